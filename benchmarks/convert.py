@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Benchmark of MetricCollector._convert_metrics on the bundled test/*.json payloads.
+
+It compares the per-scrape CPU time of the compiled rule engine against the legacy conversion loop,
+which compiled every group and metric regex for every bean and attribute.
+The compiled path is measured in steady state: series resolved on the first scrape are reused.
+
+Run from the repository root:
+    python benchmarks/convert.py [-n ITERATIONS]
+'''
+
+import os
+import re
+import sys
+import json
+import importlib
+import time
+import argparse
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prometheus_client.core import GaugeMetricFamily  # noqa: E402
+from hadoop_exporter.exporter import Exporter  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test")
+SERVICES = ["namenode", "datanode", "resourcemanager", "nodemanager"]
+
+
+def legacy_resolve_value(value, mapping):
+    if mapping:
+        mod_name, func_name = mapping.rsplit('.', 1)
+        return getattr(importlib.import_module(mod_name), func_name)(value)
+    return value
+
+
+def legacy_convert_metrics(collector, beans: List[Dict], url: str):
+    '''
+    reference copy of the conversion loop before rules were compiled.
+    '''
+    rules = {group.pattern: [rule.definition for rule in group.rules] for group in collector._rule_set}
+    metrics = {group_pattern: {} for group_pattern in rules}
+    for bean in beans:
+        for group_pattern in rules:
+            if not re.compile(group_pattern).match(bean["name"]):
+                continue
+            for metric_name, metric_value in bean.items():
+                if metric_name in collector.NON_METRIC_NAMES:
+                    continue
+                for metric_def in rules[group_pattern]:
+                    if metric_def["type"] != "GAUSE":
+                        continue
+                    if re.compile(metric_def["pattern"]).match(metric_name):
+                        pattern = re.compile("{}<>{}".format(
+                            group_pattern.rstrip("$"), metric_def["pattern"].lstrip("^")))
+                        concat_str = "{}<>{}".format(bean["name"], metric_name)
+                        sub_name = pattern.sub(metric_def["name"].replace("$", "\\"), concat_str)
+                        sub_label_names = [label for label in metric_def["labels"].keys()] \
+                            if "labels" in metric_def else []
+                        metric_identifier = '_'.join([sub_name] + sorted(sub_label_names)).lower()
+                        if metric_identifier not in metrics[group_pattern]:
+                            name = "_".join([collector._prefix, sub_name])
+                            if collector._lower_name: name = name.lower()
+                            label_names = collector._common_labels[url]["names"] + sub_label_names
+                            if collector._lower_label: label_names = [l.lower() for l in label_names]
+                            docs = name if "help" not in metric_def \
+                                else pattern.sub(metric_def["help"].replace("$", "\\"), concat_str)
+                            metrics[group_pattern][metric_identifier] = GaugeMetricFamily(name, docs, labels=label_names)
+                        sub_label_values = [pattern.sub(label.replace("$", "\\"), concat_str)
+                            for label in metric_def["labels"].values()] if "labels" in metric_def else []
+                        label_values = collector._common_labels[url]["values"] + sub_label_values
+                        if collector._lower_label: label_values = [l.lower() for l in label_values]
+                        try:
+                            resolved_value = legacy_resolve_value(metric_value, metric_def.get("mapping", None))
+                        except:
+                            pass
+                        else:
+                            metrics[group_pattern][metric_identifier].add_metric(label_values, resolved_value)
+                        break
+    return sum(len(metric.samples) for group_metrics in metrics.values() for metric in group_metrics.values())
+
+
+def compiled_convert_metrics(collector, beans: List[Dict], url: str):
+    for group in collector._rule_set:
+        collector._metrics[group.pattern] = {}
+    collector._convert_metrics(beans, url)
+    return sum(len(metric) for metrics in collector._metrics.values() for metric in metrics.values())
+
+
+def measure(func, collector, beans: List[Dict], url: str, iterations: int):
+    samples = func(collector, beans, url)
+    re.purge()
+    start = time.process_time()
+    for _ in range(iterations):
+        func(collector, beans, url)
+    return (time.process_time() - start) / iterations, samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark metric conversion on test/*.json payloads")
+    parser.add_argument("-n", dest="iterations", type=int, default=20, help="scrapes per service (default: 20)")
+    args = parser.parse_args()
+
+    print("{:<16} {:>8} {:>8} {:>12} {:>12} {:>8}".format(
+        "service", "beans", "samples", "legacy(ms)", "compiled(ms)", "speedup"))
+    for service in SERVICES:
+        with open(os.path.join(FIXTURES_DIR, f"{service}.json")) as f:
+            beans = json.load(f)["beans"]
+        url = f"http://{service}:0/jmx"
+        collector = Exporter.COLLECTOR_MAPPING[service]("benchmark", [url])
+        collector._resolve_common_labels(beans, url)
+
+        legacy, _ = measure(legacy_convert_metrics, collector, beans, url, args.iterations)
+        compiled, samples = measure(compiled_convert_metrics, collector, beans, url, args.iterations)
+        print("{:<16} {:>8} {:>8} {:>12.2f} {:>12.2f} {:>7.1f}x".format(
+            service, len(beans), samples, legacy * 1000, compiled * 1000, legacy / compiled))
+
+
+if __name__ == "__main__":
+    main()
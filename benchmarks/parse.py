@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Benchmark of jmx response parsing on the bundled test/*.json payloads.
+
+It compares loading the whole document (like response.json()) with the streaming parser of utils.iter_beans,
+which decodes only beans matched by the rules of the service. Peak memory is measured with tracemalloc.
+
+Run from the repository root:
+    python benchmarks/parse.py [-n ITERATIONS]
+'''
+
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hadoop_exporter import utils  # noqa: E402
+from hadoop_exporter.exporter import Exporter  # noqa: E402
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test")
+SERVICES = ["namenode", "datanode", "resourcemanager", "nodemanager"]
+
+
+def load_all(body: bytes, accept):
+    return json.loads(body.decode("utf-8"))["beans"]
+
+
+def stream(body: bytes, accept):
+    chunks = (body[i:i + utils.HTTP_CHUNK_SIZE] for i in range(0, len(body), utils.HTTP_CHUNK_SIZE))
+    return list(utils.iter_beans(chunks, accept))
+
+
+def measure(func, body: bytes, accept, iterations: int):
+    tracemalloc.start()
+    beans = func(body, accept)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del beans
+    start = time.process_time()
+    for _ in range(iterations):
+        beans = func(body, accept)
+    return (time.process_time() - start) / iterations, peak, len(beans)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark jmx response parsing on test/*.json payloads")
+    parser.add_argument("-n", dest="iterations", type=int, default=20, help="parses per service (default: 20)")
+    args = parser.parse_args()
+
+    print("{:<16} {:>8} {:>6} {:>10} {:>10} {:>6} {:>10} {:>10}".format(
+        "service", "size(KB)", "beans", "load(ms)", "peak(KB)", "kept", "stream(ms)", "peak(KB)"))
+    for service in SERVICES:
+        with open(os.path.join(FIXTURES_DIR, f"{service}.json"), "rb") as f:
+            body = f.read()
+        collector = Exporter.COLLECTOR_MAPPING[service]("benchmark", ["http://localhost:0/jmx"])
+
+        load_time, load_peak, beans = measure(load_all, body, collector._accept_bean, args.iterations)
+        stream_time, stream_peak, kept = measure(stream, body, collector._accept_bean, args.iterations)
+        print("{:<16} {:>8} {:>6} {:>10.2f} {:>10} {:>6} {:>10.2f} {:>10}".format(
+            service, len(body) // 1024, beans, load_time * 1000, load_peak // 1024,
+            kept, stream_time * 1000, stream_peak // 1024))
+    print("json backend: {}".format(utils.json_loads.__module__ or "json"))
+
+
+if __name__ == "__main__":
+    main()
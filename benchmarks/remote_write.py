@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Push mode benchmark against a stand-in Prometheus remote-write receiver.
+
+The receiver decodes each request (snappy, then the protobuf WriteRequest) and counts the series and samples it
+received. It can reject a fraction of the requests with 503 or answer slowly, to observe the retries and the
+backpressure of the RemoteWriter.
+
+For each run, it reports the series pushed per second, the requests and bytes received, and the series sent,
+failed and dropped by the writer.
+
+Run from the repository root:
+    python benchmarks/remote_write.py [--series N] [--pushes N] [--batch-size N] [--fail-rate 0.2] [--delay 0.05]
+'''
+
+import os
+import sys
+import time
+import random
+import struct
+import argparse
+import threading
+from typing import Dict, List, Tuple
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hadoop_exporter.remote_write import RemoteWriter  # noqa: E402
+from hadoop_exporter.store import ColumnarMetricFamily, LabelSet  # noqa: E402
+
+
+def decode_varint(data: bytes, position: int) -> Tuple[int, int]:
+    value, shift = 0, 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def snappy_decompress(data: bytes) -> bytes:
+    size, position = decode_varint(data, 0)
+    output = bytearray()
+    while position < len(data):
+        tag = data[position]
+        position += 1
+        kind = tag & 3
+        if kind == 0:
+            length = tag >> 2
+            if length >= 60:
+                length_bytes = length - 59
+                length = int.from_bytes(data[position:position + length_bytes], "little")
+                position += length_bytes
+            length += 1
+            output += data[position:position + length]
+            position += length
+            continue
+        if kind == 1:
+            length = 4 + ((tag >> 2) & 7)
+            offset = ((tag >> 5) << 8) | data[position]
+            position += 1
+        else:
+            length = (tag >> 2) + 1
+            offset_bytes = 2 if kind == 2 else 4
+            offset = int.from_bytes(data[position:position + offset_bytes], "little")
+            position += offset_bytes
+        for _ in range(length):
+            output.append(output[-offset])
+    if len(output) != size:
+        raise ValueError("snappy: expected {} bytes, got {}".format(size, len(output)))
+    return bytes(output)
+
+
+def decode_fields(data: bytes):
+    '''
+    @return (field number, value) of the fields of a protobuf message, bytes for length-delimited fields.
+    '''
+    position = 0
+    while position < len(data):
+        key, position = decode_varint(data, position)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, position = decode_varint(data, position)
+        elif wire_type == 1:
+            value = struct.unpack("<d", data[position:position + 8])[0]
+            position += 8
+        elif wire_type == 2:
+            length, position = decode_varint(data, position)
+            value = data[position:position + length]
+            position += length
+        else:
+            raise ValueError("unexpected wire type {}".format(wire_type))
+        yield field, value
+
+
+def decode_write_request(data: bytes) -> List[Tuple[Dict[str, str], List[Tuple[float, int]]]]:
+    '''
+    @return (labels, samples as (value, timestamp ms)) of each timeseries of a WriteRequest.
+    '''
+    series = []
+    for _, timeseries in decode_fields(data):
+        labels, samples = {}, []
+        for field, value in decode_fields(timeseries):
+            if field == 1:
+                label = dict(decode_fields(value))
+                labels[label[1].decode()] = label[2].decode()
+            elif field == 2:
+                sample = dict(decode_fields(value))
+                samples.append((sample.get(1, 0.0), sample.get(2, 0)))
+        series.append((labels, samples))
+    return series
+
+
+class Receiver(object):
+    '''
+    Stand-in remote-write receiver, in a thread of the benchmark process.
+    '''
+
+    def __init__(self, fail_rate: float = 0, delay: float = 0):
+        self.fail_rate = fail_rate
+        self.delay = delay
+        self.requests = 0
+        self.rejected = 0
+        self.bytes = 0
+        self.series = 0
+        self.names = set()
+        self._lock = threading.Lock()
+        receiver = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                if receiver.delay:
+                    time.sleep(receiver.delay)
+                if random.random() < receiver.fail_rate:
+                    with receiver._lock:
+                        receiver.rejected += 1
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                try:
+                    series = decode_write_request(snappy_decompress(body))
+                except Exception as e:
+                    self.send_response(400)
+                    self.end_headers()
+                    self.wfile.write(str(e).encode())
+                    return
+                with receiver._lock:
+                    receiver.requests += 1
+                    receiver.bytes += len(body)
+                    receiver.series += len(series)
+                    receiver.names.update(labels["__name__"] for labels, _ in series)
+                self.send_response(204)
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}/api/v1/write".format(self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+
+def build_metrics(series: int, families: int = 20) -> List[ColumnarMetricFamily]:
+    metrics = []
+    for index in range(families):
+        family = ColumnarMetricFamily("hadoop_hdfs_datanode_bench_{}".format(index), "bench", ["cluster", "host"])
+        for host in range(series // families):
+            family.add(LabelSet(["bench", "dn{}.example.com".format(host)]), float(host))
+        metrics.append(family)
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--series", type=int, default=100000, help="series of each push")
+    parser.add_argument("--pushes", type=int, default=10, help="number of pushes")
+    parser.add_argument("--batch-size", type=int, default=2000)
+    parser.add_argument("--queue-size", type=int, default=100000)
+    parser.add_argument("--fail-rate", type=float, default=0, help="fraction of requests rejected with 503")
+    parser.add_argument("--delay", type=float, default=0, help="seconds the receiver waits before answering")
+    args = parser.parse_args()
+
+    receiver = Receiver(args.fail_rate, args.delay)
+    writer = RemoteWriter(receiver.url, batch_size=args.batch_size, queue_size=args.queue_size, flush_interval=1,
+                          enqueue_timeout=5, backoff=0.05, backoff_max=1)
+    writer.start()
+    metrics = build_metrics(args.series)
+    started = time.perf_counter()
+    for _ in range(args.pushes):
+        writer.push(metrics)
+    flushed = writer.flush(timeout=60)
+    elapsed = time.perf_counter() - started
+    writer.stop(timeout=5)
+
+    samples = dict(writer._stats._samples)
+    print("pushed {} series in {:.2f}s, {:.0f} series/s{}".format(
+        args.series * args.pushes, elapsed, args.series * args.pushes / elapsed, "" if flushed else " (not flushed)"))
+    print("receiver: {} requests, {} rejected, {:.1f} MiB, {} series, {} families".format(
+        receiver.requests, receiver.rejected, receiver.bytes / 2 ** 20, receiver.series, len(receiver.names)))
+    print("writer: {}".format(", ".join("{} {}".format(count, result) for result, count in sorted(samples.items()))))
+    receiver.server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Offline replay benchmark of the collectors against a stand-in jmx http server serving the test/*.json payloads.
+
+Each scenario scrapes a service through the whole pull path (fetch, convert, expose) from N simulated endpoints,
+each endpoint answering the fixture with its own hostname. Larger payloads can be synthesized from the fixtures,
+e.g. a resourcemanager with 5000 queues or a datanode with 1000 volumes.
+
+For each scenario, it reports scrape latency percentiles, cpu time per scrape, fetch latency, conversion cpu time,
+peak rss and the number of series exported. Each scenario runs in its own process, the server in another one.
+
+Run from the repository root:
+    python benchmarks/replay.py [-n SCRAPES] [--endpoints N] [--queues N] [--volumes N]
+    python benchmarks/replay.py --save-baseline       # store results in benchmarks/baseline.json
+    python benchmarks/replay.py --check               # exit 1 if a scenario regressed against the baseline
+                                                      # or a refresh policy of the rules is lost
+    python benchmarks/replay.py --async               # scrape with the asyncio collector (collect_async)
+'''
+
+import os
+import sys
+import json
+import asyncio
+import time
+import fnmatch
+import logging
+import argparse
+import resource
+import threading
+import collections
+import multiprocessing
+from typing import Dict, List, Optional
+from urllib.parse import urlparse, parse_qs
+from urllib.request import urlopen
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prometheus_client import CollectorRegistry  # noqa: E402
+from hadoop_exporter.exposition import generate_latest  # noqa: E402
+from hadoop_exporter.exporter import Exporter  # noqa: E402
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(ROOT_DIR, "test")
+BASELINE_FILE = os.path.join(ROOT_DIR, "benchmarks", "baseline.json")
+SERVICES = ["namenode", "datanode", "resourcemanager", "nodemanager"]
+# measures compared with the baseline: conversion engine and fetch path
+CHECKED_MEASURES = ["convert_cpu_ms", "fetch_p50_ms", "scrape_cpu_ms"]
+
+
+def load_fixture(service: str) -> List[Dict]:
+    with open(os.path.join(FIXTURES_DIR, f"{service}.json")) as f:
+        return json.load(f)["beans"]
+
+
+def synthesize_queues(beans: List[Dict], queues: int) -> List[Dict]:
+    '''
+    add queues to a resourcemanager payload, as copies of its root.default queue.
+    '''
+    template = next(bean for bean in beans if bean["name"].endswith(",q0=root,q1=default"))
+    synthesized = []
+    for i in range(queues):
+        bean = dict(template)
+        bean["name"] = template["name"].replace("q1=default", f"q1=queue{i}")
+        bean["modelerType"] = template["modelerType"].replace("q1=default", f"q1=queue{i}")
+        bean["tag.Queue"] = f"root.queue{i}"
+        synthesized.append(bean)
+    return beans + synthesized
+
+
+def synthesize_volumes(beans: List[Dict], volumes: int) -> List[Dict]:
+    '''
+    add volumes to a datanode payload, as copies of its first DataNodeVolume bean.
+    '''
+    template = next(bean for bean in beans if ",name=DataNodeVolume-" in bean["name"])
+    path = template["name"].split("DataNodeVolume-", 1)[1]
+    synthesized = []
+    for i in range(volumes):
+        bean = dict(template)
+        bean["name"] = template["name"].replace(path, f"/data{i}/hadoop/dfs/data")
+        bean["modelerType"] = template["modelerType"].replace(path, f"/data{i}/hadoop/dfs/data")
+        synthesized.append(bean)
+    return beans + synthesized
+
+
+def build_scenarios(queues: int, volumes: int) -> Dict[str, Dict]:
+    '''
+    @return a dict of scenario name to its service and payload.
+    '''
+    scenarios = {service: {"service": service, "beans": load_fixture(service)} for service in SERVICES}
+    if queues:
+        scenarios[f"resourcemanager_{queues}_queues"] = {
+            "service": "resourcemanager", "beans": synthesize_queues(load_fixture("resourcemanager"), queues)}
+    if volumes:
+        scenarios[f"datanode_{volumes}_volumes"] = {
+            "service": "datanode", "beans": synthesize_volumes(load_fixture("datanode"), volumes)}
+    return scenarios
+
+
+def parse_object_name(name: str):
+    domain, _, properties = name.partition(":")
+    return domain, dict(prop.split("=", 1) for prop in properties.split(",") if "=" in prop)
+
+
+def match_object_name(pattern: str, name: str) -> bool:
+    '''
+    whether a bean name matches a jmx ObjectName pattern, as the qry parameter of the jmx servlet.
+    '''
+    property_list_pattern = pattern.endswith(",*")
+    if property_list_pattern:
+        pattern = pattern[:-2]
+    pattern_domain, pattern_properties = parse_object_name(pattern)
+    domain, properties = parse_object_name(name)
+    if not fnmatch.fnmatchcase(domain, pattern_domain):
+        return False
+    if not property_list_pattern and set(pattern_properties) != set(properties):
+        return False
+    return all(key in properties and fnmatch.fnmatchcase(properties[key], value)
+               for key, value in pattern_properties.items())
+
+
+def serve(scenarios: Dict[str, Dict], delay: float, ready):
+    '''
+    stand-in jmx server, answers /<scenario>/<endpoint>/jmx[?qry=...] with the payload of the scenario,
+    and /requests/<scenario>/<endpoint> with the number of requests it got per qry.
+    '''
+    bodies: Dict[tuple, bytes] = {}
+    requests = collections.Counter()
+    lock = threading.Lock()
+    hostnames = {}
+    for name, scenario in scenarios.items():
+        hostnames[name] = next((bean["tag.Hostname"] for bean in scenario["beans"] if "tag.Hostname" in bean), None)
+
+    def get_body(name: str, endpoint: str, query: Optional[str]) -> bytes:
+        key = (name, query)
+        with lock:
+            body = bodies.get(key)
+        if body is None:
+            beans = scenarios[name]["beans"]
+            if query:
+                beans = [bean for bean in beans if match_object_name(query, bean["name"])]
+            body = json.dumps({"beans": beans}, indent=2).encode()
+            with lock:
+                bodies[key] = body
+        # each endpoint is a different host
+        if hostnames[name]:
+            body = body.replace(f'"{hostnames[name]}"'.encode(), f'"{hostnames[name]}-{endpoint}"'.encode())
+        return body
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # headers and body are written apart, don't let nagle delay the body
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            parts = url.path.strip("/").split("/")
+            if len(parts) == 3 and parts[0] == "requests":
+                with lock:
+                    body = json.dumps({query: count for (name, endpoint, query), count in requests.items()
+                                       if (name, endpoint) == (parts[1], parts[2])}).encode()
+            elif len(parts) != 3 or parts[0] not in scenarios:
+                self.send_error(404)
+                return
+            else:
+                query = parse_qs(url.query).get("qry", [""])[0]
+                with lock:
+                    requests[(parts[0], parts[1], query)] += 1
+                body = get_body(parts[0], parts[1], query or None)
+            if delay:
+                time.sleep(delay)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json; charset=utf8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    ready.put(server.server_port)
+    server.serve_forever()
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run_scenario(name: str, service: str, port: int, endpoints: int, scrapes: int, use_async: bool, results):
+    '''
+    scrape a scenario in a fresh process, so its peak rss is not mixed with other scenarios.
+    @param use_async: Scrape with collect_async in an event loop instead of collect.
+    '''
+    logging.disable(logging.WARNING)
+    urls = [f"http://127.0.0.1:{port}/{name}/{i}/jmx" for i in range(endpoints)]
+    # endpoints share the host of the stand-in server, the async client would limit them to pool_size connections
+    collector = Exporter.COLLECTOR_MAPPING[service](
+        "benchmark", urls, max_in_flight=endpoints, **({"pool_size": endpoints} if use_async else {}))
+    if use_async:
+        loop = asyncio.new_event_loop()
+
+        class AsyncRegistry(object):
+            def collect(self):
+                return loop.run_until_complete(collector.collect_async())
+
+        registry = AsyncRegistry()
+        fetch_all = lambda: loop.run_until_complete(collector._fetch_all_async())
+    else:
+        registry = CollectorRegistry()
+        registry.register(collector)
+        fetch_all = collector._fetch_all
+    # first scrape resolves common labels and series, it's measured apart
+    started = time.perf_counter()
+    output = generate_latest(registry).decode()
+    first_scrape = time.perf_counter() - started
+    series = sum(1 for line in output.splitlines() if line and not line.startswith("#"))
+
+    latencies, cpu_times = [], []
+    for _ in range(scrapes):
+        started, cpu_started = time.perf_counter(), time.process_time()
+        generate_latest(registry)
+        latencies.append(time.perf_counter() - started)
+        cpu_times.append(time.process_time() - cpu_started)
+
+    fetch_latencies = []
+    for _ in range(scrapes):
+        started = time.perf_counter()
+        fetched = fetch_all()
+        fetch_latencies.append(time.perf_counter() - started)
+
+    convert_times = []
+    for _ in range(scrapes):
+        started = time.process_time()
+        collector._metrics = {group.pattern: {} for group in collector._rule_set}
+        for url, beans in fetched.items():
+            collector._convert_metrics(beans, url)
+        convert_times.append(time.process_time() - started)
+
+    results.put({
+        "scenario": name,
+        "endpoints": endpoints,
+        "client": "async" if use_async else "sync",
+        "first_scrape_ms": first_scrape * 1000,
+        "scrape_p50_ms": percentile(latencies, 0.5) * 1000,
+        "scrape_p90_ms": percentile(latencies, 0.9) * 1000,
+        "scrape_p99_ms": percentile(latencies, 0.99) * 1000,
+        "scrape_cpu_ms": sum(cpu_times) / len(cpu_times) * 1000,
+        "fetch_p50_ms": percentile(fetch_latencies, 0.5) * 1000,
+        "convert_cpu_ms": sum(convert_times) / len(convert_times) * 1000,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "series": series,
+    })
+
+
+def check_refresh(name: str, service: str, port: int, results):
+    '''
+    check in a fresh process that the groups with a refresh policy keep their own query, whatever the merge of the
+    other queries, and that two scrapes within the shortest refresh fetch each of these queries once.
+    '''
+    logging.disable(logging.WARNING)
+    endpoint = "refresh"
+    collector = Exporter.COLLECTOR_MAPPING[service]("benchmark", [f"http://127.0.0.1:{port}/{name}/{endpoint}/jmx"])
+    refreshes = {group.refresh for group in collector._rule_set if group.refresh}
+    if not refreshes or collector._queries is None:
+        results.put([f"{name}: refresh {sorted(refreshes)} without queries"] if refreshes else [])
+        return
+    slow_queries = {query: refresh for query, refresh in collector._queries if refresh}
+    regressions = [f"{name}: refresh {refresh} lost by the queries {collector._queries}"
+                   for refresh in sorted(refreshes - set(slow_queries.values()))]
+    registry = CollectorRegistry()
+    registry.register(collector)
+    started = time.time()
+    for _ in range(2):
+        generate_latest(registry)
+    if time.time() - started < min(refreshes):
+        with urlopen(f"http://127.0.0.1:{port}/requests/{name}/{endpoint}") as response:
+            requests = json.load(response)
+        regressions.extend(f"{name}: refresh {refresh} query {query} requested {requests.get(query, 0)} times "
+                           "by two scrapes, instead of once"
+                           for query, refresh in slow_queries.items() if requests.get(query, 0) != 1)
+    results.put(regressions)
+
+
+def check_regressions(results: List[Dict], baseline: Dict[str, Dict], tolerance: float, min_delta: float) -> List[str]:
+    '''
+    @return a message for each measure slower than its baseline by more than tolerance and min_delta milliseconds,
+            so the noise of the smallest scenarios isn't reported.
+    '''
+    regressions = []
+    for result in results:
+        reference = baseline.get(result["scenario"])
+        if reference is None or reference.get("endpoints") != result["endpoints"] \
+                or reference.get("client", "sync") != result["client"]:
+            continue
+        for measure in CHECKED_MEASURES:
+            if measure in reference and result[measure] > reference[measure] * (1 + tolerance) \
+                    and result[measure] - reference[measure] > min_delta:
+                regressions.append("{}: {} {:.2f} > baseline {:.2f} (+{:.0f}%)".format(
+                    result["scenario"], measure, result[measure], reference[measure],
+                    (result[measure] / reference[measure] - 1) * 100))
+        if "series" in reference and result["series"] != reference["series"]:
+            regressions.append("{}: series {} != baseline {}".format(
+                result["scenario"], result["series"], reference["series"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="replay test/*.json payloads through the collectors")
+    parser.add_argument("-n", dest="scrapes", type=int, default=20, help="scrapes per scenario (default: 20)")
+    parser.add_argument("--endpoints", type=int, default=1, help="simulated jmx endpoints per scenario (default: 1)")
+    parser.add_argument("--queues", type=int, default=5000, help="queues of the synthesized resourcemanager, 0 to skip (default: 5000)")
+    parser.add_argument("--volumes", type=int, default=1000, help="volumes of the synthesized datanode, 0 to skip (default: 1000)")
+    parser.add_argument("--delay", type=float, default=0, help="response delay (seconds) of the stand-in server (default: 0)")
+    parser.add_argument("--scenario", action="append", help="run only this scenario, can be repeated")
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="scrape with the asyncio collector instead of the thread pool")
+    parser.add_argument("--save-baseline", action="store_true", help=f"store results in {BASELINE_FILE}")
+    parser.add_argument("--check", action="store_true", help="exit 1 if a scenario regressed against the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown against the baseline (default: 0.25)")
+    parser.add_argument("--min-delta", type=float, default=5, help="allowed slowdown (ms) against the baseline (default: 5)")
+    args = parser.parse_args()
+
+    os.chdir(ROOT_DIR)
+    scenarios = build_scenarios(args.queues, args.volumes)
+    if args.scenario:
+        scenarios = {name: scenario for name, scenario in scenarios.items() if name in args.scenario}
+
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(scenarios, args.delay, ready), daemon=True)
+    server.start()
+    port = ready.get()
+
+    results = []
+    print("{:<30} {:>9} {:>9} {:>9} {:>9} {:>9} {:>9} {:>10} {:>8} {:>8}".format(
+        "scenario", "first(ms)", "p50(ms)", "p90(ms)", "p99(ms)", "cpu(ms)", "fetch(ms)", "convert(ms)", "rss(MB)", "series"))
+    try:
+        for name, scenario in scenarios.items():
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process(
+                target=run_scenario,
+                args=(name, scenario["service"], port, args.endpoints, args.scrapes, args.use_async, queue))
+            process.start()
+            result = queue.get()
+            process.join()
+            results.append(result)
+            print("{scenario:<30} {first_scrape_ms:>9.2f} {scrape_p50_ms:>9.2f} {scrape_p90_ms:>9.2f} {scrape_p99_ms:>9.2f} "
+                  "{scrape_cpu_ms:>9.2f} {fetch_p50_ms:>9.2f} {convert_cpu_ms:>10.2f} {peak_rss_mb:>8.1f} {series:>8}".format(**result))
+        refresh_regressions = []
+        if args.check:
+            for name, scenario in scenarios.items():
+                if name != scenario["service"]:
+                    continue
+                queue = multiprocessing.Queue()
+                process = multiprocessing.Process(target=check_refresh, args=(name, scenario["service"], port, queue))
+                process.start()
+                refresh_regressions.extend(queue.get())
+                process.join()
+    finally:
+        server.terminate()
+
+    if args.save_baseline:
+        with open(BASELINE_FILE, "w") as f:
+            json.dump({result["scenario"]: result for result in results}, f, indent=2, sort_keys=True)
+        print(f"baseline saved to {BASELINE_FILE}")
+    if args.check:
+        if not os.path.exists(BASELINE_FILE):
+            sys.exit(f"no baseline in {BASELINE_FILE}, run with --save-baseline first")
+        with open(BASELINE_FILE) as f:
+            regressions = check_regressions(results, json.load(f), args.tolerance, args.min_delta) + refresh_regressions
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("no regression against baseline")
+
+
+if __name__ == "__main__":
+    main()
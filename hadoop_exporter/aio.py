@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import ssl
+import time
+import asyncio
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlencode, urlsplit
+import requests
+from hadoop_exporter import utils
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# seconds to wait for an idle connection to be closed
+CLOSE_TIMEOUT = 1
+
+
+class AsyncJmxClient(object):
+    '''
+    Non-blocking http client of jmx servlets, for the event loop it is used in.
+    Requests are sent by aiohttp if it is installed, which follows redirects and handles proxies and authentication
+    like requests. Otherwise by a minimal http/1.1 client, which only sends GET requests to the url as is.
+    Connections are kept alive and pooled per host, at most limit_per_host requests are in flight to a host.
+    Errors are raised as the exceptions of requests, e.g. requests.Timeout or requests.HTTPError, so they are handled
+    as the ones of the blocking session. Only 2xx responses are successful.
+    '''
+
+    def __init__(self, limit_per_host: int = utils.HTTP_POOL_SIZE_DEFAULT, timeout: float = utils.HTTP_TIMEOUT_DEFAULT,
+                 keep_alive: bool = True, retries: int = 0, backoff_factor: float = 0):
+        '''
+        @param limit_per_host: Max number of connections to a host, all kept alive.
+        @param timeout: Timeout (seconds) to connect and of each read.
+        @param keep_alive: Reuse connections between requests if true, else close them after each request.
+        @param retries: Number of retries on connection errors and 5xx responses.
+        @param backoff_factor: Sleep {backoff_factor} * (2 ^ (retry - 1)) seconds between retries.
+        '''
+        self._limit_per_host = max(1, limit_per_host)
+        self._timeout = timeout
+        self._keep_alive = keep_alive
+        self._retries = retries
+        self._backoff_factor = backoff_factor
+        self._ssl_context = None
+        # session of aiohttp, created in the event loop on first request
+        self._session = None
+        # (scheme, host, port) -> semaphore limiting connections to the host, idle connections
+        self._limits: Dict[Tuple[str, str, int], asyncio.Semaphore] = {}
+        self._idle: Dict[Tuple[str, str, int], List[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]] = {}
+
+    async def get(self, url: str, params: Optional[Dict] = None, stats: Optional[utils.FetchStats] = None,
+                  consume: Optional[Callable[[bytes], None]] = None) -> List[bytes]:
+        '''
+        @param params: The query parameters, e.g. {"qry": "Hadoop:service=NameNode,name=FSNamesystem"}
+        @param stats: Accumulates durations of request and download and the bytes received.
+        @param consume: Called with each chunk of the body as it is received, instead of keeping the chunks.
+        @return the response body as a list of chunks, empty if consumed.
+        @raise requests.HTTPError if the response status is not 2xx.
+        '''
+        stats = stats or utils.FetchStats()
+        chunks = []
+        received = 0
+
+        def receive(chunk: bytes):
+            nonlocal received
+            received += len(chunk)
+            stats.bytes += len(chunk)
+            if consume is None:
+                chunks.append(chunk)
+            else:
+                consume(chunk)
+
+        retry = 0
+        while True:
+            try:
+                if aiohttp is not None:
+                    status, reason = await self._request_aiohttp(url, params, stats, receive)
+                else:
+                    status, reason = await self._request_url(url, params, stats, receive)
+            except (requests.ConnectionError, requests.Timeout):
+                # a body partially consumed can't be received again
+                if retry >= self._retries or received:
+                    raise
+            else:
+                if 200 <= status < 300:
+                    return chunks
+                if status not in utils.HTTP_RETRY_STATUS or retry >= self._retries:
+                    raise requests.HTTPError("{0} Error: {1} for url: {2}".format(status, reason, url))
+            retry += 1
+            if retry > 1:
+                await asyncio.sleep(self._backoff_factor * 2 ** (retry - 1))
+
+    async def _request_aiohttp(self, url: str, params: Optional[Dict], stats: utils.FetchStats,
+                               receive: Callable[[bytes], None]) -> Tuple[int, str]:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=0, limit_per_host=self._limit_per_host,
+                                               force_close=not self._keep_alive),
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=self._timeout, sock_read=self._timeout),
+                headers={"Accept": "application/json"}, trust_env=True)
+        started = time.perf_counter()
+        try:
+            async with self._session.get(url, params=params) as response:
+                stats.request_seconds += time.perf_counter() - started
+                started = time.perf_counter()
+                if 200 <= response.status < 300:
+                    async for chunk in response.content.iter_chunked(utils.HTTP_CHUNK_SIZE):
+                        receive(chunk)
+                stats.download_seconds += time.perf_counter() - started
+                return response.status, response.reason or ""
+        except asyncio.TimeoutError:
+            raise requests.Timeout("request to {0} timed out ({1}s)".format(url, self._timeout))
+        except aiohttp.ClientResponseError as e:
+            # e.g. too many redirects
+            raise requests.HTTPError("{0} Error: {1} for url: {2}".format(e.status, e.message, url))
+        except aiohttp.ClientError as e:
+            raise requests.ConnectionError("request to {0} failed: {1}".format(url, e))
+
+    async def _request_url(self, url: str, params: Optional[Dict], stats: utils.FetchStats,
+                           receive: Callable[[bytes], None]) -> Tuple[int, str]:
+        parts = urlsplit(url)
+        key = (parts.scheme or "http", parts.hostname or "localhost",
+               parts.port or (443 if parts.scheme == "https" else 80))
+        query = "&".join(query for query in (parts.query, urlencode(params or {})) if query)
+        target = (parts.path or "/") + ("?" + query if query else "")
+        return await self._request(key, parts.netloc, target, stats, receive)
+
+    async def _request(self, key: Tuple[str, str, int], netloc: str, target: str, stats: utils.FetchStats,
+                       receive: Callable[[bytes], None]) -> Tuple[int, str]:
+        limit = self._limits.get(key)
+        if limit is None:
+            limit = self._limits[key] = asyncio.Semaphore(self._limit_per_host)
+        async with limit:
+            idle = self._idle.setdefault(key, [])
+            while True:
+                reused = bool(idle)
+                reader, writer = idle.pop() if reused else await self._connect(key)
+                started = time.perf_counter()
+                status = None
+                try:
+                    writer.write("GET {0} HTTP/1.1\r\nHost: {1}\r\nAccept: application/json\r\n"
+                                 "Accept-Encoding: identity\r\nConnection: {2}\r\n\r\n".format(
+                                     target, netloc, "keep-alive" if self._keep_alive else "close").encode("latin-1"))
+                    await writer.drain()
+                    status_line = await self._read(reader.readline())
+                    if not status_line and reused:
+                        # the idle connection was closed by the server, send again on a new one
+                        writer.close()
+                        continue
+                    status, reason, headers, keep_alive = await self._read_head(reader, status_line)
+                    stats.request_seconds += time.perf_counter() - started
+                    started = time.perf_counter()
+                    # the body of an error is read to reuse the connection, but not received
+                    await self._read_body(reader, headers, receive if 200 <= status < 300 else None)
+                    stats.download_seconds += time.perf_counter() - started
+                except (ConnectionError, asyncio.IncompleteReadError) as e:
+                    writer.close()
+                    if reused and status is None:
+                        continue
+                    raise requests.ConnectionError("connection to {0} failed: {1}".format(netloc, e))
+                except:
+                    writer.close()
+                    raise
+                if keep_alive and self._keep_alive and (
+                        "content-length" in headers or "chunked" in headers.get("transfer-encoding", "")):
+                    idle.append((reader, writer))
+                else:
+                    writer.close()
+                return status, reason
+
+    async def _connect(self, key: Tuple[str, str, int]) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        scheme, host, port = key
+        if scheme == "https" and self._ssl_context is None:
+            self._ssl_context = ssl.create_default_context()
+        try:
+            return await asyncio.wait_for(asyncio.open_connection(
+                host, port, ssl=self._ssl_context if scheme == "https" else None), self._timeout)
+        except asyncio.TimeoutError:
+            raise requests.ConnectTimeout("connection to {0}:{1} timed out".format(host, port))
+        except OSError as e:
+            raise requests.ConnectionError("can't connect to {0}:{1}: {2}".format(host, port, e))
+
+    async def _read(self, awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, self._timeout)
+        except asyncio.TimeoutError:
+            raise requests.ReadTimeout("read timed out ({0}s)".format(self._timeout))
+
+    async def _read_head(self, reader: asyncio.StreamReader,
+                         status_line: bytes) -> Tuple[int, str, Dict[str, str], bool]:
+        '''
+        @return a tuple of (status, reason, headers with lower case names, whether the connection is kept alive).
+        '''
+        parts = status_line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/") or not parts[1].isdigit():
+            raise requests.ConnectionError("bad status line: {0!r}".format(status_line[:64]))
+        headers = {}
+        while True:
+            line = await self._read(reader.readline())
+            if not line:
+                raise asyncio.IncompleteReadError(b"", None)
+            if line in (b"\r\n", b"\n"):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection == "keep-alive" if parts[0] == "HTTP/1.0" else connection != "close"
+        return int(parts[1]), parts[2] if len(parts) > 2 else "", headers, keep_alive
+
+    async def _read_body(self, reader: asyncio.StreamReader, headers: Dict[str, str],
+                         receive: Optional[Callable[[bytes], None]]):
+        receive = receive or (lambda chunk: None)
+        if "chunked" in headers.get("transfer-encoding", ""):
+            while True:
+                size = int((await self._read(reader.readline())).split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    # trailers, until the empty line
+                    while (await self._read(reader.readline())).strip():
+                        pass
+                    break
+                receive(await self._read(reader.readexactly(size)))
+                await self._read(reader.readexactly(2))
+        elif "content-length" in headers:
+            remaining = int(headers["content-length"])
+            while remaining > 0:
+                chunk = await self._read(reader.read(min(remaining, utils.HTTP_CHUNK_SIZE)))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b"", remaining)
+                receive(chunk)
+                remaining -= len(chunk)
+        else:
+            # the body ends with the connection
+            while True:
+                chunk = await self._read(reader.read(utils.HTTP_CHUNK_SIZE))
+                if not chunk:
+                    break
+                receive(chunk)
+
+    def close_host(self, url: str):
+        '''
+        close the idle connections to the host of an url, e.g. a target which is not scraped anymore.
+        idle connections of aiohttp are closed by its connector after their keep alive timeout.
+        '''
+        parts = urlsplit(url)
+        key = (parts.scheme or "http", parts.hostname or "localhost",
+               parts.port or (443 if parts.scheme == "https" else 80))
+        for _, writer in self._idle.pop(key, []):
+            writer.close()
+        self._limits.pop(key, None)
+
+    async def close(self):
+        if self._session is not None:
+            session, self._session = self._session, None
+            await session.close()
+        writers = [writer for idle in self._idle.values() for _, writer in idle]
+        self._idle.clear()
+        for writer in writers:
+            writer.close()
+        for writer in writers:
+            try:
+                await asyncio.wait_for(writer.wait_closed(), CLOSE_TIMEOUT)
+            except:
+                pass
+
+
+async def fetch_beans_async(client: AsyncJmxClient, url: str, params: Optional[Dict] = None,
+                            accept: Optional[Callable[[str], bool]] = None, stream: bool = False,
+                            stats: Optional[utils.FetchStats] = None) -> List[Dict]:
+    '''
+    same as utils.fetch_beans, the response is received by the non-blocking client.
+    :param stream: Parse beans incrementally from the chunks of the response as they are received, the whole body is
+                   never held in memory and beans not accepted are never decoded.
+    '''
+    stats = stats or utils.FetchStats()
+    if stream:
+        parser = utils.BeanParser(accept, stats)
+        beans = []
+        decoded = 0.0
+
+        def consume(chunk: bytes):
+            nonlocal decoded
+            started = time.perf_counter()
+            beans.extend(parser.feed(chunk))
+            decoded += time.perf_counter() - started
+
+        await client.get(url, params, stats, consume)
+        parser.close()
+        # chunks are decoded while the body is downloaded
+        stats.decode_seconds += decoded
+        stats.download_seconds -= decoded
+        return beans
+    chunks = await client.get(url, params, stats)
+    return utils.load_beans(b"".join(chunks), url, accept, stats)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import defaultdict
+from typing import Dict, Tuple
+
+MAX_SERIES_DEFAULT = 0
+OVERFLOW_DROP = "drop"
+OVERFLOW_AGGREGATE = "aggregate"
+OVERFLOW_ACTIONS = (OVERFLOW_DROP, OVERFLOW_AGGREGATE)
+# value of the labels of a rule in the series aggregating its overflowing series
+OVERFLOW_LABEL_VALUE = "__overflow__"
+# overflow of a dropped series, aggregated series refer to the series they are aggregated into instead
+DROPPED = object()
+
+
+class SeriesLimiter(object):
+    '''
+    Series budgets of a collector: at most max_series series for the collector, and at most the max_series
+    of each rule defining one. A series takes a slot of the budgets when it is resolved and keeps it while its bean
+    attribute is scraped, so the same series are exported from one scrape to the next whatever the order of beans.
+    New series beyond a budget overflow: they are dropped, or aggregated by the collector into one series per metric
+    if the overflow of their rule is aggregate. Slots released by disappeared series are given to the overflowing
+    series on their next resolution.
+    Series are resolved once and cached by the collector, so they are counted exactly without any per-scrape cost.
+    '''
+
+    def __init__(self, max_series: int = MAX_SERIES_DEFAULT):
+        '''
+        @param max_series: Max series of the collector, 0 for no limit beside the ones of the rules.
+        '''
+        self.max_series = max_series
+        self.total = 0
+        self._rule_series: Dict[object, int] = defaultdict(int)
+        # (group pattern, rule pattern, overflow action) -> overflowing series
+        self.overflow: Dict[Tuple[str, str, str], int] = defaultdict(int)
+        # whether slots were released while series overflow
+        self.released = False
+
+    def admit(self, series) -> bool:
+        '''
+        take a slot of the budgets for a new series.
+        @return False if a budget is full, the series overflows.
+        '''
+        rule = series.rule
+        if (self.max_series > 0 and self.total >= self.max_series) or \
+                (rule.max_series > 0 and self._rule_series[rule] >= rule.max_series):
+            self.overflow[self.get_overflow_key(series)] += 1
+            return False
+        self.total += 1
+        self._rule_series[rule] += 1
+        return True
+
+    def release(self, series):
+        '''
+        free the slot of a series which is not scraped anymore, or stop counting it if it overflowed.
+        '''
+        if series.overflow is not None:
+            key = self.get_overflow_key(series)
+            self.overflow[key] -= 1
+            if self.overflow[key] <= 0:
+                del self.overflow[key]
+            return
+        self.total -= 1
+        self._rule_series[series.rule] -= 1
+        if self.overflow:
+            self.released = True
+
+    def get_overflow_key(self, series) -> Tuple[str, str, str]:
+        return series.group_pattern, series.rule.definition["pattern"], series.rule.overflow
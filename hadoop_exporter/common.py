@@ -3,13 +3,84 @@
 
 import os
 import re
+import time
+import asyncio
 import traceback
+from array import array
 from logging import Logger
-from typing import Any, List, Dict, Optional, Union
-from prometheus_client.core import GaugeMetricFamily
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Any, List, Dict, Optional, Tuple, Union
+from urllib.parse import urlparse
+import requests
 from hadoop_exporter import utils
+from hadoop_exporter.aio import AsyncJmxClient, fetch_beans_async
+from hadoop_exporter.cardinality import SeriesLimiter, DROPPED, MAX_SERIES_DEFAULT, OVERFLOW_AGGREGATE, \
+    OVERFLOW_LABEL_VALUE
+from hadoop_exporter.rules import get_rule_registry
+from hadoop_exporter.mapping import to_number
+from hadoop_exporter.discovery import TargetDiscovery, DISCOVERY_INTERVAL_DEFAULT
+from hadoop_exporter.replicas import ReplicaSet
+from hadoop_exporter.health import TargetHealth, FAILURE_THRESHOLD_DEFAULT, CIRCUIT_BACKOFF_DEFAULT, \
+    CIRCUIT_BACKOFF_MAX_DEFAULT, STALE_TTL_DEFAULT
+from hadoop_exporter.store import ColumnarMetricFamily, LabelSet
+from hadoop_exporter.plans import PlanCache, SeriesTemplate, Shape, get_plan_key
+from hadoop_exporter.instrumentation import CollectorStats, STAGE_CONVERT, STAGE_EXPOSE, STAGE_FETCH, get_error_type
 
 EXPORTER_METRICS_DIR = os.environ.get('EXPORTER_METRICS_DIR', 'metrics')
+MAX_IN_FLIGHT_DEFAULT = 16
+SCRAPE_DEADLINE_DEFAULT = 25
+MAX_QUERIES_DEFAULT = 4
+REJECTED_VALUES_SIZE = 4096
+
+
+class Series(LabelSet):
+    '''
+    Metadata of a series resolved from a bean attribute, reused while the bean is scraped.
+    It is also the label set referenced by the samples of the series.
+    A series beyond a series budget has an overflow: DROPPED, or the series its values are aggregated into.
+    '''
+    __slots__ = ("group_pattern", "identifier", "name", "docs", "label_names", "rule", "overflow")
+
+    def __init__(self, group_pattern: str, identifier: str, name: str, docs: str,
+                 label_names: List[str], label_values: List[str], rule):
+        super().__init__(label_values)
+        self.group_pattern = group_pattern
+        self.identifier = identifier
+        self.name = name
+        self.docs = docs
+        self.label_names = tuple(label_names)
+        self.rule = rule
+        self.overflow = None
+
+
+class LabelSource(object):
+    '''
+    A common label of the series of a target, read from an attribute of one of its beans.
+    '''
+    __slots__ = ("name", "bean_pattern", "bean_regex", "attribute", "value_regex")
+
+    def __init__(self, name: str, bean_pattern: str, attribute: str, value_regex: Optional[str] = None):
+        '''
+        @param name: Label name, e.g. host.
+        @param bean_pattern: Regex matching the name of the bean, e.g. Hadoop:service=NameNode,name=JvmMetrics
+        @param attribute: Attribute of the bean holding the label value, e.g. tag.Hostname
+        @param value_regex: Regex extracting the label value from the attribute as its first group.
+        '''
+        self.name = name
+        self.bean_pattern = bean_pattern
+        self.bean_regex = re.compile(bean_pattern)
+        self.attribute = attribute
+        self.value_regex = re.compile(value_regex) if value_regex else None
+
+    def get_value(self, bean: Dict) -> Optional[str]:
+        value = bean.get(self.attribute)
+        if value is None:
+            return None
+        if self.value_regex is None:
+            return str(value)
+        matched = self.value_regex.match(str(value))
+        return matched.group(1) if matched else None
 
 
 class MetricCollector(object):
@@ -17,14 +88,61 @@ class MetricCollector(object):
     MetricCollector is a super class of all kinds of MetricsColleter classes. It setup common params like cluster, url, component and service.
     '''
     NON_METRIC_NAMES = ["name", "modelerType", "Name", "ObjectName"]
+    # common labels of every series of a target after cluster, their beans are fetched even if no rule matches them
+    LABEL_SOURCES: List[LabelSource] = []
+    # common labels added by the extra_labels option, beside jmx_port
+    EXTRA_LABEL_SOURCES: Dict[str, LabelSource] = {}
 
-    def __init__(self, cluster: str, urls: Union[str, List[str]], component: str, service: str, logger: Logger = None):
+    def __init__(self, cluster: str, urls: Union[str, List[str]], component: str, service: str, logger: Logger = None,
+                 max_in_flight: int = MAX_IN_FLIGHT_DEFAULT, scrape_deadline: float = SCRAPE_DEADLINE_DEFAULT,
+                 timeout: float = utils.HTTP_TIMEOUT_DEFAULT, pool_size: int = utils.HTTP_POOL_SIZE_DEFAULT,
+                 keep_alive: bool = True, retries: int = 0, backoff_factor: float = 0,
+                 bean_query: bool = True, max_queries: int = MAX_QUERIES_DEFAULT, stream: bool = False,
+                 profile_rules: bool = False, failure_threshold: int = FAILURE_THRESHOLD_DEFAULT,
+                 circuit_backoff: float = CIRCUIT_BACKOFF_DEFAULT, circuit_backoff_max: float = CIRCUIT_BACKOFF_MAX_DEFAULT,
+                 stale_ttl: float = STALE_TTL_DEFAULT, min_interval: float = 0,
+                 discover_from: Optional[Union[str, List[str]]] = None,
+                 discovery_interval: float = DISCOVERY_INTERVAL_DEFAULT, max_series: int = MAX_SERIES_DEFAULT,
+                 extra_labels: Optional[Union[str, List[str]]] = None, rollups: bool = True,
+                 replicas: Optional[ReplicaSet] = None):
         '''
         @param cluster: Cluster name, registered in the config file or ran in the command-line.
         @param urls: List of JMX url of each unique serivce corresponding to each component 
                     e.g. hdfs namenode metrics can be scraped in list: [http://namenode1:9870/jmx. http://namenode2:9870/jmx]
         @param component: Component name. e.g. "hdfs", "yarn"
         @param service: Service name. e.g. "namenode", "datanode", "resourcemanager", "nodemanager"
+        @param max_in_flight: Maximum number of JMX urls fetched concurrently.
+        @param scrape_deadline: Total time (seconds) to wait for all JMX urls of a scrape. Urls not fetched in time are skipped,
+                                the connect and read timeouts of their requests are bounded by the time left, so they
+                                release their worker at the deadline, later only by the download of a body still
+                                arriving or the retries of a request.
+        @param timeout: Timeout (seconds) of each JMX request.
+        @param pool_size: Max number of connections kept alive per JMX host.
+        @param keep_alive: Reuse connections between scrapes.
+        @param retries: Number of retries on connection errors and 5xx responses.
+        @param backoff_factor: Backoff factor (seconds) between retries.
+        @param bean_query: Fetch only beans matched by rules, using jmx qry parameter derived from group patterns.
+        @param max_queries: Max qry requests per url on every scrape, queries are merged by JMX domain to stay below it,
+                    all beans are fetched in one request if more are still needed. Queries of groups with a refresh
+                    are fetched apart and don't count.
+        @param stream: Parse jmx responses incrementally, beans matched by no rule are skipped without being decoded.
+                    It saves memory on very large responses, but is slower than loading the whole document.
+        @param profile_rules: Measure the cpu time spent in each rule, exposed by hadoop_exporter_rule_cpu_seconds_total.
+        @param failure_threshold: Consecutive failures of an url before it is skipped, 0 to never skip urls.
+        @param circuit_backoff: Seconds a failing url is skipped, doubled on each failed retry.
+        @param circuit_backoff_max: Max seconds a failing url is skipped.
+        @param stale_ttl: Seconds the last good values of a skipped or failing url are served, 0 to drop them.
+        @param min_interval: Min seconds between two scrapes of the jmx services, collect returns the last metrics before.
+        @param discover_from: Jmx urls of the service listing the urls of this service, e.g. namenodes for datanodes.
+                    Discovered urls are scraped beside urls.
+        @param discovery_interval: Seconds between two discoveries of the urls.
+        @param max_series: Max series exported by the collector, 0 for no limit. Rules can also define their own
+                    max_series in metrics/*.yaml. New series beyond a budget are dropped or aggregated.
+        @param extra_labels: Common labels added to every series of a target, e.g. jmx_port, or hastate of namenodes
+                    and resourcemanagers.
+        @param rollups: Compute the rollups of metrics/<service>.yaml, disabled in shard workers which convert only
+                    a part of the urls of the service.
+        @param replicas: Exporter replicas sharing the config, only the urls owned by this replica are scraped.
         '''
 
         self._logger = logger or utils.get_logger()
@@ -32,115 +150,772 @@ class MetricCollector(object):
         self._component = component
         self._service = service
         self._urls = list(map(lambda url: url.rstrip('/'), urls.split(",") if isinstance(urls, str) else urls))
+        self._static_urls = list(self._urls)
+        self._discovery = TargetDiscovery(service, discover_from, discovery_interval, timeout) if discover_from else None
+        self._discovered_urls = None
+        self._replicas = replicas
+        self._replica_version = None
+        if replicas is not None:
+            self._replica_version = replicas.get_version()
+            self._urls = replicas.select(cluster, service, self._urls)
         self._prefix = f"hadoop_{component}_{service}"
 
-        cfg = utils.read_yaml_file(os.path.join(EXPORTER_METRICS_DIR, f"{service}.yaml"))
-        common_cfg = utils.read_yaml_file(os.path.join(EXPORTER_METRICS_DIR, 'common.yaml'))
-
-        self._rules = cfg.get("rules", {}) if cfg is not None else {}
-        if common_cfg is not None:
-            self._rules.update(common_cfg.get("rules", {}))
-        self._lower_name = cfg.get("lowercaseOutputName", True)
-        self._lower_label = cfg.get("lowercaseOutputLabel", True)
-        self._common_labels = {}
-        self._first_get_common_labels = {}
-        for url in self._urls:
-            self._first_get_common_labels[url] = True
+        self._rule_registry = get_rule_registry(EXPORTER_METRICS_DIR)
+        self._bean_query = bean_query
+        self._max_queries = max_queries
+        # url -> common label names and values of the last scrape
+        self._common_labels: Dict[str, Dict[str, List[str]]] = {}
+        self._extra_labels = []
+        for name in (extra_labels.split(",") if isinstance(extra_labels, str) else extra_labels or []):
+            if name.strip() == "jmx_port" or name.strip() in self.EXTRA_LABEL_SOURCES:
+                self._extra_labels.append(name.strip())
+            else:
+                self._logger.warning("Unknown extra label {} of {}, only {}".format(
+                    name, service, ", ".join(["jmx_port"] + list(self.EXTRA_LABEL_SOURCES))))
+        self._label_sources = list(self.LABEL_SOURCES) + [
+            self.EXTRA_LABEL_SOURCES[name] for name in self._extra_labels if name in self.EXTRA_LABEL_SOURCES]
+        self._label_bean_regex = re.compile("|".join(
+            "(?:{})".format(source.bean_pattern) for source in self._label_sources)) if self._label_sources else None
+        # url -> bean pattern -> position of the bean in the beans of the last scrape
+        self._label_bean_positions: Dict[str, Dict[str, int]] = {}
         self._metrics = {}
+        # url -> (bean name, attribute) -> series resolved on the last scrape
+        self._series: Dict[str, Dict[Tuple[str, str], Tuple[Series, ...]]] = {}
+        self._scrape_deadline = scrape_deadline
+        self._max_in_flight = max(1, max_in_flight)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(1, max_in_flight if self._discovery or self._replicas
+                            else min(max_in_flight, len(self._urls))),
+            thread_name_prefix=f"{self._prefix}_fetcher")
+        self._timeout = timeout
+        self._session_options = dict(pool_size=pool_size, keep_alive=keep_alive, retries=retries,
+                                     backoff_factor=backoff_factor)
+        self._pool_connections = max(1, len(self._urls))
+        self._session = utils.get_session(pool_connections=self._pool_connections, **self._session_options)
+        # (event loop, client) used by collect_async, created in the loop running it
+        self._async_client: Optional[Tuple[asyncio.AbstractEventLoop, AsyncJmxClient]] = None
+        self._last_success: Dict[str, Optional[float]] = {url: None for url in self._urls}
+        self._health_options = (failure_threshold, circuit_backoff, circuit_backoff_max)
+        self._health = {url: TargetHealth(*self._health_options) for url in self._urls}
+        self._stale_ttl = stale_ttl
+        # url -> (unix timestamp, series, values) of the samples of its last successful scrape
+        self._last_good: Dict[str, Tuple[float, List[Series], array]] = {}
+        self._min_interval = min_interval
+        self._max_series = max_series
+        self._rollups = rollups
+        self._last_collect = None
+        self._last_families = []
+        self._query_unsupported = set()
+        self._service_rules = None
+        self._load_rules()
+        self._stream = stream
+        self._rejected_values = set()
+        self._stats = CollectorStats(cluster, service, self._urls, profile_rules)
+
+
+    def _load_rules(self):
+        '''
+        take the shared compiled rules of the service, again if they were reloaded since the last scrape.
+        '''
+        service_rules = self._rule_registry.get(self._service)
+        if service_rules is self._service_rules:
+            return
+        self._service_rules = service_rules
+        self._rule_set = service_rules.rule_set
+        self._lower_name = service_rules.lower_name
+        self._lower_label = service_rules.lower_label
+        self._series = {}
+        # url -> bean shape -> (attribute name, series) of the attributes matched by a rule
+        self._url_plans: Dict[str, Dict[Shape, Tuple[Tuple[str, Tuple[Series, ...]], ...]]] = {}
+        # extraction plans shared by all urls, by bean shape
+        self._plans = PlanCache()
+        self._last_good = {}
+        # only with series budgets. url -> (group pattern, identifier) -> series aggregating overflowing series
+        self._limiter = SeriesLimiter(self._max_series) \
+            if self._max_series > 0 or self._rule_set.has_series_budgets() else None
+        self._overflow_series: Dict[str, Dict[Tuple[str, str], Series]] = {}
+        # url -> query -> (unix timestamp, beans) of the queries of groups with a refresh policy
+        self._bean_cache: Dict[str, Dict[str, Tuple[float, List[Dict]]]] = {}
+        # list of (jmx qry, seconds between two fetches of the query, 0 for every scrape)
+        self._queries = self._rule_set.get_refresh_queries(
+            list(dict.fromkeys(source.bean_pattern for source in self._label_sources)),
+            self._max_queries) if self._bean_query else None
 
 
     def collect(self):
-        for group_pattern in self._rules:
-            self._metrics[group_pattern] = {}
+        if self._scraped_recently():
+            for metric in self._last_families:
+                yield metric
+            return
+        self._last_collect = time.monotonic()
+        self._load_rules()
+        self._discover()
+        families = self._build_families(self._fetch_all())
+
+        # time spent by the caller to expose the metrics between two yields, e.g. generate_latest
+        started = time.perf_counter()
+        for metric in families:
+            yield metric
+        self._stats.observe_stage(STAGE_EXPOSE, time.perf_counter() - started)
+
+
+    async def collect_async(self) -> List[ColumnarMetricFamily]:
+        '''
+        same as collect, but the jmx urls are fetched concurrently by a non-blocking client in the running event loop,
+        so one loop can scrape many services without a thread per request.
+        @return the metric families.
+        '''
+        if self._scraped_recently():
+            return self._last_families
+        self._last_collect = time.monotonic()
+        self._load_rules()
+        if self._discovery is not None:
+            # discovery sends blocking requests, it's refreshed in a thread then read from its cache
+            await asyncio.get_event_loop().run_in_executor(None, self._discovery.get_urls)
+        self._discover()
+        return self._build_families(await self._fetch_all_async())
+
+
+    def _scraped_recently(self) -> bool:
+        return bool(self._min_interval) and self._last_collect is not None \
+            and time.monotonic() - self._last_collect < self._min_interval
+
+
+    def _build_families(self, fetched: Dict[str, List[Dict]]) -> List[ColumnarMetricFamily]:
+        '''
+        convert the fetched beans, and the last good values of the urls not fetched, to metric families.
+        '''
+        self._metrics = {group.pattern: {} for group in self._rule_set}
+        started = time.perf_counter()
+        # convert in the configured url order whatever the order beans arrived
         for url in self._urls:
-            try:
-                beans = utils.get_metrics(url)
-            except:
-                self._logger.info(
-                    "Can't scrape metrics from url: {0}".format(url))
-                pass
+            if url not in fetched:
+                self._serve_stale(url)
+                continue
+            self._resolve_common_labels(fetched[url], url)
+            self._convert_metrics(fetched[url], url)
+        if self._limiter is not None:
+            self._readmit_overflow()
+        families = [metric for group_metrics in self._metrics.values() for metric in group_metrics.values()]
+        if self._rollups:
+            families = self._service_rules.rollups.apply(families)
+        self._stats.observe_stage(STAGE_CONVERT, time.perf_counter() - started)
+
+        if self._min_interval:
+            self._last_families = families
+        return families
+
+
+    def _discover(self):
+        '''
+        scrape the discovered urls beside the configured ones, urls which disappeared are dropped with their state.
+        with replicas, only the urls owned by this replica are scraped, selected again when peers change.
+        '''
+        if self._discovery is None and self._replicas is None:
+            return
+        discovered_urls = self._discovery.get_urls() if self._discovery is not None else None
+        if discovered_urls is None:
+            discovered_urls = self._discovered_urls
+        replica_version = self._replicas.get_version() if self._replicas is not None else None
+        if discovered_urls is self._discovered_urls and replica_version == self._replica_version:
+            return
+        self._discovered_urls = discovered_urls
+        self._replica_version = replica_version
+        urls = list(dict.fromkeys(self._static_urls + (discovered_urls or [])))
+        if self._replicas is not None:
+            urls = self._replicas.select(self._cluster, self._service, urls)
+        self._set_urls(urls)
+
+
+    def _set_urls(self, urls: List[str]):
+        kept = set(urls)
+        for url in self._urls:
+            if url in kept:
+                continue
+            self._forget_series(url)
+            for state in (self._common_labels, self._label_bean_positions, self._last_success, self._health,
+                          self._last_good, self._bean_cache):
+                state.pop(url, None)
+            self._query_unsupported.discard(url)
+            if self._async_client is not None:
+                self._async_client[1].close_host(url)
+        for url in urls:
+            if url not in self._health:
+                self._last_success[url] = None
+                self._health[url] = TargetHealth(*self._health_options)
+        self._urls = urls
+        self._stats.set_urls(urls)
+        if len(urls) > self._pool_connections:
+            # keep a connection pool per host
+            self._pool_connections = len(urls)
+            self._session.close()
+            self._session = utils.get_session(pool_connections=self._pool_connections, **self._session_options)
+
+
+    def _fetch_all(self) -> Dict[str, List[Dict]]:
+        '''
+        fetch beans of all urls in parallel, bounded by max_in_flight and scrape_deadline.
+        @return a dict of url to its beans, only contains urls fetched successfully before the deadline.
+        '''
+        started = time.perf_counter()
+        deadline = time.monotonic() + self._scrape_deadline
+        futures = {self._executor.submit(self._fetch, url, deadline): url for url in self._allowed_urls()}
+        done, not_done = wait(futures, timeout=self._scrape_deadline)
+        fetched = {}
+        for future in done:
+            self._fetch_completed(futures[future], future, fetched)
+        for future in not_done:
+            future.cancel()
+            self._fetch_expired(futures[future])
+        self._observe_circuits(started)
+        return fetched
+
+
+    async def _fetch_all_async(self) -> Dict[str, List[Dict]]:
+        '''
+        same as _fetch_all, urls are fetched by tasks of the running event loop.
+        '''
+        started = time.perf_counter()
+        loop = asyncio.get_event_loop()
+        if self._async_client is None or self._async_client[0] is not loop:
+            self._async_client = (loop, AsyncJmxClient(
+                self._session_options["pool_size"], self._timeout, self._session_options["keep_alive"],
+                self._session_options["retries"], self._session_options["backoff_factor"]))
+        in_flight = asyncio.Semaphore(self._max_in_flight)
+        tasks = {asyncio.ensure_future(self._fetch_async(url, in_flight)): url for url in self._allowed_urls()}
+        done, not_done = await asyncio.wait(tasks, timeout=self._scrape_deadline) if tasks else (set(), set())
+        fetched = {}
+        for task in done:
+            self._fetch_completed(tasks[task], task, fetched)
+        for task in not_done:
+            task.cancel()
+            self._fetch_expired(tasks[task])
+        self._observe_circuits(started)
+        return fetched
+
+
+    def _allowed_urls(self) -> List[str]:
+        '''
+        urls to fetch, urls with an open circuit are skipped, their last good values are served instead.
+        '''
+        now = time.time()
+        return [url for url in self._urls if self._health[url].allow(now)]
+
+
+    def _fetch_completed(self, url: str, future, fetched: Dict[str, List[Dict]]):
+        '''
+        account the result of a fetch, a concurrent or an asyncio future, and add its beans to fetched if it succeeded.
+        '''
+        try:
+            fetched[url], fetch_stats = future.result()
+        except Exception as e:
+            error_type = get_error_type(e)
+            self._stats.observe_fetch_error(url, error_type)
+            self._logger.info(
+                "Can't scrape metrics from url: {0}, {1} error: {2}".format(url, error_type, e))
+            self._fetch_failed(url)
+        else:
+            self._stats.observe_fetch(url, fetch_stats, len(fetched[url]))
+            if self._health[url].success():
+                self._logger.info("{0} recovered, it is scraped again".format(url))
+            if fetched[url]:
+                self._last_success[url] = time.time()
             else:
-                if self._first_get_common_labels[url]:
-                    self._common_labels[url] = {"names": [], "values": []} 
-                    self._get_common_labels(beans, url)
-            self._convert_metrics(beans, url)
+                self._logger.warning("no metrics get in the {0}.".format(url))
 
-        for group_metrics in self._metrics.values():
-            for metric in group_metrics.values():
-                yield metric
+
+    def _fetch_expired(self, url: str):
+        self._stats.observe_fetch_error(url, "deadline")
+        self._logger.info("Scrape deadline {0}s exceeded, skip url: {1}".format(self._scrape_deadline, url))
+        self._fetch_failed(url)
+
+
+    def _observe_circuits(self, started: float):
+        now = time.time()
+        for url in self._urls:
+            self._stats.observe_circuit(url, self._health[url].is_open(now))
+        self._stats.observe_stage(STAGE_FETCH, time.perf_counter() - started)
 
 
-    def _get_common_labels(self, beans: List[Dict], url: str):
-        self._first_get_common_labels[url] = False
-        self._common_labels[url]["names"].append("cluster")
-        self._common_labels[url]["values"].append(self._cluster)
+    def _fetch_failed(self, url: str):
+        health = self._health[url]
+        delay = health.failure(time.time())
+        if delay is not None:
+            self._logger.warning("{0} failed {1} times in a row, skip it for {2:g}s".format(url, health.failures, delay))
+
+
+    def _fetch(self, url: str, deadline: Optional[float] = None) -> Tuple[List[Dict], utils.FetchStats]:
+        '''
+        fetch beans of an url, only beans matched by rules if jmx qry can be used, else all beans.
+        beans of queries with a refresh are taken from the cache of the url until they expire.
+        @param deadline: time.monotonic() of the scrape deadline, requests don't wait beyond it.
+        @return a tuple of (beans, stats of the fetch).
+        @raise an exception if the url can't be fetched.
+        '''
+        fetch_stats = utils.FetchStats()
+        if self._queries is None or url in self._query_unsupported:
+            return self._fetch_beans(url, fetch_stats, deadline=deadline), fetch_stats
+        cache = self._bean_cache.setdefault(url, {})
+        try:
+            results, now = [], time.time()
+            for query, refresh in self._queries:
+                query_beans = self._get_cached_beans(cache, query, refresh, now)
+                if query_beans is None:
+                    query_beans = self._drop_slower_beans(
+                        self._fetch_beans(url, fetch_stats, {"qry": query}, deadline), refresh)
+                    if refresh > 0:
+                        cache[query] = (now, query_beans)
+                results.append(query_beans)
+            return self._merge_beans(results), fetch_stats
+        except (requests.HTTPError, ValueError) as e:
+            self._query_failed(url, e)
+        return self._fetch_beans(url, fetch_stats, deadline=deadline), fetch_stats
+
+
+    async def _fetch_async(self, url: str, in_flight: asyncio.Semaphore) -> Tuple[List[Dict], utils.FetchStats]:
+        '''
+        same as _fetch, with the non-blocking client.
+        @param in_flight: Bounds the urls fetched concurrently by max_in_flight.
+        '''
+        async with in_flight:
+            fetch_stats = utils.FetchStats()
+            if self._queries is None or url in self._query_unsupported:
+                return await self._fetch_beans_async(url, fetch_stats), fetch_stats
+            cache = self._bean_cache.setdefault(url, {})
+            try:
+                results, now = [], time.time()
+                for query, refresh in self._queries:
+                    query_beans = self._get_cached_beans(cache, query, refresh, now)
+                    if query_beans is None:
+                        query_beans = self._drop_slower_beans(
+                            await self._fetch_beans_async(url, fetch_stats, {"qry": query}), refresh)
+                        if refresh > 0:
+                            cache[query] = (now, query_beans)
+                    results.append(query_beans)
+                return self._merge_beans(results), fetch_stats
+            except (requests.HTTPError, ValueError) as e:
+                self._query_failed(url, e)
+            return await self._fetch_beans_async(url, fetch_stats), fetch_stats
+
+
+    def _get_cached_beans(self, cache: Dict[str, Tuple[float, List[Dict]]], query: str, refresh: float,
+                          now: float) -> Optional[List[Dict]]:
+        '''
+        @return the cached beans of a query if they were fetched less than refresh seconds ago, else None.
+        '''
+        cached = cache.get(query)
+        if cached is not None and now - cached[0] < refresh:
+            return cached[1]
+        return None
+
+
+    def _drop_slower_beans(self, beans: List[Dict], refresh: float) -> List[Dict]:
+        '''
+        drop the beans of groups with a longer refresh than the query which fetched them, e.g. the beans of a slow group
+        covered by a merged query, they are taken from the cache of their own query.
+        '''
+        if refresh >= self._queries[-1][1]:
+            return beans
+        label_regex = self._label_bean_regex
+        return [bean for bean in beans if self._rule_set.get_refresh(bean.get("name", "")) <= refresh
+                or (label_regex is not None and label_regex.match(bean.get("name", "")))]
+
+
+    def _merge_beans(self, results: List[List[Dict]]) -> List[Dict]:
+        '''
+        beans of all queries, a bean matched by several queries is kept once.
+        '''
+        beans, names = [], set()
+        for query_beans in results:
+            for bean in query_beans:
+                if bean.get("name") not in names:
+                    names.add(bean.get("name"))
+                    beans.append(bean)
+        return beans
+
+
+    def _query_failed(self, url: str, error: Exception):
+        # the jmx service is up but doesn't support the queries
+        self._logger.warning("Error when fetch {0} with qry, fetch all beans instead: {1}".format(url, error))
+        self._query_unsupported.add(url)
+        self._bean_cache.get(url, {}).clear()
+
+
+    def _fetch_beans(self, url: str, fetch_stats: utils.FetchStats, params: Optional[Dict] = None,
+                     deadline: Optional[float] = None) -> List[Dict]:
+        return utils.fetch_beans(url, self._session, self._get_timeout(deadline), params=params,
+                                 accept=self._accept_bean, stream=self._stream, stats=fetch_stats)
+
+
+    def _get_timeout(self, deadline: Optional[float]) -> float:
+        '''
+        the timeout of a request, bounded by the time left before the scrape deadline: a fetch can't be cancelled
+        once started, a worker waiting beyond the deadline would delay the urls of the next scrape.
+        @raise requests.Timeout if the deadline is exceeded, the url was skipped by the scrape.
+        '''
+        if deadline is None:
+            return self._timeout
+        left = deadline - time.monotonic()
+        if left <= 0:
+            raise requests.Timeout("Scrape deadline exceeded")
+        return min(self._timeout, left)
+
+
+    async def _fetch_beans_async(self, url: str, fetch_stats: utils.FetchStats,
+                                 params: Optional[Dict] = None) -> List[Dict]:
+        return await fetch_beans_async(self._async_client[1], url, params=params,
+                                       accept=self._accept_bean, stream=self._stream, stats=fetch_stats)
+
+
+    def _accept_bean(self, name: str) -> bool:
+        '''
+        whether a bean must be fetched: matched by a rule group or used to resolve common labels.
+        '''
+        if self._rule_set.match(name):
+            return True
+        return self._label_bean_regex is not None and self._label_bean_regex.match(name) is not None
+
+
+    def get_last_success(self) -> Dict[str, Optional[float]]:
+        '''
+        @return a dict of url to the unix timestamp of its last successful fetch, None if never succeeded.
+        '''
+        return dict(self._last_success)
+
+
+    def _resolve_common_labels(self, beans: List[Dict], url: str):
+        '''
+        resolve the common labels of an url on each scrape, its series are resolved again if they changed,
+        e.g. after a failover changing the hastate label.
+        '''
+        names, values = self._get_common_labels(beans, url)
+        labels = self._common_labels.get(url)
+        if labels is not None and labels["names"] == names and labels["values"] == values:
+            return
+        if labels is not None:
+            self._logger.info("Common labels of {0} changed to {1}".format(url, dict(zip(names, values))))
+        self._common_labels[url] = {"names": names, "values": values}
+        self._forget_series(url)
+
+
+    def _get_common_labels(self, beans: List[Dict], url: str) -> Tuple[List[str], List[str]]:
+        '''
+        @return a tuple of (label names, label values) common to all series of the url. A label whose bean is missing
+                keeps its last value, e.g. in a partial response.
+        '''
+        names, values = ["cluster"], [self._cluster]
+        previous = self._common_labels.get(url)
+        for source in self._label_sources:
+            bean = self._find_label_bean(beans, url, source)
+            value = source.get_value(bean) if bean is not None else None
+            if value is None and previous is not None and source.name in previous["names"]:
+                value = previous["values"][previous["names"].index(source.name)]
+            if value is not None:
+                names.append(source.name)
+                values.append(value)
+        if "jmx_port" in self._extra_labels:
+            names.append("jmx_port")
+            values.append(str(urlparse(url).port or ""))
+        return names, values
+
+
+    def _find_label_bean(self, beans: List[Dict], url: str, source: LabelSource) -> Optional[Dict]:
+        '''
+        find the bean of a label source at its position in the last scrape, beans are scanned only if it moved.
+        '''
+        positions = self._label_bean_positions.setdefault(url, {})
+        position = positions.get(source.bean_pattern)
+        if position is not None and position < len(beans) and source.bean_regex.match(beans[position]["name"]):
+            return beans[position]
+        for position, bean in enumerate(beans):
+            if source.bean_regex.match(bean["name"]):
+                positions[source.bean_pattern] = position
+                return bean
+        return None
 
 
     def _convert_metrics(self, beans: List[Dict], url: str):
-        # loop for each group metric
+        '''
+        add a sample for each bean attribute matched by a rule. each bean is converted by the plan of its shape,
+        the series of the url bound to the plan on a previous scrape are reused. only new shapes go through the regex
+        substitution, once for all urls. series of disappeared beans are evicted.
+        '''
+        started = time.perf_counter()
+        cached_series = self._series.setdefault(url, {})
+        url_plans = self._url_plans.setdefault(url, {})
+        scraped_shapes = []
+        rule_matches: Dict[str, int] = {}
+        # cpu time and evaluations by (group pattern, rule pattern), only with profile_rules
+        profile = (defaultdict(float), defaultdict(int)) if self._stats.profile_rules else None
+        # samples kept to be served while the url is skipped or failing
+        kept_series, kept_values = ([], array('d')) if self._stale_ttl > 0 else (None, None)
+        # overflowing samples by overflow key, values of the series aggregating overflowing series
+        overflow_samples: Dict[Tuple[str, str, str], int] = defaultdict(int)
+        aggregated: Dict[Series, float] = {}
         for bean in beans:
-            for group_pattern in self._rules:
-                if not re.compile(group_pattern).match(bean["name"]):
-                    continue
-                for metric_name, metric_value in bean.items():
-                    if metric_name in self.NON_METRIC_NAMES:
+            bean_name = bean["name"]
+            if not self._rule_set.match(bean_name):
+                continue
+            shape = (bean_name, tuple(bean))
+            entries = url_plans.get(shape)
+            if entries is None:
+                entries = url_plans[shape] = self._bind_plan(shape, bean, url, cached_series, profile)
+            scraped_shapes.append(shape)
+            for metric_name, series_list in entries:
+                metric_value = bean[metric_name]
+                for series in series_list:
+                    group_metrics = self._metrics[series.group_pattern]
+                    metric = group_metrics.get(series.identifier)
+                    if metric is None:
+                        metric = group_metrics[series.identifier] = ColumnarMetricFamily(
+                            series.name, series.docs, series.label_names)
+                    if profile is not None:
+                        resolve_started = time.thread_time()
+                    try:
+                        resolved_value = series.rule.resolve(metric_value)
+                    except:
+                        resolved_value = None
+                    if profile is not None:
+                        profile_key = (series.group_pattern, series.rule.definition["pattern"])
+                        profile[0][profile_key] += time.thread_time() - resolve_started
+                        profile[1][profile_key] += 1
+                    if resolved_value is None:
+                        self._reject_value(bean_name, metric_name, metric_value, url)
                         continue
-                    # loop for each metric defined in each group
-                    for metric_def in self._rules[group_pattern]:
-                        if metric_def["type"] != "GAUSE":
-                            self._logger.warning(
-                                "Metric type {} not supported currently".format(metric_def["type"]))
-                            continue
-                        if re.compile(metric_def["pattern"]).match(metric_name):
-                            pattern = re.compile("{}<>{}".format(
-                                group_pattern.rstrip("$"), metric_def["pattern"].lstrip("^")))
-                            concat_str = "{}<>{}".format(bean["name"], metric_name)
-                            sub_name = pattern.sub(metric_def["name"].replace("$", "\\"), concat_str)
-                            sub_label_names = [label for label in metric_def["labels"].keys()] \
-                                if "labels" in metric_def else []
-                            metric_identifier = '_'.join([sub_name] + sorted(sub_label_names)).lower()
-                            if metric_identifier not in self._metrics[group_pattern]:
-                                name = "_".join([self._prefix, sub_name])
-                                if self._lower_name: name = name.lower()
-                                label_names = self._common_labels[url]["names"] + sub_label_names
-                                if self._lower_label: label_names = [l.lower() for l in label_names]
-                                docs = name if "help" not in metric_def \
-                                    else pattern.sub(metric_def["help"].replace("$", "\\"), concat_str)
-                                try:
-                                    metric = GaugeMetricFamily(name, docs, labels=label_names)
-                                except:
-                                    self._logger.warning("Error while create new metric")
-                                    traceback.print_exc()
-                                else:
-                                    self._metrics[group_pattern][metric_identifier] = metric
-
-                            if metric_identifier in self._metrics[group_pattern]:
-                                sub_label_values = [pattern.sub(label.replace("$", "\\"), concat_str)
-                                    for label in metric_def["labels"].values()] if "labels" in metric_def else []
-                                label_values = self._common_labels[url]["values"] + sub_label_values
-                                if self._lower_label: label_values = [l.lower() for l in label_values]
-                                try:
-                                    resolved_value = self._resolve_value(metric_value, metric_def.get("mapping", None))
-                                except:
-                                    self._logger.warn("Unparseble metric: {} - {} = {}".format(bean["name"], metric_name, metric_value))
-                                else:
-                                    self._metrics[group_pattern][metric_identifier].add_metric(label_values, resolved_value)
-                            break
-
-
-    def _resolve_value(self, value: Any, mapping: Optional[str]) -> Any:
-        if mapping:
-            import importlib
-            mod_name, func_name = mapping.rsplit('.',1)
-            mod = importlib.import_module(mod_name)
-            func = getattr(mod, func_name)
-            return func(value)
-        return value
-
-
-    def _find_bean(self, beans: List[Dict], group_pattern: str) -> Optional[Dict]:
-        regex = re.compile(group_pattern)
-        for bean in beans:
-            if regex.match(bean["name"]):
-                return bean
-        return None
+                    if series.overflow is not None:
+                        overflow_samples[self._limiter.get_overflow_key(series)] += 1
+                        if series.overflow is not DROPPED:
+                            aggregated[series.overflow] = aggregated.get(series.overflow, 0.0) + resolved_value
+                        continue
+                    metric.add(series, resolved_value)
+                    if kept_series is not None:
+                        kept_series.append(series)
+                        kept_values.append(resolved_value)
+                    rule_matches[series.group_pattern] = rule_matches.get(series.group_pattern, 0) + 1
+        for series, value in aggregated.items():
+            group_metrics = self._metrics[series.group_pattern]
+            metric = group_metrics.get(series.identifier)
+            if metric is None:
+                metric = group_metrics[series.identifier] = ColumnarMetricFamily(
+                    series.name, series.docs, series.label_names)
+            metric.add(series, value)
+            if kept_series is not None:
+                kept_series.append(series)
+                kept_values.append(value)
+            rule_matches[series.group_pattern] = rule_matches.get(series.group_pattern, 0) + 1
+        if len(scraped_shapes) != len(url_plans):
+            self._evict_series(url, scraped_shapes)
+        if self._limiter is not None:
+            self._stats.observe_overflow(self._limiter.overflow, overflow_samples)
+        if kept_series is not None:
+            self._last_good[url] = (time.time(), kept_series, kept_values)
+        self._stats.observe_stale(url, False)
+        self._stats.observe_convert(url, time.perf_counter() - started, sum(rule_matches.values()), rule_matches)
+        if profile is not None:
+            self._stats.observe_rules(*profile)
+
+
+    def _forget_series(self, url: str):
+        '''
+        drop the cached series of an url, they are resolved again on its next scrape.
+        '''
+        cached_series = self._series.pop(url, None)
+        self._url_plans.pop(url, None)
+        self._overflow_series.pop(url, None)
+        if self._limiter is not None and cached_series:
+            for series_list in cached_series.values():
+                for series in series_list:
+                    self._limiter.release(series)
+
+
+    def _evict_series(self, url: str, scraped_shapes: List[Shape]):
+        '''
+        drop the plans of the shapes of an url which were not scraped, and the series of attributes they don't have anymore.
+        '''
+        url_plans = self._url_plans[url]
+        cached_series = self._series[url]
+        scraped_shapes = set(scraped_shapes)
+        for shape in [shape for shape in url_plans if shape not in scraped_shapes]:
+            del url_plans[shape]
+        scraped_keys = {(shape[0], metric_name) for shape, entries in url_plans.items() for metric_name, _ in entries}
+        for key in [key for key in cached_series if key not in scraped_keys]:
+            series_list = cached_series.pop(key)
+            if self._limiter is not None:
+                # series of disappeared bean attributes release their slot
+                for series in series_list:
+                    self._limiter.release(series)
+
+
+    def _readmit_overflow(self):
+        '''
+        after slots were released, drop the cached overflowing series so they take the free slots when resolved again.
+        '''
+        if not self._limiter.released:
+            return
+        self._limiter.released = False
+        for url, cached_series in self._series.items():
+            for key in [key for key, series_list in cached_series.items()
+                        if any(series.overflow is not None for series in series_list)]:
+                for series in cached_series.pop(key):
+                    self._limiter.release(series)
+                self._url_plans.pop(url, None)
+
+
+    def _overflow(self, series: Series, url: str):
+        '''
+        @return the overflow of a series beyond a budget: DROPPED, or the series of its metric with the labels of
+                its rule set to OVERFLOW_LABEL_VALUE if the overflow of the rule is aggregate.
+        '''
+        if series.rule.overflow != OVERFLOW_AGGREGATE:
+            return DROPPED
+        overflow_series = self._overflow_series.setdefault(url, {})
+        key = (series.group_pattern, series.identifier)
+        if key not in overflow_series:
+            common_values = len(self._common_labels[url]["values"])
+            overflow_series[key] = Series(
+                series.group_pattern, series.identifier, series.name, series.docs, series.label_names,
+                series.label_values[:common_values] + [OVERFLOW_LABEL_VALUE] * (len(series.label_values) - common_values),
+                series.rule)
+        return overflow_series[key]
+
+
+    def _serve_stale(self, url: str):
+        '''
+        add the last good samples of an url which is skipped or failed, until they are older than stale_ttl.
+        '''
+        last_good = self._last_good.get(url)
+        if last_good is not None and time.time() - last_good[0] > self._stale_ttl:
+            del self._last_good[url]
+            last_good = None
+        self._stats.observe_stale(url, last_good is not None)
+        if last_good is None:
+            return
+        _, series_list, values = last_good
+        for series, value in zip(series_list, values):
+            group_metrics = self._metrics[series.group_pattern]
+            metric = group_metrics.get(series.identifier)
+            if metric is None:
+                metric = group_metrics[series.identifier] = ColumnarMetricFamily(
+                    series.name, series.docs, series.label_names)
+            metric.add(series, value)
+
+
+    def _bind_plan(self, shape: Shape, bean: Dict, url: str, cached_series: Dict[Tuple[str, str], Tuple[Series, ...]],
+                   profile: Optional[Tuple[Dict, Dict]] = None) -> Tuple[Tuple[str, Tuple[Series, ...]], ...]:
+        '''
+        bind the plan of a bean shape to an url: the series of each attribute of the plan with the common labels of the url.
+        series already resolved for the bean attributes are reused, e.g. when an attribute is added to the bean.
+        the plan is compiled once for the shapes of all urls with the same plan key.
+        '''
+        plan_key = get_plan_key(self._rule_set.match(shape[0]), shape)
+        plan = self._plans.get(plan_key)
+        if plan is None:
+            plan = self._compile_plan(shape, bean, profile)
+            self._plans.put(plan_key, plan)
+        bean_name = shape[0]
+        entries = []
+        for metric_name, templates in plan:
+            key = (bean_name, metric_name)
+            series_list = cached_series.get(key)
+            if series_list is None:
+                series_list = cached_series[key] = tuple(
+                    series for series in (self._bind_series(template, url) for template in templates)
+                    if series is not None)
+            entries.append((metric_name, series_list))
+        return tuple(entries)
+
+
+    def _compile_plan(self, shape: Shape, bean: Dict, profile: Optional[Tuple[Dict, Dict]] = None):
+        '''
+        compile the extraction plan of a bean shape: the series templates of each attribute matched by a rule.
+        attributes whose value in the bean can't be exported without a mapping, e.g. strings or arrays, are left out
+        of the series of rules without mapping, once for all beans of the shape.
+        '''
+        bean_name, metric_names = shape
+        groups = self._rule_set.match(bean_name)
+        plan = []
+        for metric_name in metric_names:
+            if metric_name in self.NON_METRIC_NAMES:
+                continue
+            templates = self._compile_series(groups, bean_name, metric_name, profile)
+            value = bean[metric_name]
+            if value is not None and to_number(value) is None and \
+                    any(template.rule.mapping is None for template in templates):
+                self._logger.warning("Unparseble metric: {} - {} = {}, it is not exported".format(
+                    bean_name, metric_name, value))
+                templates = tuple(template for template in templates if template.rule.mapping is not None)
+            if templates:
+                plan.append((metric_name, templates))
+        return tuple(plan)
+
+
+    def _compile_series(self, groups: List, bean_name: str, metric_name: str,
+                        profile: Optional[Tuple[Dict, Dict]] = None) -> Tuple[SeriesTemplate, ...]:
+        '''
+        resolve the series templates of a bean attribute, one for each rule group matching the bean.
+        @param profile: dicts of cpu time and evaluations by (group pattern, rule pattern) to update, if profiling rules.
+        '''
+        templates = []
+        for group in groups:
+            if profile is not None:
+                started = time.thread_time()
+            # first metric defined in the group matching the attribute
+            rule = group.find_rule(metric_name)
+            if rule is not None:
+                sub_name, sub_label_values, sub_help = rule.substitute(bean_name, metric_name)
+            if profile is not None:
+                # the cost of attributes matched by no rule is accounted to the group
+                profile_key = (group.pattern, rule.definition["pattern"] if rule is not None else "")
+                profile[0][profile_key] += time.thread_time() - started
+                profile[1][profile_key] += 1
+            if rule is None:
+                continue
+            name = "_".join([self._prefix, sub_name])
+            if self._lower_name: name = name.lower()
+            label_names = rule.label_names
+            label_values = sub_label_values
+            if self._lower_label:
+                label_names = [l.lower() for l in label_names]
+                label_values = [l.lower() for l in label_values]
+            templates.append(SeriesTemplate(group.pattern, '_'.join([sub_name] + rule.sorted_label_names).lower(), name,
+                                            name if sub_help is None else sub_help, label_names, label_values, rule))
+        return tuple(templates)
+
+
+    def _bind_series(self, template: SeriesTemplate, url: str) -> Optional[Series]:
+        '''
+        @return the series of a template for an url, with its common labels. None if the series is invalid.
+        '''
+        label_names = self._common_labels[url]["names"]
+        label_values = self._common_labels[url]["values"]
+        if self._lower_label:
+            label_names = [l.lower() for l in label_names]
+            label_values = [l.lower() for l in label_values]
+        if template.common_label_names != label_names:
+            try:
+                ColumnarMetricFamily(template.name, "", label_names + template.label_names)
+            except:
+                self._logger.warning("Error while create new metric")
+                traceback.print_exc()
+                return None
+            template.common_label_names = label_names
+        label_names = label_names + template.label_names
+        label_values = label_values + template.label_values
+        series = Series(template.group_pattern, template.identifier, template.name, template.docs,
+                        label_names, label_values, template.rule)
+        if self._limiter is not None and not self._limiter.admit(series):
+            series.overflow = self._overflow(series, url)
+        return series
+
+
+    def _reject_value(self, bean_name: str, metric_name: str, metric_value: Any, url: str):
+        '''
+        log a value which can't be exported, e.g. a string without mapping, once per bean attribute.
+        '''
+        self._stats.observe_error(url, "value")
+        if (bean_name, metric_name) in self._rejected_values:
+            return
+        if len(self._rejected_values) >= REJECTED_VALUES_SIZE:
+            self._rejected_values.clear()
+        self._rejected_values.add((bean_name, metric_name))
+        self._logger.warning("Unparseble metric: {} - {} = {}".format(bean_name, metric_name, metric_value))
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import threading
+from typing import Callable, Dict, List, Optional, Union
+from urllib.parse import urlparse
+from hadoop_exporter import utils
+
+logger = utils.get_logger(__name__)
+
+DISCOVERY_INTERVAL_DEFAULT = 300
+# seconds before retrying a discovery which failed
+DISCOVERY_RETRY_INTERVAL = 30
+# datanodes in this admin state don't serve metrics anymore
+DATANODE_EXCLUDED_STATES = ("Decommissioned",)
+NODEMANAGER_STATES = ("NEW", "RUNNING", "UNHEALTHY", "DECOMMISSIONING")
+
+
+def parse_live_datanodes(bean: Dict, scheme: str) -> List[str]:
+    '''
+    jmx urls of the live datanodes listed by the LiveNodes attribute of the NameNodeInfo bean, e.g.
+        {"dn1:9866": {"infoAddr": "10.0.0.1:9864", "infoSecureAddr": "10.0.0.1:0", "adminState": "In Service", ...}}
+    datanodes are addressed by their hostname and their http (or https) info port.
+    '''
+    urls = []
+    for name, node in json.loads(bean.get("LiveNodes") or "{}").items():
+        if node.get("adminState") in DATANODE_EXCLUDED_STATES:
+            continue
+        address = node.get("infoSecureAddr" if scheme == "https" else "infoAddr") or ""
+        port = address.rsplit(":", 1)[-1]
+        if not port.isdigit() or port == "0":
+            continue
+        urls.append(f"{scheme}://{name.rsplit(':', 1)[0]}:{port}/jmx")
+    return sorted(urls)
+
+
+def parse_live_nodemanagers(bean: Dict, scheme: str) -> List[str]:
+    '''
+    jmx urls of the nodemanagers listed by the LiveNodeManagers attribute of the RMNMInfo bean, e.g.
+        [{"HostName": "nm1", "State": "RUNNING", "NodeHTTPAddress": "nm1:8042", ...}]
+    '''
+    urls = []
+    for node in json.loads(bean.get("LiveNodeManagers") or "[]"):
+        if node.get("State") not in NODEMANAGER_STATES or not node.get("NodeHTTPAddress"):
+            continue
+        urls.append(f"{scheme}://{node['NodeHTTPAddress']}/jmx")
+    return sorted(urls)
+
+
+class DiscoverySource(object):
+    '''
+    Where the urls of a service are discovered: the bean of another service listing them.
+    '''
+    __slots__ = ("service", "query", "parse")
+
+    def __init__(self, service: str, query: str, parse: Callable[[Dict, str], List[str]]):
+        '''
+        @param service: Name of the service publishing the bean, e.g. namenode.
+        @param query: ObjectName of the bean.
+        @param parse: Function returning the urls listed by the bean, given the scheme of the source url.
+        '''
+        self.service = service
+        self.query = query
+        self.parse = parse
+
+
+# discovered service -> its source
+DISCOVERY_SOURCES = {
+    "datanode": DiscoverySource("namenode", "Hadoop:service=NameNode,name=NameNodeInfo", parse_live_datanodes),
+    "nodemanager": DiscoverySource("resourcemanager", "Hadoop:service=ResourceManager,name=RMNMInfo",
+                                   parse_live_nodemanagers),
+}
+
+
+class TargetDiscovery(object):
+    '''
+    TargetDiscovery lists the urls of a service from the jmx of its source, e.g. datanodes from the namenodes.
+    The result is cached for interval seconds, so every scrape can ask for it. A failed or empty discovery
+    keeps the last discovered urls and is retried after DISCOVERY_RETRY_INTERVAL seconds.
+    '''
+
+    def __init__(self, service: str, source_urls: Union[str, List[str]],
+                 interval: float = DISCOVERY_INTERVAL_DEFAULT, timeout: float = utils.HTTP_TIMEOUT_DEFAULT):
+        '''
+        @param service: Name of the discovered service, datanode or nodemanager.
+        @param source_urls: Jmx urls of the source service, e.g. all namenodes of an HA cluster.
+        @param interval: Seconds between two discoveries.
+        @param timeout: Timeout (seconds) of each jmx request.
+        '''
+        if service not in DISCOVERY_SOURCES:
+            raise ValueError("Discovery of {} is not supported, only {}".format(
+                service, ", ".join(DISCOVERY_SOURCES)))
+        self.service = service
+        self._source = DISCOVERY_SOURCES[service]
+        self._source_urls = [url.rstrip("/") for url in (
+            source_urls.split(",") if isinstance(source_urls, str) else source_urls)]
+        self._interval = interval
+        self._timeout = timeout
+        self._session = utils.get_session(pool_connections=max(1, len(self._source_urls)), pool_size=1)
+        self._lock = threading.Lock()
+        self._urls: Optional[List[str]] = None
+        self._next_discovery = 0.0
+
+    def get_urls(self) -> Optional[List[str]]:
+        '''
+        @return the discovered urls, the same list until they change. None if never discovered.
+        '''
+        if time.monotonic() < self._next_discovery:
+            return self._urls
+        with self._lock:
+            now = time.monotonic()
+            if now < self._next_discovery:
+                return self._urls
+            urls = self._discover()
+            if not urls:
+                self._next_discovery = now + min(self._interval, DISCOVERY_RETRY_INTERVAL)
+                return self._urls
+            self._next_discovery = now + self._interval
+            if self._urls is None or set(urls) != set(self._urls):
+                previous = set(self._urls or [])
+                logger.info("Discovered {} {}s from {}: {} added, {} removed".format(
+                    len(urls), self.service, self._source.service,
+                    len(set(urls) - previous), len(previous - set(urls))))
+                self._urls = urls
+        return self._urls
+
+    def _discover(self) -> Optional[List[str]]:
+        '''
+        union of the urls listed by all source urls, e.g. active and standby namenodes.
+        @return None if no source url could be read.
+        '''
+        urls, succeeded = set(), False
+        for source_url in self._source_urls:
+            try:
+                beans = utils.fetch_beans(source_url, self._session, self._timeout, params={"qry": self._source.query})
+                for bean in beans:
+                    urls.update(self._source.parse(bean, urlparse(source_url).scheme or "http"))
+                succeeded = True
+            except Exception as e:
+                logger.warning("Can't discover {}s from {}: {}".format(self.service, source_url, e))
+        if not succeeded:
+            return None
+        if not urls:
+            logger.warning("No {} discovered from {}, keep the last discovered ones".format(
+                self.service, ", ".join(self._source_urls)))
+        return sorted(urls)
@@ -1,12 +1,22 @@
 import os
 import time
+import asyncio
+import signal
+import socket
 import traceback
 from typing import Callable, Dict, List, Optional, Union
 from prometheus_client.core import REGISTRY
-from prometheus_client import start_http_server
 import yaml
 from hadoop_exporter import utils
 from hadoop_exporter.common import MetricCollector
+from hadoop_exporter.discovery import DISCOVERY_SOURCES
+from hadoop_exporter.exposition import CACHE_TTL_DEFAULT, start_async_http_server, start_http_server
+from hadoop_exporter.instrumentation import ExporterMetrics
+from hadoop_exporter.remote_write import PushScheduler, RemoteWriter
+from hadoop_exporter.replicas import ReplicaSet
+from hadoop_exporter.rules import invalidate_rule_registries
+from hadoop_exporter.sharding import ShardedScheduler
+from hadoop_exporter.scheduler import Scheduler, SCHEDULER_JITTER_DEFAULT, collect_async
 from hadoop_exporter import (
     HDFSNameNodeMetricCollector,
     HDFSDataNodeMetricCollector,
@@ -30,6 +40,11 @@ EXPORTER_PATH_DEFAULT = '/metrics'
 EXPORTER_PERIOD_DEFAULT=30
 EXPORTER_CONFIG_DEFAULT='/exporter/config.yaml'
 EXPORTER_LOG_LEVEL_DEFAULT='info'
+EXPORTER_MAX_IN_FLIGHT_DEFAULT=16
+EXPORTER_SCRAPE_DEADLINE_DEFAULT=25
+EXPORTER_MODE_DEFAULT='pull'
+EXPORTER_MODES=['pull', 'scheduler', 'sharded', 'async', 'push']
+EXPORTER_WORKERS_DEFAULT=os.cpu_count() or 1
 
 
 class ExporterEnv:
@@ -58,30 +73,56 @@ class ExporterEnv:
     EXPORTER_PATH = os.environ.get('EXPORTER_PATH', EXPORTER_PATH_DEFAULT)
     EXPORTER_PERIOD = os.environ.get('EXPORTER_PERIOD', EXPORTER_PERIOD_DEFAULT)
     EXPORTER_LOG_LEVEL = os.environ.get('EXPORTER_LOG_LEVEL', EXPORTER_LOG_LEVEL_DEFAULT)
+    EXPORTER_MAX_IN_FLIGHT = os.environ.get('EXPORTER_MAX_IN_FLIGHT', EXPORTER_MAX_IN_FLIGHT_DEFAULT)
+    EXPORTER_SCRAPE_DEADLINE = os.environ.get('EXPORTER_SCRAPE_DEADLINE', EXPORTER_SCRAPE_DEADLINE_DEFAULT)
+    EXPORTER_MODE = os.environ.get('EXPORTER_MODE', EXPORTER_MODE_DEFAULT)
+    EXPORTER_JITTER = os.environ.get('EXPORTER_JITTER', SCHEDULER_JITTER_DEFAULT)
+    EXPORTER_PROFILE_RULES = os.environ.get('EXPORTER_PROFILE_RULES', 'false')
+    EXPORTER_WORKERS = os.environ.get('EXPORTER_WORKERS', EXPORTER_WORKERS_DEFAULT)
+    EXPORTER_CACHE_TTL = os.environ.get('EXPORTER_CACHE_TTL', CACHE_TTL_DEFAULT)
+    EXPORTER_REMOTE_WRITE_URL = os.environ.get('EXPORTER_REMOTE_WRITE_URL', None)
+    EXPORTER_REPLICA = os.environ.get('EXPORTER_REPLICA', None)
+    EXPORTER_PEERS = os.environ.get('EXPORTER_PEERS', None)
+    EXPORTER_MEMBERSHIP_FILE = os.environ.get('EXPORTER_MEMBERSHIP_FILE', None)
 
 
 class Service:
-    def __init__(self, cluster: str, urls: List[str], collector: Callable = MetricCollector, name: Optional[str] = None) -> None:
+    def __init__(self, cluster: str, urls: List[str], collector: Callable = MetricCollector, name: Optional[str] = None,
+                 options: Optional[Dict] = None, period: Optional[int] = None) -> None:
         self.collector = collector
         self.urls = urls
         self.cluster = cluster
         self.flag = True
         self.name = name
+        self.options = options or {}
+        self.period = period
+
+    def build(self, **options) -> MetricCollector:
+        return self.collector(cluster=self.cluster, urls=self.urls, **dict(self.options, **options))
 
     def register(self):
         if self.flag:
             logger.info("register new {} listen from {}".format(
                 self.collector.__name__, self.urls))
-            REGISTRY.register(self.collector(
-                cluster=self.cluster, urls=self.urls))
+            # in pull mode, the period of a service is the min interval between two scrapes of its jmx services
+            REGISTRY.register(self.build(min_interval=self.period or 0))
             self.flag = not self.flag
 
     def __str__(self) -> str:
-        return "(cluster: {}, url: {}, collector: {}{})".format(
-            self.cluster, self.urls, self.collector.__name__, f', name: {self.name}' if self.name else '')
+        return "(cluster: {}, url: {}, collector: {}{}{})".format(
+            self.cluster, self.urls, self.collector.__name__, f', name: {self.name}' if self.name else '',
+            f", discovered from: {self.options['discover_from']}" if self.options.get('discover_from') else '')
 
 
 class Exporter:
+    # options can be set per service in config file, beside its urls
+    SERVICE_OPTIONS = ['max_in_flight', 'scrape_deadline', 'timeout', 'pool_size', 'keep_alive', 'retries', 'backoff_factor',
+                       'bean_query', 'max_queries', 'stream', 'profile_rules', 'failure_threshold', 'circuit_backoff',
+                       'circuit_backoff_max', 'stale_ttl', 'discovery_interval', 'max_series',
+                       'extra_labels']
+    # options of server.remote_write in config file, used in push mode
+    REMOTE_WRITE_OPTIONS = ['url', 'batch_size', 'flush_interval', 'queue_size', 'enqueue_timeout', 'timeout', 'backoff',
+                            'backoff_max', 'headers']
     COLLECTOR_MAPPING = {
         'namenode': HDFSNameNodeMetricCollector,
         'datanode': HDFSDataNodeMetricCollector,
@@ -114,6 +155,20 @@ class Exporter:
                 self.port = int(server.get('port', EXPORTER_PORT_DEFAULT))
                 self.path = server.get('path', ExporterEnv.EXPORTER_PATH)
                 self.period = int(server.get('period', ExporterEnv.EXPORTER_PERIOD))
+                self.mode = server.get('mode', ExporterEnv.EXPORTER_MODE).lower()
+                self.jitter = float(server.get('jitter', ExporterEnv.EXPORTER_JITTER))
+                self.workers = int(server.get('workers', ExporterEnv.EXPORTER_WORKERS))
+                self.cache_ttl = float(server.get('cache_ttl', ExporterEnv.EXPORTER_CACHE_TTL))
+                self.remote_write = self._parse_remote_write(server.get('remote_write') or {})
+                self.collector_options = {
+                    'max_in_flight': int(server.get('max_in_flight', ExporterEnv.EXPORTER_MAX_IN_FLIGHT)),
+                    'scrape_deadline': float(server.get('scrape_deadline', ExporterEnv.EXPORTER_SCRAPE_DEADLINE)),
+                    'profile_rules': str(server.get('profile_rules', ExporterEnv.EXPORTER_PROFILE_RULES)).lower() == 'true',
+                }
+                replicas = server.get('replicas') or {}
+                self._add_replicas(replicas.get('replica', ExporterEnv.EXPORTER_REPLICA),
+                                   replicas.get('peers', ExporterEnv.EXPORTER_PEERS),
+                                   replicas.get('membership_file', ExporterEnv.EXPORTER_MEMBERSHIP_FILE))
                 self.sevices: List[Service] = []
 
                 jmx = cfg.get('jmx', [])
@@ -131,6 +186,19 @@ class Exporter:
             self.port = int(args.port or ExporterEnv.EXPORTER_PORT)
             self.path = args.path or ExporterEnv.EXPORTER_PATH
             self.period = int(args.period or ExporterEnv.EXPORTER_PERIOD)
+            self.mode = (args.mode or ExporterEnv.EXPORTER_MODE).lower()
+            self.jitter = float(args.jitter or ExporterEnv.EXPORTER_JITTER)
+            self.workers = int(args.workers or ExporterEnv.EXPORTER_WORKERS)
+            self.cache_ttl = float(args.cache_ttl or ExporterEnv.EXPORTER_CACHE_TTL)
+            self.remote_write = self._parse_remote_write(
+                {'url': args.remote_write_url or ExporterEnv.EXPORTER_REMOTE_WRITE_URL})
+            self.collector_options = {
+                'max_in_flight': int(args.max_in_flight or ExporterEnv.EXPORTER_MAX_IN_FLIGHT),
+                'scrape_deadline': float(args.scrape_deadline or ExporterEnv.EXPORTER_SCRAPE_DEADLINE),
+                'profile_rules': ExporterEnv.EXPORTER_PROFILE_RULES.lower() == 'true',
+            }
+            self._add_replicas(args.replica or ExporterEnv.EXPORTER_REPLICA, args.peers or ExporterEnv.EXPORTER_PEERS,
+                               args.membership_file or ExporterEnv.EXPORTER_MEMBERSHIP_FILE)
             self.sevices: List[Service] = []
 
             if (args.auto_discovery or ExporterEnv.EXPORTER_AUTO_DISCOVERY).lower() == 'true':
@@ -150,12 +218,13 @@ class Exporter:
             hiveserver2_jmx = args.hiveserver2_jmx or ExporterEnv.EXPORTER_HIVESERVER2_JMX
             hivellap_jmx = args.hivellap_jmx or ExporterEnv.EXPORTER_HIVELLAP_JMX
 
+            # datanodes and nodemanagers not given are discovered from the namenode and the resourcemanager
+            discover_datanodes = self.auto_discovery and not datanode_jmx
+            discover_nodemanagers = self.auto_discovery and not nodemanager_jmx
             if self.auto_discovery:
                 namenode_jmx = namenode_jmx or 'http://localhost:9870/jmx'
-                datanode_jmx = datanode_jmx or 'http://localhost:9864/jmx'
                 journalnode_jmx = journalnode_jmx or 'http://localhost:8480/jmx'
                 resourcemanager_jmx = resourcemanager_jmx or 'http://localhost:8088/jmx'
-                nodemanager_jmx = nodemanager_jmx or 'http://localhost:8042/jmx'
                 mapred_jobhistory_jmx = mapred_jobhistory_jmx or 'http://localhost:19888/jmx'
                 hmaster_jmx = hmaster_jmx or 'http://localhost:16010/jmx'
                 hregion_jmx = hregion_jmx or 'http://localhost:16030/jmx'
@@ -168,18 +237,20 @@ class Exporter:
             if namenode_jmx and self._check_whitelist('nn'):
                 self.sevices.append(self._build_service(
                     cluster_name, namenode_jmx, HDFSNameNodeMetricCollector))
-            if datanode_jmx and self._check_whitelist('dn'):
+            if (datanode_jmx or discover_datanodes) and self._check_whitelist('dn'):
                 self.sevices.append(self._build_service(
-                    cluster_name, datanode_jmx, HDFSDataNodeMetricCollector))
+                    cluster_name, datanode_jmx or [], HDFSDataNodeMetricCollector,
+                    discover_from=namenode_jmx if discover_datanodes else None))
             if journalnode_jmx and self._check_whitelist('jn'):
                 self.sevices.append(self._build_service(
                     cluster_name, journalnode_jmx, HDFSJournalNodeMetricCollector))
             if resourcemanager_jmx and self._check_whitelist('rm'):
                 self.sevices.append(self._build_service(
                     cluster_name, resourcemanager_jmx, YARNResourceManagerMetricCollector))
-            if nodemanager_jmx and self._check_whitelist('nm'):
+            if (nodemanager_jmx or discover_nodemanagers) and self._check_whitelist('nm'):
                 self.sevices.append(self._build_service(
-                    cluster_name, nodemanager_jmx, YARNNodeManagerMetricCollector))
+                    cluster_name, nodemanager_jmx or [], YARNNodeManagerMetricCollector,
+                    discover_from=resourcemanager_jmx if discover_nodemanagers else None))
             # if mapred_jobhistory_jmx and self._check_whitelist('mrjh'):
             #     self.sevices.append(self._build_service(
             #         cluster_name, mapred_jobhistory_jmx, MapredJobHistoryMetricCollector))
@@ -203,13 +274,18 @@ class Exporter:
 
         cluster=js.get("cluster", EXPORTER_CLUSTER_NAME_DEFAULT)
         services= []
-        for service_name, urls in js["services"].items():
+        for service_name, service_cfg in js["services"].items():
             collector = self.COLLECTOR_MAPPING.get(service_name.lower(), None)
             if collector:
+                urls, options, period = self._parse_service_config(service_name, service_cfg)
+                if isinstance(service_cfg, dict) and str(service_cfg.get('discover', False)).lower() == 'true':
+                    options = self._add_discovery_source(js["services"], service_name.lower(), options)
                 service = Service(
                     cluster=cluster,
                     urls=urls,
-                    collector=collector
+                    collector=collector,
+                    options=options,
+                    period=period
                 )
                 services.append(service)
                 logger.info("Added service: {}".format(service))
@@ -217,11 +293,84 @@ class Exporter:
                 logger.warning("Unknown service name: {}. Ignored".format(service_name))
         return services
 
-    def _build_service(self, cluster_name: str, urls: Union[str, List[str]], collector: Callable) -> Service:
+    def _add_replicas(self, replica: Optional[str], peers: Optional[Union[str, List[str]]],
+                      membership_file: Optional[str]):
+        '''
+        with peers or a membership file, this exporter is one of the replicas sharing the config and its collectors
+        scrape only the urls it owns, e.g.
+            replicas:
+              replica: exporter-0 # default: hostname
+              peers: [exporter-0, exporter-1, exporter-2]
+        '''
+        if not peers and not membership_file:
+            return
+        replicas = ReplicaSet(replica or socket.gethostname(), peers, membership_file)
+        logger.info("Exporter is replica {} of {}".format(replicas.replica, membership_file or replicas.get_peers()))
+        self.collector_options['replicas'] = replicas
+
+    def _parse_remote_write(self, remote_write_cfg: Dict) -> Dict:
+        '''
+        options of the RemoteWriter of push mode, e.g.
+            remote_write:
+              url: http://prometheus:9090/api/v1/write
+              batch_size: 2000
+              flush_interval: 5
+        '''
+        options = {}
+        for key, value in remote_write_cfg.items():
+            if key not in self.REMOTE_WRITE_OPTIONS:
+                logger.warning("Unknown option {} of remote_write. Ignored".format(key))
+            elif value is not None:
+                options[key] = value
+        return options
+
+    def _parse_service_config(self, service_name: str, service_cfg: Union[str, List[str], Dict]):
+        '''
+        a service is configured by either its list of urls or a dict of urls and options, e.g.
+            datanode:
+              urls: [http://dn1:9864/jmx, http://dn2:9864/jmx]
+              pool_size: 4
+              retries: 2
+              period: 60
+        @return a tuple of (urls, collector options, scrape period)
+        '''
+        if not isinstance(service_cfg, dict):
+            return service_cfg, self.collector_options, None
+        options = dict(self.collector_options)
+        for key, value in service_cfg.items():
+            if key in self.SERVICE_OPTIONS:
+                options[key] = value
+            elif key not in ('urls', 'period', 'discover'):
+                logger.warning("Unknown option {} of service {}. Ignored".format(key, service_name))
+        period = int(service_cfg['period']) if 'period' in service_cfg else None
+        return service_cfg.get('urls', []), options, period
+
+    def _add_discovery_source(self, services_cfg: Dict, service_name: str, options: Dict) -> Dict:
+        '''
+        set the urls of the source service of the cluster to discover the urls of a service from, e.g.
+            namenode: [http://nn1:9870/jmx, http://nn2:9870/jmx]
+            datanode:
+              discover: true
+        '''
+        source = DISCOVERY_SOURCES.get(service_name)
+        if source is None:
+            logger.warning("Discovery of {} is not supported, only {}".format(service_name, ", ".join(DISCOVERY_SOURCES)))
+            return options
+        source_cfg = services_cfg.get(source.service)
+        source_urls = source_cfg.get('urls', []) if isinstance(source_cfg, dict) else source_cfg
+        if not source_urls:
+            logger.warning("{} must be configured to discover {} urls".format(source.service, service_name))
+            return options
+        return dict(options, discover_from=source_urls)
+
+    def _build_service(self, cluster_name: str, urls: Union[str, List[str]], collector: Callable,
+                       discover_from: Optional[Union[str, List[str]]] = None) -> Service:
+        options = dict(self.collector_options, discover_from=discover_from) if discover_from else self.collector_options
         service = Service(
             cluster=cluster_name,
             urls=urls,
             collector=collector,
+            options=options
         )
         logger.info("Added service: {}".format(service))
         return service
@@ -237,28 +386,101 @@ class Exporter:
                 return False
 
     def register_consul(self):
-        start_http_server(self.port, addr=self.address)
-        logger.info(
-            f"Exporter start listening on http://{self.address}:{self.port}")
+        if self.mode == 'push' and not self.remote_write.get('url'):
+            logger.warning(f"remote_write url is required in push mode. Use {EXPORTER_MODE_DEFAULT} mode")
+            self.mode = EXPORTER_MODE_DEFAULT
+        if self.mode == 'push':
+            # samples are pushed by the RemoteWriter started by register_prometheus, nothing listens
+            logger.info(f"Exporter start pushing to {self.remote_write['url']}")
+        else:
+            # in async mode, metrics are served by the event loop started by register_prometheus
+            if self.mode != 'async':
+                start_http_server(self.port, addr=self.address, cache_ttl=self.cache_ttl)
+            logger.info(
+                f"Exporter start listening on http://{self.address}:{self.port}")
         logger.info(f"Scraping metrics every {self.period}s ...")
         logger.info(f"Set log level = {self.log_level}")
         logger.setLevel(self.log_level)
 
+    def register_reload_signal(self):
+        '''
+        reload metric rules on SIGHUP, without restarting the exporter.
+        '''
+        if not hasattr(signal, "SIGHUP"):
+            return
+        def reload(signum, frame):
+            logger.info("Received SIGHUP, rules will be reloaded on next scrape")
+            invalidate_rule_registries()
+        signal.signal(signal.SIGHUP, reload)
+
     def register_prometheus(self):
         self.logging_threshold = 60 #seconds
+        self.register_reload_signal()
+        REGISTRY.register(ExporterMetrics())
         counter = self.logging_threshold
+        writer = None
+        if self.mode not in EXPORTER_MODES:
+            logger.warning(f"Unknown exporter mode: {self.mode}. Use {EXPORTER_MODE_DEFAULT} mode")
+            self.mode = EXPORTER_MODE_DEFAULT
+        if self.mode == 'scheduler':
+            logger.info(f"Scrape services in background, jitter = {self.jitter}")
+            scheduler = Scheduler(self.sevices, self.period, self.jitter)
+            scheduler.start()
+            REGISTRY.register(scheduler)
+        elif self.mode == 'sharded':
+            logger.info(f"Scrape services in background with {self.workers} worker processes, jitter = {self.jitter}")
+            scheduler = ShardedScheduler(self.sevices, self.period, self.jitter, self.workers)
+            scheduler.start()
+            REGISTRY.register(scheduler)
+        elif self.mode == 'push':
+            logger.info(f"Scrape services in background and push samples, jitter = {self.jitter}")
+            writer = RemoteWriter(**self.remote_write)
+            writer.start()
+            scheduler = PushScheduler(self.sevices, self.period, writer, self.jitter)
+            scheduler.start()
+        elif self.mode == 'async':
+            logger.info("Scrape services concurrently in an event loop on each pull")
+            try:
+                asyncio.run(self.serve_async())
+            except KeyboardInterrupt:
+                logger.info("Interrupted")
+                exit(0)
+            return
         try:
             while True:
-                for service in self.sevices:
-                    service.register()
+                if self.mode == 'pull':
+                    for service in self.sevices:
+                        service.register()
                 if counter >= self.logging_threshold:
                     logger.info(f"Continue scraping metrics every {self.period}s ...")
                     counter = 0
                 counter += 1
                 time.sleep(self.period)
+                if writer is not None:
+                    # internal metrics of the exporter are pushed with the samples of the services
+                    writer.push(REGISTRY.collect())
 
         except KeyboardInterrupt:
             logger.info("Interrupted")
+            if writer is not None:
+                writer.stop(timeout=self.period)
             exit(0)
         except:
             traceback.print_exc()
+
+    async def serve_async(self):
+        '''
+        serve /metrics from an event loop, the jmx services of all collectors are fetched concurrently on each pull
+        by non-blocking clients, without a thread per request.
+        '''
+        # as in pull mode, the period of a service is the min interval between two scrapes of its jmx services
+        collectors = [service.build(min_interval=service.period or 0) for service in self.sevices]
+        for service in self.sevices:
+            logger.info("register new {} listen from {}".format(service.collector.__name__, service.urls))
+
+        async def collect():
+            return list(REGISTRY.collect()) + await collect_async(collectors)
+
+        server = await start_async_http_server(collect, self.port, self.address, self.cache_ttl)
+        async with server:
+            await server.serve_forever()
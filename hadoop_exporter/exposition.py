@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gzip
+import time
+import asyncio
+import threading
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+from wsgiref.simple_server import make_server
+from prometheus_client.core import REGISTRY, Metric
+from prometheus_client.exposition import CONTENT_TYPE_LATEST, ThreadingWSGIServer, _SilentHandler
+from prometheus_client.openmetrics.exposition import CONTENT_TYPE_LATEST as OPENMETRICS_CONTENT_TYPE_LATEST
+from prometheus_client.utils import floatToGoString
+from hadoop_exporter import utils
+from hadoop_exporter.store import ColumnarMetricFamily, escape_label_value
+
+logger = utils.get_logger(__name__)
+
+FORMAT_TEXT = "text"
+FORMAT_OPENMETRICS = "openmetrics"
+CONTENT_TYPES = {FORMAT_TEXT: CONTENT_TYPE_LATEST, FORMAT_OPENMETRICS: OPENMETRICS_CONTENT_TYPE_LATEST}
+GZIP_LEVEL = 6
+CACHE_TTL_DEFAULT = 0
+
+
+def labels_text(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    return '{{{0}}}'.format(','.join(
+        ['{0}="{1}"'.format(k, escape_label_value(v)) for k, v in sorted(labels.items())]))
+
+
+def sample_line(sample) -> str:
+    timestamp = ''
+    if sample.timestamp is not None:
+        # Convert to milliseconds.
+        timestamp = ' {0:d}'.format(int(float(sample.timestamp) * 1000))
+    return '{0}{1} {2}{3}\n'.format(sample.name, labels_text(sample.labels), floatToGoString(sample.value), timestamp)
+
+
+def openmetrics_sample_line(sample, metric=None) -> str:
+    exemplar = ''
+    if sample.exemplar:
+        if metric is not None and (metric.type not in ('histogram', 'gaugehistogram') or not sample.name.endswith('_bucket')):
+            raise ValueError("Metric {0} has exemplars, but is not a histogram bucket".format(metric.name))
+        exemplar = ' # {0} {1}'.format(labels_text(sample.exemplar.labels), floatToGoString(sample.exemplar.value))
+        if sample.exemplar.timestamp is not None:
+            exemplar += ' {0}'.format(sample.exemplar.timestamp)
+    timestamp = ''
+    if sample.timestamp is not None:
+        timestamp = ' {0}'.format(sample.timestamp)
+    return '{0}{1} {2}{3}{4}\n'.format(
+        sample.name, labels_text(sample.labels), floatToGoString(sample.value), timestamp, exemplar)
+
+
+def generate_latest(registry=REGISTRY) -> bytes:
+    '''
+    same output as prometheus_client.generate_latest, but samples of ColumnarMetricFamily are rendered
+    from their columns with their cached prefix instead of being materialized as Sample.
+    '''
+    output = []
+    for metric in registry.collect():
+        try:
+            mname = metric.name
+            mtype = metric.type
+            # Munging from OpenMetrics into Prometheus format.
+            if mtype == 'counter':
+                mname = mname + '_total'
+            elif mtype == 'info':
+                mname = mname + '_info'
+                mtype = 'gauge'
+            elif mtype == 'stateset':
+                mtype = 'gauge'
+            elif mtype == 'gaugehistogram':
+                mtype = 'histogram'
+            elif mtype == 'unknown':
+                mtype = 'untyped'
+
+            output.append('# HELP {0} {1}\n'.format(
+                mname, metric.documentation.replace('\\', r'\\').replace('\n', r'\n')))
+            output.append('# TYPE {0} {1}\n'.format(mname, mtype))
+
+            if isinstance(metric, ColumnarMetricFamily):
+                metric.render(output, sample_line)
+                continue
+            om_samples = {}
+            for s in metric.samples:
+                for suffix in ['_created', '_gsum', '_gcount']:
+                    if s.name == metric.name + suffix:
+                        # OpenMetrics specific sample, put in a gauge at the end.
+                        om_samples.setdefault(suffix, []).append(sample_line(s))
+                        break
+                else:
+                    output.append(sample_line(s))
+        except Exception as exception:
+            exception.args = (exception.args or ('',)) + (metric,)
+            raise
+
+        for suffix, lines in sorted(om_samples.items()):
+            output.append('# HELP {0}{1} {2}\n'.format(
+                metric.name, suffix, metric.documentation.replace('\\', r'\\').replace('\n', r'\n')))
+            output.append('# TYPE {0}{1} gauge\n'.format(metric.name, suffix))
+            output.extend(lines)
+    return ''.join(output).encode('utf-8')
+
+
+def generate_openmetrics(registry=REGISTRY) -> bytes:
+    '''
+    same output as prometheus_client.openmetrics.exposition.generate_latest, with the columnar fast path.
+    '''
+    output = []
+    for metric in registry.collect():
+        try:
+            mname = metric.name
+            output.append('# HELP {0} {1}\n'.format(
+                mname, escape_label_value(metric.documentation)))
+            output.append('# TYPE {0} {1}\n'.format(mname, metric.type))
+            if metric.unit:
+                output.append('# UNIT {0} {1}\n'.format(mname, metric.unit))
+            if isinstance(metric, ColumnarMetricFamily):
+                metric.render(output, openmetrics_sample_line)
+                continue
+            for s in metric.samples:
+                output.append(openmetrics_sample_line(s, metric))
+        except Exception as exception:
+            exception.args = (exception.args or ('',)) + (metric,)
+            raise
+    output.append('# EOF\n')
+    return ''.join(output).encode('utf-8')
+
+
+ENCODERS = {FORMAT_TEXT: generate_latest, FORMAT_OPENMETRICS: generate_openmetrics}
+
+
+def choose_format(accept_header: Optional[str]) -> str:
+    for accepted in (accept_header or '').split(','):
+        if accepted.split(';')[0].strip() == 'application/openmetrics-text':
+            return FORMAT_OPENMETRICS
+    return FORMAT_TEXT
+
+
+def accepts_gzip(accept_encoding: Optional[str]) -> bool:
+    for encoding in (accept_encoding or '').split(','):
+        parts = encoding.split(';')
+        if parts[0].strip().lower() != 'gzip':
+            continue
+        for param in parts[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.strip() == 'q':
+                # gzip;q=0 means gzip is not acceptable
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+class Rendering(object):
+    '''
+    One rendering of the registry in a format, shared by the scrapers arriving while it is rendered or fresh.
+    '''
+    __slots__ = ("done", "output", "gzipped", "error", "rendered_at", "_lock")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.output = None
+        self.gzipped = None
+        self.error = None
+        self.rendered_at = None
+        self._lock = threading.Lock()
+
+    def get_gzipped(self) -> bytes:
+        with self._lock:
+            if self.gzipped is None:
+                self.gzipped = gzip.compress(self.output, GZIP_LEVEL)
+        return self.gzipped
+
+
+class ExpositionCache(object):
+    '''
+    ExpositionCache collects and renders the registry once for all concurrent scrapers: a scraper arriving while
+    the registry is rendered waits for that rendering instead of collecting again, e.g. jmx services aren't fetched
+    twice in pull mode by a pair of prometheus servers. A rendering is reused for ttl seconds,
+    gzip is compressed at most once per rendering.
+    '''
+
+    def __init__(self, registry=REGISTRY, ttl: float = CACHE_TTL_DEFAULT):
+        '''
+        @param ttl: Seconds a rendering is served after it completed, 0 to only share in-flight renderings.
+        '''
+        self._registry = registry
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._renderings: Dict[str, Rendering] = {}
+
+    def get(self, fmt: str, gzipped: bool = False) -> bytes:
+        with self._lock:
+            rendering = self._renderings.get(fmt)
+            owner = rendering is None or (
+                rendering.done.is_set() and time.monotonic() - rendering.rendered_at >= self._ttl)
+            if owner:
+                rendering = self._renderings[fmt] = Rendering()
+        if owner:
+            try:
+                rendering.output = ENCODERS[fmt](self._registry)
+            except Exception as e:
+                rendering.error = e
+            finally:
+                rendering.rendered_at = time.monotonic()
+                rendering.done.set()
+        else:
+            rendering.done.wait()
+        if rendering.error is not None:
+            raise rendering.error
+        return rendering.get_gzipped() if gzipped else rendering.output
+
+
+def make_wsgi_app(registry=REGISTRY, cache_ttl: float = CACHE_TTL_DEFAULT):
+    '''
+    WSGI app serving the metrics of the registry in the text or OpenMetrics format negotiated by the Accept header,
+    gzipped if accepted by the scraper. Filtered requests (name[]) are rendered apart, without cache.
+    '''
+    cache = ExpositionCache(registry, cache_ttl)
+
+    def metrics_app(environ, start_response):
+        fmt = choose_format(environ.get('HTTP_ACCEPT'))
+        gzipped = accepts_gzip(environ.get('HTTP_ACCEPT_ENCODING'))
+        params = parse_qs(environ.get('QUERY_STRING', ''))
+        if 'name[]' in params:
+            output = ENCODERS[fmt](registry.restricted_registry(params['name[]']))
+            if gzipped:
+                output = gzip.compress(output, GZIP_LEVEL)
+        else:
+            output = cache.get(fmt, gzipped)
+        headers = [('Content-Type', CONTENT_TYPES[fmt]), ('Content-Length', str(len(output)))]
+        if gzipped:
+            headers.append(('Content-Encoding', 'gzip'))
+        start_response('200 OK', headers)
+        return [output]
+
+    return metrics_app
+
+
+def start_http_server(port: int, addr: str = '', registry=REGISTRY, cache_ttl: float = CACHE_TTL_DEFAULT):
+    '''
+    serve the metrics of the registry in a daemon thread.
+    @param cache_ttl: Seconds a rendering of the metrics is served to other scrapers.
+    '''
+    httpd = make_server(addr, port, make_wsgi_app(registry, cache_ttl), ThreadingWSGIServer,
+                        handler_class=_SilentHandler)
+    thread = threading.Thread(target=httpd.serve_forever, name="metrics_server", daemon=True)
+    thread.start()
+    return httpd
+
+
+class MetricFamilies(object):
+    '''
+    Registry-like view of a list of metric families, rendered by the encoders.
+    '''
+
+    def __init__(self, families: List[Metric]):
+        self._families = families
+
+    def collect(self):
+        return iter(self._families)
+
+    def restricted_registry(self, names: List[str]) -> "MetricFamilies":
+        '''
+        same as CollectorRegistry.restricted_registry, only samples with these names are kept.
+        '''
+        names = set(names)
+        restricted = []
+        for metric in self._families:
+            if isinstance(metric, ColumnarMetricFamily):
+                # its samples are named after the family
+                if metric.name in names:
+                    restricted.append(metric)
+                continue
+            samples = [sample for sample in metric.samples if sample.name in names]
+            if samples:
+                kept = Metric(metric.name, metric.documentation, metric.type)
+                kept.samples = samples
+                restricted.append(kept)
+        return MetricFamilies(restricted)
+
+
+class AsyncExpositionCache(object):
+    '''
+    same as ExpositionCache in an event loop: scrapers arriving while the metrics are collected and rendered await
+    the same task. Rendering and gzip run in the default executor, so the loop keeps serving meanwhile.
+    '''
+
+    def __init__(self, collect: Callable[[], Awaitable[List[Metric]]], ttl: float = CACHE_TTL_DEFAULT):
+        '''
+        @param collect: Coroutine function returning the metric families to render.
+        @param ttl: Seconds a rendering is served after it completed, 0 to only share in-flight renderings.
+        '''
+        self._collect = collect
+        self._ttl = ttl
+        self._renderings: Dict[str, asyncio.Future] = {}
+
+    async def get(self, fmt: str, gzipped: bool = False) -> bytes:
+        task = self._renderings.get(fmt)
+        if task is None or (task.done() and (task.cancelled() or task.exception() is not None
+                                             or time.monotonic() - task.result().rendered_at >= self._ttl)):
+            task = self._renderings[fmt] = asyncio.ensure_future(self._render(fmt))
+        # a scraper going away doesn't cancel the rendering awaited by the others
+        rendering = await asyncio.shield(task)
+        if gzipped:
+            return await asyncio.get_event_loop().run_in_executor(None, rendering.get_gzipped)
+        return rendering.output
+
+    async def _render(self, fmt: str) -> Rendering:
+        families = await self._collect()
+        rendering = Rendering()
+        rendering.output = await asyncio.get_event_loop().run_in_executor(
+            None, ENCODERS[fmt], MetricFamilies(families))
+        rendering.rendered_at = time.monotonic()
+        rendering.done.set()
+        return rendering
+
+
+class AsyncMetricsServer(object):
+    '''
+    http/1.1 server of the metrics in an event loop, same responses as make_wsgi_app. Connections are kept alive
+    between scrapes.
+    '''
+
+    def __init__(self, collect: Callable[[], Awaitable[List[Metric]]], cache_ttl: float = CACHE_TTL_DEFAULT):
+        '''
+        @param collect: Coroutine function returning the metric families to serve, awaited on each rendering.
+        @param cache_ttl: Seconds a rendering of the metrics is served to other scrapers.
+        '''
+        self._collect = collect
+        self._cache = AsyncExpositionCache(collect, cache_ttl)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                connection = headers.get('connection', '').lower()
+                keep_alive = connection == 'keep-alive' if parts[2] == 'HTTP/1.0' else connection != 'close'
+                status, response_headers, output = await self._respond(parts[1], headers)
+                response_headers.append(('Connection', 'keep-alive' if keep_alive else 'close'))
+                writer.write('HTTP/1.1 {0}\r\n{1}\r\n'.format(status, ''.join(
+                    '{0}: {1}\r\n'.format(name, value) for name, value in response_headers)).encode('latin-1'))
+                if parts[0] != 'HEAD':
+                    writer.write(output)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, target: str, headers: Dict[str, str]) -> Tuple[str, List[Tuple[str, str]], bytes]:
+        fmt = choose_format(headers.get('accept'))
+        gzipped = accepts_gzip(headers.get('accept-encoding'))
+        params = parse_qs(target.partition('?')[2])
+        loop = asyncio.get_event_loop()
+        try:
+            if 'name[]' in params:
+                families = MetricFamilies(await self._collect()).restricted_registry(params['name[]'])
+                output = await loop.run_in_executor(None, ENCODERS[fmt], families)
+                if gzipped:
+                    output = await loop.run_in_executor(None, gzip.compress, output, GZIP_LEVEL)
+            else:
+                output = await self._cache.get(fmt, gzipped)
+        except Exception as e:
+            logger.warning("Error while rendering metrics: {0}".format(e))
+            output = 'error while rendering metrics: {0}\n'.format(e).encode('utf-8')
+            return '500 Internal Server Error', [
+                ('Content-Type', 'text/plain; charset=utf-8'), ('Content-Length', str(len(output)))], output
+        response_headers = [('Content-Type', CONTENT_TYPES[fmt]), ('Content-Length', str(len(output)))]
+        if gzipped:
+            response_headers.append(('Content-Encoding', 'gzip'))
+        return '200 OK', response_headers, output
+
+
+async def start_async_http_server(collect: Callable[[], Awaitable[List[Metric]]], port: int, addr: str = '',
+                                  cache_ttl: float = CACHE_TTL_DEFAULT) -> asyncio.AbstractServer:
+    '''
+    serve the metrics returned by collect from the running event loop.
+    @return the asyncio server, serving until closed.
+    '''
+    server = AsyncMetricsServer(collect, cache_ttl)
+    return await asyncio.start_server(server.handle, addr or None, port)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from typing import Optional
+
+FAILURE_THRESHOLD_DEFAULT = 2
+CIRCUIT_BACKOFF_DEFAULT = 30
+CIRCUIT_BACKOFF_MAX_DEFAULT = 600
+STALE_TTL_DEFAULT = 300
+
+
+class TargetHealth(object):
+    '''
+    Circuit breaker of a jmx url. After failure_threshold consecutive failures the circuit opens and the url is
+    skipped for backoff seconds, doubled on each failure of the single try made when it expires, up to backoff_max.
+    A successful fetch closes the circuit.
+    '''
+    __slots__ = ("failure_threshold", "backoff", "backoff_max", "failures", "open_until")
+
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD_DEFAULT, backoff: float = CIRCUIT_BACKOFF_DEFAULT,
+                 backoff_max: float = CIRCUIT_BACKOFF_MAX_DEFAULT):
+        '''
+        @param failure_threshold: Consecutive failures opening the circuit, 0 to never skip the url.
+        @param backoff: Seconds the url is skipped when the circuit opens.
+        @param backoff_max: Max seconds the url is skipped.
+        '''
+        self.failure_threshold = failure_threshold
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.failures = 0
+        self.open_until = 0.0
+
+    def allow(self, now: float) -> bool:
+        '''
+        whether the url must be fetched, false while the circuit is open.
+        '''
+        return now >= self.open_until
+
+    def is_open(self, now: float) -> bool:
+        return not self.allow(now)
+
+    def success(self) -> bool:
+        '''
+        @return True if the url recovered, i.e. the circuit was opened before.
+        '''
+        recovered = self.failure_threshold > 0 and self.failures >= self.failure_threshold
+        self.failures = 0
+        self.open_until = 0.0
+        return recovered
+
+    def failure(self, now: float) -> Optional[float]:
+        '''
+        @return seconds the url will be skipped, None if the circuit stays closed.
+        '''
+        self.failures += 1
+        if self.failure_threshold <= 0 or self.failures < self.failure_threshold:
+            return None
+        delay = min(self.backoff_max, self.backoff * 2 ** min(self.failures - self.failure_threshold, 32))
+        self.open_until = now + delay
+        return delay
@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import bisect
+import threading
+import weakref
+from collections import defaultdict
+from typing import Dict, List, Optional, Tuple
+import requests
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60)
+# stages of a scrape of a collector
+STAGE_FETCH = "fetch"
+STAGE_CONVERT = "convert"
+STAGE_EXPOSE = "expose"
+# stages of a scrape of an url
+STAGE_REQUEST = "request"
+STAGE_DOWNLOAD = "download"
+STAGE_DECODE = "decode"
+
+
+def get_error_type(error: Exception) -> str:
+    '''
+    type label of a fetch error in hadoop_exporter_errors_total.
+    '''
+    if isinstance(error, requests.Timeout):
+        return "timeout"
+    if isinstance(error, requests.ConnectionError):
+        return "connection"
+    if isinstance(error, requests.HTTPError):
+        return "http"
+    if isinstance(error, ValueError):
+        return "parse"
+    return "other"
+
+
+class Histogram(object):
+    '''
+    Minimal histogram with fixed buckets, observed under the lock of its CollectorStats.
+    '''
+    __slots__ = ("counts", "sum")
+
+    def __init__(self):
+        self.counts = [0] * (len(DURATION_BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(DURATION_BUCKETS, value)] += 1
+        self.sum += value
+
+    def buckets(self) -> List[Tuple[str, int]]:
+        buckets, total = [], 0
+        for bound, count in zip(list(DURATION_BUCKETS) + [float("inf")], self.counts):
+            total += count
+            buckets.append(("+Inf" if bound == float("inf") else str(bound), total))
+        return buckets
+
+
+class CollectorStats(object):
+    '''
+    Internal metrics of a collector and its urls, exposed by ExporterMetrics.
+    '''
+
+    def __init__(self, cluster: str, service: str, urls: List[str], profile_rules: bool = False):
+        '''
+        @param profile_rules: Also measure the time spent by each rule, which adds timer calls in the conversion loop.
+        '''
+        self.cluster = cluster
+        self.service = service
+        self.profile_rules = profile_rules
+        self._lock = threading.Lock()
+        self._stages: Dict[str, Histogram] = defaultdict(Histogram)
+        self._url_stages: Dict[Tuple[str, str], Histogram] = defaultdict(Histogram)
+        self._bytes: Dict[str, int] = defaultdict(int)
+        self._beans: Dict[Tuple[str, str], int] = {}
+        self._series: Dict[str, int] = {}
+        self._up: Dict[str, int] = {url: 0 for url in urls}
+        self._circuit_open: Dict[str, int] = {url: 0 for url in urls}
+        self._stale: Dict[str, int] = {url: 0 for url in urls}
+        self._errors: Dict[Tuple[str, str], int] = defaultdict(int)
+        self._rule_matches: Dict[str, int] = defaultdict(int)
+        self._rule_seconds: Dict[Tuple[str, str], float] = defaultdict(float)
+        self._rule_evaluations: Dict[Tuple[str, str], int] = defaultdict(int)
+        # (group pattern, rule pattern, overflow action) -> series and samples beyond series budgets
+        self._overflow_series: Dict[Tuple[str, str, str], int] = {}
+        self._overflow_samples: Dict[Tuple[str, str, str], int] = defaultdict(int)
+        _stats.add(self)
+
+    def set_urls(self, urls: List[str]):
+        '''
+        drop the metrics of urls which are not scraped anymore, e.g. decommissioned datanodes.
+        '''
+        kept = set(urls)
+        with self._lock:
+            for metrics in (self._bytes, self._series, self._up, self._circuit_open, self._stale):
+                for url in [url for url in metrics if url not in kept]:
+                    del metrics[url]
+            for metrics in (self._url_stages, self._beans, self._errors):
+                for key in [key for key in metrics if key[0] not in kept]:
+                    del metrics[key]
+            for url in urls:
+                self._up.setdefault(url, 0)
+                self._circuit_open.setdefault(url, 0)
+                self._stale.setdefault(url, 0)
+
+    def observe_stage(self, stage: str, seconds: float):
+        with self._lock:
+            self._stages[stage].observe(seconds)
+
+    def observe_fetch(self, url: str, fetch_stats, matched: int):
+        '''
+        @param fetch_stats: utils.FetchStats of the fetch of the url.
+        '''
+        with self._lock:
+            self._url_stages[(url, STAGE_REQUEST)].observe(fetch_stats.request_seconds)
+            self._url_stages[(url, STAGE_DOWNLOAD)].observe(fetch_stats.download_seconds)
+            self._url_stages[(url, STAGE_DECODE)].observe(fetch_stats.decode_seconds)
+            self._bytes[url] += fetch_stats.bytes
+            self._beans[(url, "received")] = fetch_stats.beans
+            self._beans[(url, "matched")] = matched
+            self._up[url] = 1
+
+    def observe_convert(self, url: str, seconds: float, series: int, rule_matches: Dict[str, int]):
+        with self._lock:
+            self._url_stages[(url, STAGE_CONVERT)].observe(seconds)
+            self._series[url] = series
+            for group_pattern, count in rule_matches.items():
+                self._rule_matches[group_pattern] += count
+
+    def observe_rules(self, rule_seconds: Dict[Tuple[str, str], float], rule_evaluations: Dict[Tuple[str, str], int]):
+        with self._lock:
+            for key, seconds in rule_seconds.items():
+                self._rule_seconds[key] += seconds
+            for key, count in rule_evaluations.items():
+                self._rule_evaluations[key] += count
+
+    def observe_overflow(self, overflow_series: Dict[Tuple[str, str, str], int],
+                         overflow_samples: Dict[Tuple[str, str, str], int]):
+        '''
+        @param overflow_series: Series of the collector currently beyond a budget.
+        @param overflow_samples: Samples dropped or aggregated in the conversion of an url.
+        '''
+        with self._lock:
+            self._overflow_series = dict(overflow_series)
+            for key, count in overflow_samples.items():
+                self._overflow_samples[key] += count
+
+    def observe_fetch_error(self, url: str, error_type: str):
+        with self._lock:
+            self._errors[(url, error_type)] += 1
+            self._up[url] = 0
+
+    def observe_error(self, url: str, error_type: str):
+        with self._lock:
+            self._errors[(url, error_type)] += 1
+
+    def observe_circuit(self, url: str, circuit_open: bool):
+        with self._lock:
+            self._circuit_open[url] = int(circuit_open)
+
+    def observe_stale(self, url: str, stale: bool):
+        with self._lock:
+            self._stale[url] = int(stale)
+
+    def collect(self, families: Dict[str, object]):
+        '''
+        add the samples of this collector into the process-wide metric families.
+        '''
+        common = [self.cluster, self.service]
+        with self._lock:
+            for stage, histogram in self._stages.items():
+                families["stage"].add_metric(common + [stage], histogram.buckets(), histogram.sum)
+            for (url, stage), histogram in self._url_stages.items():
+                families["url_stage"].add_metric(common + [url, stage], histogram.buckets(), histogram.sum)
+            for url, count in self._bytes.items():
+                families["bytes"].add_metric(common + [url], count)
+            for (url, state), count in self._beans.items():
+                families["beans"].add_metric(common + [url, state], count)
+            for url, count in self._series.items():
+                families["series"].add_metric(common + [url], count)
+            for url, up in self._up.items():
+                families["up"].add_metric(common + [url], up)
+            for url, circuit_open in self._circuit_open.items():
+                families["circuit_open"].add_metric(common + [url], circuit_open)
+            for url, stale in self._stale.items():
+                families["stale"].add_metric(common + [url], stale)
+            for (url, error_type), count in self._errors.items():
+                families["errors"].add_metric(common + [url, error_type], count)
+            for group_pattern, count in self._rule_matches.items():
+                families["rule_matches"].add_metric(common + [group_pattern], count)
+            for (group_pattern, rule_pattern), seconds in self._rule_seconds.items():
+                families["rule_seconds"].add_metric(common + [group_pattern, rule_pattern], seconds)
+            for (group_pattern, rule_pattern), count in self._rule_evaluations.items():
+                families["rule_evaluations"].add_metric(common + [group_pattern, rule_pattern], count)
+            for key, count in self._overflow_series.items():
+                families["overflow_series"].add_metric(common + list(key), count)
+            for key, count in self._overflow_samples.items():
+                families["overflow_samples"].add_metric(common + list(key), count)
+
+
+class RemoteWriteStats(object):
+    '''
+    Internal metrics of a remote-write queue, exposed by ExporterMetrics.
+    '''
+
+    def __init__(self, url: str):
+        self.url = url
+        self._lock = threading.Lock()
+        self._samples: Dict[str, int] = defaultdict(int)
+        self._requests: Dict[str, int] = defaultdict(int)
+        self._request_duration = Histogram()
+        self._queue = 0
+        _stats.add(self)
+
+    def observe_samples(self, result: str, count: int):
+        '''
+        @param result: sent, rejected by the receiver, failed after retries or dropped from the full queue.
+        '''
+        with self._lock:
+            self._samples[result] += count
+
+    def observe_request(self, seconds: float, status: Optional[int]):
+        with self._lock:
+            self._request_duration.observe(seconds)
+            self._requests["error" if status is None else str(status)] += 1
+
+    def observe_queue(self, size: int):
+        with self._lock:
+            self._queue = size
+
+    def collect(self, families: Dict[str, object]):
+        with self._lock:
+            for result, count in self._samples.items():
+                families["remote_write_samples"].add_metric([self.url, result], count)
+            for status, count in self._requests.items():
+                families["remote_write_requests"].add_metric([self.url, status], count)
+            families["remote_write_duration"].add_metric(
+                [self.url], self._request_duration.buckets(), self._request_duration.sum)
+            families["remote_write_queue"].add_metric([self.url], self._queue)
+
+
+_stats = weakref.WeakSet()
+
+
+class ExporterMetrics(object):
+    '''
+    Collector of the internal metrics of all collectors of the process, registered once.
+    '''
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        labels = ["cluster", "service"]
+        families = {
+            "stage": HistogramMetricFamily(
+                "hadoop_exporter_stage_duration_seconds",
+                "duration of the stages of a scrape of a service: fetch of all urls, convert, expose",
+                labels=labels + ["stage"]),
+            "url_stage": HistogramMetricFamily(
+                "hadoop_exporter_target_stage_duration_seconds",
+                "duration of the stages of a scrape of an url: request (until response headers), download, decode, convert",
+                labels=labels + ["url", "stage"]),
+            "bytes": CounterMetricFamily(
+                "hadoop_exporter_fetched_bytes", "bytes of jmx responses fetched from the url",
+                labels=labels + ["url"]),
+            "beans": GaugeMetricFamily(
+                "hadoop_exporter_beans", "beans received from the url and matched by rules in the last scrape",
+                labels=labels + ["url", "state"]),
+            "series": GaugeMetricFamily(
+                "hadoop_exporter_series", "series produced from the url in the last scrape",
+                labels=labels + ["url"]),
+            "up": GaugeMetricFamily(
+                "hadoop_exporter_up", "whether the last fetch of the url succeeded",
+                labels=labels + ["url"]),
+            "circuit_open": GaugeMetricFamily(
+                "hadoop_exporter_circuit_open", "whether the url is skipped after consecutive failures",
+                labels=labels + ["url"]),
+            "stale": GaugeMetricFamily(
+                "hadoop_exporter_stale",
+                "whether the samples of the url are its last good values, served while it is skipped or failing",
+                labels=labels + ["url"]),
+            "errors": CounterMetricFamily(
+                "hadoop_exporter_errors", "errors while scraping the url by type",
+                labels=labels + ["url", "type"]),
+            "rule_matches": CounterMetricFamily(
+                "hadoop_exporter_rule_matches", "bean attributes matched by the rules of a group pattern",
+                labels=labels + ["group"]),
+            "rule_seconds": CounterMetricFamily(
+                "hadoop_exporter_rule_cpu_seconds", "cpu time spent in a rule, only with profile_rules",
+                labels=labels + ["group", "rule"]),
+            "rule_evaluations": CounterMetricFamily(
+                "hadoop_exporter_rule_evaluations", "evaluations of a rule, only with profile_rules",
+                labels=labels + ["group", "rule"]),
+            "overflow_series": GaugeMetricFamily(
+                "hadoop_exporter_overflow_series",
+                "series beyond the series budget of the collector or of the rule, dropped or aggregated",
+                labels=labels + ["group", "rule", "action"]),
+            "overflow_samples": CounterMetricFamily(
+                "hadoop_exporter_overflow_samples", "samples dropped or aggregated because their series is beyond a budget",
+                labels=labels + ["group", "rule", "action"]),
+            "remote_write_samples": CounterMetricFamily(
+                "hadoop_exporter_remote_write_samples",
+                "samples pushed to the remote-write url by result: sent, rejected, failed or dropped",
+                labels=["url", "result"]),
+            "remote_write_requests": CounterMetricFamily(
+                "hadoop_exporter_remote_write_requests", "remote-write requests by http status, error if none",
+                labels=["url", "status"]),
+            "remote_write_duration": HistogramMetricFamily(
+                "hadoop_exporter_remote_write_duration_seconds", "duration of the remote-write requests",
+                labels=["url"]),
+            "remote_write_queue": GaugeMetricFamily(
+                "hadoop_exporter_remote_write_queue_series", "series queued to be sent to the remote-write url",
+                labels=["url"]),
+        }
+        for stats in list(_stats):
+            stats.collect(families)
+        return [family for family in families.values() if family.samples]
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import queue
+import atexit
+import logging
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional, Tuple
+
+LOG_FORMAT = '%(asctime)s %(filename)s[line:%(lineno)d]-[%(levelname)s]: %(message)s'
+LOG_FILE_DEFAULT = 'hadoop_exporter.log'
+# records waiting to be written, records beyond are dropped instead of blocking the caller
+LOG_QUEUE_SIZE = 10000
+# records logged by a line of code in each interval, others are counted and summarized at the end of the interval
+LOG_RATE_LIMIT_BURST = int(os.environ.get('EXPORTER_LOG_RATE_LIMIT_BURST', 10))
+LOG_RATE_LIMIT_INTERVAL = float(os.environ.get('EXPORTER_LOG_RATE_LIMIT_INTERVAL', 60))
+
+
+class RateLimitFilter(logging.Filter):
+    '''
+    Rate limits the records of each line of code, e.g. a warning in the conversion loop logged for thousands of
+    attributes when a rule is misconfigured. Beyond burst records in an interval, records of the line are dropped
+    before being queued, and a summary with their count is logged by flush at the end of the interval.
+    Errors are never dropped.
+    '''
+
+    def __init__(self, burst: int = LOG_RATE_LIMIT_BURST):
+        super().__init__()
+        self.burst = burst
+        self._lock = threading.Lock()
+        # (logger name, path, line) -> records of the interval
+        self._counts: Dict[Tuple[str, str, int], int] = {}
+        # (logger name, path, line) -> (dropped records of the interval, last dropped record)
+        self._suppressed: Dict[Tuple[str, str, int], Tuple[int, logging.LogRecord]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.ERROR or getattr(record, "summary", False):
+            return True
+        key = (record.name, record.pathname, record.lineno)
+        with self._lock:
+            count = self._counts.get(key, 0) + 1
+            self._counts[key] = count
+            if count <= self.burst:
+                return True
+            suppressed = self._suppressed.get(key)
+            self._suppressed[key] = ((suppressed[0] if suppressed else 0) + 1, record)
+        return False
+
+    def flush(self, interval: float):
+        '''
+        log the count of records dropped since the last flush, and start a new interval.
+        '''
+        with self._lock:
+            suppressed = self._suppressed
+            self._counts = {}
+            self._suppressed = {}
+        for (name, _, _), (count, record) in suppressed.items():
+            logging.getLogger(name).log(
+                record.levelno, "Suppressed {} messages of {}[line:{}] in the last {:g}s, last one: {}".format(
+                    count, record.filename, record.lineno, interval, record.getMessage()),
+                extra={"summary": True})
+
+
+class LogQueueHandler(QueueHandler):
+    '''
+    Queues records of a log file for the background writer, without blocking: records are dropped if it's full.
+    '''
+
+    def __init__(self, log_queue: queue.Queue, log_file: str):
+        super().__init__(log_queue)
+        self.log_file = log_file
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = super().prepare(record)
+        record.log_file = self.log_file
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogRouter(logging.Handler):
+    '''
+    Writes the records of the background writer to the console and to their log file, in its thread only.
+    '''
+
+    def __init__(self, logs_dir: str):
+        super().__init__()
+        self.logs_dir = logs_dir
+        self._formatter = logging.Formatter(fmt=LOG_FORMAT)
+        self._stream = logging.StreamHandler()
+        self._stream.setFormatter(self._formatter)
+        self._files: Dict[str, logging.FileHandler] = {}
+
+    def emit(self, record: logging.LogRecord):
+        self._stream.handle(record)
+        log_file = getattr(record, "log_file", None)
+        if log_file is None:
+            return
+        handler = self._files.get(log_file)
+        if handler is None:
+            if not os.path.exists(self.logs_dir):
+                os.makedirs(self.logs_dir)
+            handler = self._files[log_file] = logging.FileHandler(os.path.join(self.logs_dir, log_file))
+            handler.setFormatter(self._formatter)
+        handler.handle(record)
+
+    def close(self):
+        for handler in [self._stream] + list(self._files.values()):
+            handler.close()
+        super().close()
+
+
+class LogWriter(object):
+    '''
+    Background writer of all loggers of the process: loggers only queue their records, the file and console writes
+    are done by one thread, so logging from collect doesn't wait for disk io.
+    '''
+
+    def __init__(self, logs_dir: str, burst: int = LOG_RATE_LIMIT_BURST, interval: float = LOG_RATE_LIMIT_INTERVAL):
+        self.interval = interval
+        self._queue = queue.Queue(LOG_QUEUE_SIZE)
+        self._router = LogRouter(logs_dir)
+        self._listener = QueueListener(self._queue, self._router)
+        self._rate_limit = RateLimitFilter(burst)
+        self._handlers: Dict[str, LogQueueHandler] = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._logger = logging.getLogger(__name__)
+        self._logger.addHandler(self.get_handler(LOG_FILE_DEFAULT))
+        self._listener.start()
+        threading.Thread(target=self._summarize, name="log_summary", daemon=True).start()
+        atexit.register(self.stop)
+
+    def get_handler(self, log_file: str) -> LogQueueHandler:
+        with self._lock:
+            handler = self._handlers.get(log_file)
+            if handler is None:
+                handler = self._handlers[log_file] = LogQueueHandler(self._queue, log_file)
+                handler.addFilter(self._rate_limit)
+            return handler
+
+    def stop(self):
+        '''
+        write the queued records, then stop the writer thread.
+        '''
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._rate_limit.flush(self.interval)
+        self._listener.stop()
+        self._router.close()
+
+    def _summarize(self):
+        while not self._stopped.wait(self.interval):
+            self._rate_limit.flush(self.interval)
+            dropped = sum(handler.dropped for handler in list(self._handlers.values()))
+            if dropped:
+                for handler in list(self._handlers.values()):
+                    handler.dropped = 0
+                self._logger.warning("Log queue is full, dropped {} messages".format(dropped), extra={"summary": True})
+
+
+_writer: Optional[LogWriter] = None
+_writer_lock = threading.Lock()
+
+
+def get_logger(name: str, logs_dir: str, log_file: str, level: str) -> logging.Logger:
+    '''
+    @return the logger of a name, its handler to the background writer is attached on the first call only.
+    '''
+    global _writer
+    logger = logging.getLogger(name)
+    with _writer_lock:
+        if _writer is None:
+            _writer = LogWriter(logs_dir)
+        if any(isinstance(handler, LogQueueHandler) for handler in logger.handlers):
+            return logger
+        logger.setLevel(level.upper())
+        logger.addHandler(_writer.get_handler(log_file))
+    return logger
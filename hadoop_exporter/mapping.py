@@ -1,3 +1,8 @@
+import re
+import importlib
+import functools
+from typing import Any, Callable, Dict, Optional, Union
+
 
 def fsstate(value):
     if value == "Operational":
@@ -22,3 +27,113 @@ def hastate(value):
 
 def rmstate(value):
     return hastate(value)
+
+
+# Declarative value mappings, compiled once per rule from the "mapping" field of metrics/*.yaml:
+#   mapping: hadoop_exporter.mapping.hastate     # dotted path of a mapping function
+#   mapping:
+#     regex: '^(\d+)'                            # extract the first group (or whole match) of a string value
+#     enum: {active: 1, standby: 2}              # or bool: true, to coerce true/false values to 1/0
+#     scale: 0.001                               # multiply the numeric value
+#     default: 9999                              # value used when regex, enum or bool can't map the value
+
+MAPPING_KEYS = {"regex", "enum", "bool", "scale", "default"}
+BOOL_VALUES = {"true": 1.0, "false": 0.0}
+
+
+@functools.lru_cache(maxsize=None)
+def import_function(path: str) -> Callable[[Any], Any]:
+    '''
+    import a mapping function from its dotted path, e.g. hadoop_exporter.mapping.hastate
+    '''
+    mod_name, func_name = path.rsplit('.', 1)
+    func = getattr(importlib.import_module(mod_name), func_name)
+    if not callable(func):
+        raise ValueError("mapping {} is not callable".format(path))
+    return func
+
+
+def to_number(value: Any) -> Optional[float]:
+    '''
+    resolve an unmapped attribute value: numbers (and booleans) as is, numeric strings as floats, e.g. "0.5".
+    '''
+    if isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+
+def compile_mapping(mapping: Union[None, str, Dict]) -> Callable[[Any], Optional[float]]:
+    '''
+    compile the "mapping" field of a metric rule into a resolver of attribute values.
+    the resolver returns None for values it can't map, they must not be exported.
+    @raise ValueError if the mapping is invalid, e.g. unknown keys or function not found.
+    '''
+    if mapping is None:
+        return to_number
+    if isinstance(mapping, str):
+        try:
+            func = import_function(mapping)
+        except (ImportError, AttributeError, ValueError) as e:
+            raise ValueError("invalid mapping function {}: {}".format(mapping, e))
+        return lambda value: to_number(func(value))
+    if not isinstance(mapping, dict):
+        raise ValueError("mapping must be a function path or a dict, got {!r}".format(mapping))
+
+    unknown = set(mapping) - MAPPING_KEYS
+    if unknown:
+        raise ValueError("unknown mapping keys: {}".format(", ".join(sorted(unknown))))
+    if "enum" in mapping and "bool" in mapping:
+        raise ValueError("mapping can't have both enum and bool")
+    regex = re.compile(mapping["regex"]) if "regex" in mapping else None
+    scale = _to_float(mapping.get("scale", 1), "scale")
+    default = _to_float(mapping["default"], "default") if "default" in mapping else None
+    if "enum" in mapping:
+        if not isinstance(mapping["enum"], dict):
+            raise ValueError("mapping enum must be a dict of value to number")
+        table = {_to_key(key): _to_float(number, "enum value") for key, number in mapping["enum"].items()}
+    elif mapping.get("bool"):
+        table = BOOL_VALUES
+    else:
+        table = None
+
+    def resolve(value: Any) -> Optional[float]:
+        if regex is not None:
+            if not isinstance(value, str):
+                value = str(value)
+            matched = regex.search(value)
+            if matched is None:
+                return default
+            value = matched.group(1) if regex.groups else matched.group(0)
+        if table is not None:
+            number = table.get(_to_key(value, lower=table is BOOL_VALUES))
+            if number is None:
+                return default
+        elif isinstance(value, str):
+            try:
+                number = float(value)
+            except ValueError:
+                return default
+        elif isinstance(value, (int, float)):
+            number = value
+        else:
+            return default
+        return number * scale if scale != 1 else number
+
+    return resolve
+
+
+def _to_float(value: Any, field: str) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError("mapping {} must be a number, got {!r}".format(field, value))
+    return float(value)
+
+
+def _to_key(value: Any, lower: bool = False) -> str:
+    # json and yaml booleans are decoded to True/False, compare them as "true"/"false"
+    key = str(value).lower() if isinstance(value, bool) else str(value)
+    return key.lower() if lower else key
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+PLAN_CACHE_SIZE = 16384
+
+
+class SeriesTemplate(object):
+    '''
+    The part of a series resolved by the rules from a bean attribute, which doesn't depend on the url.
+    It is completed by the common labels of each url scraping the attribute.
+    '''
+    __slots__ = ("group_pattern", "identifier", "name", "docs", "label_names", "label_values", "rule",
+                 "common_label_names")
+
+    def __init__(self, group_pattern: str, identifier: str, name: str, docs: str,
+                 label_names: List[str], label_values: List[str], rule):
+        self.group_pattern = group_pattern
+        self.identifier = identifier
+        self.name = name
+        self.docs = docs
+        self.label_names = label_names
+        self.label_values = label_values
+        self.rule = rule
+        # common label names the series was last validated with, validated again only for other names
+        self.common_label_names = None
+
+
+# bean shape: (bean name, attribute names in the order of the bean)
+Shape = Tuple[str, Tuple[str, ...]]
+# key of the plan of a shape: (groups captured from the bean name, or the bean name, sorted attribute names)
+PlanKey = Tuple[object, Tuple[str, ...]]
+# extraction plan of a shape: (attribute name, templates of its series) of the attributes matched by a rule
+Plan = Tuple[Tuple[str, Tuple[SeriesTemplate, ...]], ...]
+
+
+def get_plan_key(groups: List, shape: Shape) -> PlanKey:
+    '''
+    key of the plan of a bean shape, shared by the beans whose names differ only by parts not captured by their rule
+    groups, e.g. the host and port of Hadoop:service=DataNode,name=DataNodeActivity-<host>-<port> on each datanode.
+    rules substitute only the groups captured from the bean name, so the whole name is kept in the key if a group
+    doesn't match it to its end.
+    @param groups: The rule groups matching the bean name.
+    '''
+    bean_name, metric_names = shape
+    captures = []
+    for group in groups:
+        matched = group.regex.match(bean_name)
+        if matched is None or matched.end() != len(bean_name):
+            return bean_name, tuple(sorted(metric_names))
+        captures.append((group.index, matched.groups()))
+    return tuple(captures), tuple(sorted(metric_names))
+
+
+class PlanCache(object):
+    '''
+    LRU cache of the extraction plans of bean shapes by plan key. The beans of a homogeneous fleet, e.g. hundreds of
+    datanodes, have the same plan keys, so the rules are evaluated once per shape instead of once per url.
+    '''
+
+    def __init__(self, max_size: int = PLAN_CACHE_SIZE):
+        self.max_size = max_size
+        self._plans: "OrderedDict[PlanKey, Plan]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._plans)
+
+    def get(self, key: PlanKey) -> Optional[Plan]:
+        plan = self._plans.get(key)
+        if plan is not None:
+            self._plans.move_to_end(key)
+        return plan
+
+    def put(self, key: PlanKey, plan: Plan):
+        self._plans[key] = plan
+        self._plans.move_to_end(key)
+        while len(self._plans) > self.max_size:
+            self._plans.popitem(last=False)
@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import struct
+import threading
+import traceback
+from collections import deque
+from typing import Dict, Iterable, List, Optional
+import requests
+from prometheus_client.core import Metric
+from hadoop_exporter import utils
+from hadoop_exporter.instrumentation import RemoteWriteStats
+from hadoop_exporter.scheduler import Scheduler, ScrapeJob, SCHEDULER_JITTER_DEFAULT, build_target_status
+from hadoop_exporter.store import ColumnarMetricFamily
+
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+logger = utils.get_logger(__name__)
+
+REMOTE_WRITE_BATCH_SIZE_DEFAULT = 2000
+REMOTE_WRITE_FLUSH_INTERVAL_DEFAULT = 5
+REMOTE_WRITE_QUEUE_SIZE_DEFAULT = 100000
+REMOTE_WRITE_ENQUEUE_TIMEOUT_DEFAULT = 10
+REMOTE_WRITE_BACKOFF_DEFAULT = 1
+REMOTE_WRITE_BACKOFF_MAX_DEFAULT = 30
+# encoded label sets kept by SeriesEncoder, cleared when full
+LABELS_CACHE_SIZE = 262144
+REMOTE_WRITE_HEADERS = {
+    "Content-Encoding": "snappy",
+    "Content-Type": "application/x-protobuf",
+    "User-Agent": "hadoop_exporter",
+    "X-Prometheus-Remote-Write-Version": "0.1.0",
+}
+
+
+# varints of a single byte, e.g. field tags and lengths of label names and values
+SMALL_VARINTS = [bytes([value]) for value in range(0x80)]
+
+
+def encode_varint(value: int) -> bytes:
+    if value < 0x80:
+        return SMALL_VARINTS[value]
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def encode_string(field: int, value: str) -> bytes:
+    '''
+    length-delimited field of a protobuf message.
+    '''
+    data = value.encode("utf-8")
+    return encode_varint(field << 3 | 2) + encode_varint(len(data)) + data
+
+
+_label_names: Dict[str, bytes] = {}
+
+
+def encode_labels(labels: Dict[str, str]) -> bytes:
+    '''
+    labels of a prometheus.TimeSeries message, sorted by name as remote-write receivers expect.
+    '''
+    encoded = []
+    for name, value in sorted(labels.items()):
+        encoded_name = _label_names.get(name)
+        if encoded_name is None:
+            encoded_name = _label_names[name] = encode_string(1, name)
+        label = encoded_name + encode_string(2, value)
+        encoded.append(b"\x0a" + encode_varint(len(label)) + label)
+    return b"".join(encoded)
+
+
+def encode_series(labels: bytes, value: float, timestamp_ms: int) -> bytes:
+    '''
+    a prometheus.TimeSeries with one sample, as a timeseries field of a prometheus.WriteRequest.
+    @param labels: The labels of the series, encoded by encode_labels.
+    '''
+    sample = b"\x09" + struct.pack("<d", value) + b"\x10" + encode_varint(timestamp_ms)
+    series = labels + b"\x12" + encode_varint(len(sample)) + sample
+    return b"\x0a" + encode_varint(len(series)) + series
+
+
+class SeriesEncoder(object):
+    '''
+    Encodes samples of metric families into remote-write timeseries. The labels of a series are encoded once and
+    cached by its exposition prefix, which LabelSet already keeps across scrapes.
+    '''
+
+    def __init__(self, cache_size: int = LABELS_CACHE_SIZE):
+        self._cache_size = cache_size
+        self._labels: Dict[str, bytes] = {}
+
+    def encode(self, metrics: Iterable[Metric], timestamp: float) -> List[bytes]:
+        '''
+        @param timestamp: Unix timestamp of the samples, in seconds.
+        @return one encoded timeseries per sample, NaN values included.
+        '''
+        timestamp_ms = int(timestamp * 1000)
+        encoded = []
+        for metric in metrics:
+            if isinstance(metric, ColumnarMetricFamily):
+                name = metric.name
+                for label_names, label_sets, values in metric._columns:
+                    for label_set, value in zip(label_sets, values):
+                        prefix = label_set.get_prefix(name, label_names)
+                        labels = self._labels.get(prefix)
+                        if labels is None:
+                            if len(self._labels) >= self._cache_size:
+                                self._labels.clear()
+                            labels = self._labels[prefix] = encode_labels(
+                                dict(label_set.get_labels(label_names), __name__=name))
+                        encoded.append(encode_series(labels, value, timestamp_ms))
+                samples = metric._samples
+            else:
+                samples = metric.samples
+            for sample in samples:
+                sample_ms = timestamp_ms if sample.timestamp is None else int(float(sample.timestamp) * 1000)
+                encoded.append(encode_series(encode_labels(dict(sample.labels, __name__=sample.name)),
+                                             float(sample.value), sample_ms))
+        return encoded
+
+
+class RemoteWriter(object):
+    '''
+    RemoteWriter pushes samples to a Prometheus remote-write receiver, e.g. Prometheus, Mimir or VictoriaMetrics.
+    Pushed samples are queued, a background thread sends them in batches of batch_size series, or every flush_interval
+    seconds. A batch failing with a 5xx, a 429 or a connection error is retried with an exponential backoff, meanwhile
+    the queue fills up: when it holds queue_size series, push blocks for enqueue_timeout seconds, then the oldest
+    series are dropped.
+    '''
+
+    def __init__(self, url: str, batch_size: int = REMOTE_WRITE_BATCH_SIZE_DEFAULT,
+                 flush_interval: float = REMOTE_WRITE_FLUSH_INTERVAL_DEFAULT,
+                 queue_size: int = REMOTE_WRITE_QUEUE_SIZE_DEFAULT,
+                 enqueue_timeout: float = REMOTE_WRITE_ENQUEUE_TIMEOUT_DEFAULT,
+                 timeout: float = utils.HTTP_TIMEOUT_DEFAULT, backoff: float = REMOTE_WRITE_BACKOFF_DEFAULT,
+                 backoff_max: float = REMOTE_WRITE_BACKOFF_MAX_DEFAULT, headers: Optional[Dict[str, str]] = None):
+        '''
+        @param url: Remote-write endpoint, e.g. http://prometheus:9090/api/v1/write
+        @param batch_size: Max series sent in a request.
+        @param flush_interval: Max seconds a series waits in the queue for its batch to be full.
+        @param queue_size: Max series waiting to be sent.
+        @param enqueue_timeout: Seconds push blocks while the queue is full, before dropping the oldest series.
+        @param timeout: Timeout (seconds) of each request.
+        @param backoff: Seconds before the first retry of a failed batch, doubled on each retry.
+        @param backoff_max: Max seconds between two retries.
+        @param headers: Other http headers of requests, e.g. Authorization or X-Scope-OrgID.
+        @raise ImportError if python-snappy is not installed, remote-write requires compressed requests.
+        '''
+        if snappy is None:
+            raise ImportError("python-snappy is required to compress remote-write requests in push mode, "
+                              "install it with pip install python-snappy")
+        self.url = url
+        self._batch_size = max(1, int(batch_size))
+        self._flush_interval = flush_interval
+        self._queue_size = max(self._batch_size, int(queue_size))
+        self._enqueue_timeout = enqueue_timeout
+        self._timeout = timeout
+        self._backoff = backoff
+        self._backoff_max = backoff_max
+        self._session = utils.get_session(pool_connections=1, pool_size=1)
+        self._session.headers.update(REMOTE_WRITE_HEADERS)
+        self._session.headers.update(headers or {})
+        self._encoder = SeriesEncoder()
+        self._encoder_lock = threading.Lock()
+        self._queue: deque = deque()
+        self._sending = False
+        self._condition = threading.Condition()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="remote_writer", daemon=True)
+        self._stats = RemoteWriteStats(url)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        '''
+        stop sending, after the queued series are sent or timeout seconds.
+        '''
+        with self._condition:
+            self._stopped.set()
+            self._condition.notify_all()
+        self._thread.join(timeout)
+
+    def push(self, metrics: Iterable[Metric], timestamp: Optional[float] = None) -> int:
+        '''
+        queue the samples of metric families to be sent.
+        @param timestamp: Unix timestamp of the samples, default to now.
+        @return the number of queued series.
+        '''
+        with self._encoder_lock:
+            series = self._encoder.encode(metrics, time.time() if timestamp is None else timestamp)
+        deadline = time.monotonic() + self._enqueue_timeout
+        with self._condition:
+            # backpressure: wait for the sender to make room
+            while len(self._queue) + len(series) > self._queue_size and not self._stopped.is_set():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            self._queue.extend(series)
+            dropped = max(0, len(self._queue) - self._queue_size)
+            if dropped:
+                logger.warning("Remote-write queue is full, drop the {} oldest series".format(dropped))
+                for _ in range(dropped):
+                    self._queue.popleft()
+                self._stats.observe_samples("dropped", dropped)
+            self._stats.observe_queue(len(self._queue))
+            self._condition.notify_all()
+        return len(series) - dropped
+
+    def flush(self, timeout: float = 30) -> bool:
+        '''
+        wait until all queued series are sent.
+        @return False if series are still queued after timeout seconds.
+        '''
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            self._condition.notify_all()
+            while self._queue or self._sending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(min(remaining, 0.1))
+        return True
+
+    def _run(self):
+        while True:
+            with self._condition:
+                # wait for a full batch, or for the oldest queued series to wait flush_interval seconds
+                while not self._queue and not self._stopped.is_set():
+                    self._condition.wait()
+                deadline = time.monotonic() + self._flush_interval
+                while len(self._queue) < self._batch_size and not self._stopped.is_set():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                if not self._queue:
+                    return
+                batch = [self._queue.popleft() for _ in range(min(self._batch_size, len(self._queue)))]
+                self._sending = True
+                self._stats.observe_queue(len(self._queue))
+                self._condition.notify_all()
+            try:
+                self._send(batch)
+            finally:
+                with self._condition:
+                    self._sending = False
+                    self._condition.notify_all()
+
+    def _send(self, batch: List[bytes]):
+        '''
+        send a batch until it succeeds, is rejected by the receiver or the writer is stopped.
+        '''
+        body = snappy.compress(b"".join(batch))
+        backoff = self._backoff
+        while True:
+            started = time.perf_counter()
+            try:
+                response = self._session.post(self.url, data=body, timeout=self._timeout)
+                status = response.status_code
+                response.close()
+            except requests.RequestException as e:
+                status, error = None, e
+            else:
+                error = None
+            self._stats.observe_request(time.perf_counter() - started, status)
+            if status is not None and status < 300:
+                self._stats.observe_samples("sent", len(batch))
+                return
+            if status is not None and status < 500 and status != 429:
+                # rejected by the receiver, e.g. out of order samples, sending it again won't help
+                logger.warning("Remote-write to {} rejected {} series with status {}".format(self.url, len(batch), status))
+                self._stats.observe_samples("rejected", len(batch))
+                return
+            if self._stopped.wait(backoff):
+                logger.warning("Remote-write to {} stopped, {} series not sent".format(self.url, len(batch)))
+                self._stats.observe_samples("failed", len(batch))
+                return
+            logger.warning("Remote-write to {} failed ({}), retry in {}s".format(
+                self.url, error if error is not None else status, backoff))
+            backoff = min(self._backoff_max, backoff * 2)
+
+
+class PushScheduler(Scheduler):
+    '''
+    PushScheduler scrapes every service in background like Scheduler, and pushes each snapshot to a remote-write
+    receiver instead of serving it on /metrics.
+    '''
+
+    def __init__(self, services: List, period: float, writer: RemoteWriter, jitter: float = SCHEDULER_JITTER_DEFAULT):
+        super().__init__(services, period, jitter)
+        self._writer = writer
+
+    def _update(self, job: ScrapeJob):
+        collector = job.collector
+        status = build_target_status(
+            [(collector._cluster, collector._service, collector.get_last_success(), job.last_duration)])
+        try:
+            self._writer.push(job.snapshot + status, job.last_scrape)
+        except:
+            logger.warning("Error while pushing {}".format(collector.__class__.__name__))
+            traceback.print_exc()
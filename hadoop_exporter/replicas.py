@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import hashlib
+import traceback
+from typing import List, Optional
+from hadoop_exporter import utils
+
+logger = utils.get_logger(__name__)
+
+# seconds between two checks of the modification time of the membership file
+MEMBERSHIP_CHECK_INTERVAL = 5
+
+
+def rendezvous_score(peer: str, key: str) -> int:
+    '''
+    weight of a peer for a key, stable across processes and hosts unlike hash().
+    '''
+    return int.from_bytes(hashlib.blake2b("{}\0{}".format(peer, key).encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def get_owner(peers: List[str], cluster: str, service: str, url: str) -> str:
+    '''
+    rendezvous hashing: a target is owned by the peer with the highest score for it. When a peer is added, it takes
+    only the targets it now scores highest on, and when a peer is removed, only its targets move to other peers.
+    '''
+    key = "{}\0{}\0{}".format(cluster, service, url)
+    return max(peers, key=lambda peer: rendezvous_score(peer, key))
+
+
+def parse_peers(peers: Optional[object]) -> List[str]:
+    '''
+    @param peers: Comma separated names of peers, or a list of names.
+    '''
+    if not peers:
+        return []
+    names = peers.split(",") if isinstance(peers, str) else peers
+    return list(dict.fromkeys(str(name).strip() for name in names if str(name).strip()))
+
+
+class ReplicaSet(object):
+    '''
+    Exporter replicas sharing the same config, each one scrapes only the (cluster, service, url) targets it owns.
+    Peers are a static list, or read from a membership file listing one peer per line, re-read when it changes,
+    e.g. written by a sidecar from the pods of a statefulset.
+    '''
+
+    def __init__(self, replica: str, peers: Optional[List[str]] = None, membership_file: Optional[str] = None):
+        '''
+        @param replica: Name of this replica in the peers, e.g. the hostname of a pod of a statefulset.
+        @param peers: Names of all replicas, this one included.
+        @param membership_file: File listing the names of all replicas, one per line, instead of peers.
+        '''
+        self.replica = replica
+        self.membership_file = membership_file
+        self._peers = parse_peers(peers)
+        self._mtime = None
+        self._checked = 0.0
+        # incremented each time peers change, targets are selected again
+        self.version = 0
+        if membership_file:
+            self._read_membership()
+        if not self._peers:
+            logger.warning("No peer of replica {}, it scrapes all targets".format(replica))
+        elif replica not in self._peers:
+            logger.warning("Replica {} is not in its peers {}, it scrapes no target".format(replica, self._peers))
+
+    def get_peers(self) -> List[str]:
+        '''
+        @return the current peers, the membership file is checked at most every MEMBERSHIP_CHECK_INTERVAL seconds.
+        '''
+        if self.membership_file:
+            now = time.monotonic()
+            if now - self._checked >= MEMBERSHIP_CHECK_INTERVAL:
+                self._checked = now
+                self._read_membership()
+        return self._peers
+
+    def get_version(self) -> int:
+        self.get_peers()
+        return self.version
+
+    def _read_membership(self):
+        '''
+        read peers from the membership file if it was modified. peers are kept if it can't be read.
+        '''
+        try:
+            mtime = os.stat(self.membership_file).st_mtime
+            if mtime == self._mtime:
+                return
+            with open(self.membership_file, "r") as f:
+                peers = parse_peers([line.split("#", 1)[0] for line in f])
+        except OSError as e:
+            # warn once until the file can be read again
+            if self._mtime is not False:
+                logger.warning("Error while reading membership file {}, keep peers {}: {}".format(
+                    self.membership_file, self._peers, e))
+            self._mtime = False
+            return
+        except:
+            logger.warning("Error while reading membership file {}".format(self.membership_file))
+            traceback.print_exc()
+            return
+        self._mtime = mtime
+        if peers == self._peers:
+            return
+        logger.info("Peers of replica {} changed to {}".format(self.replica, peers))
+        self._peers = peers
+        self.version += 1
+
+    def owns(self, cluster: str, service: str, url: str) -> bool:
+        peers = self.get_peers()
+        return not peers or get_owner(peers, cluster, service, url) == self.replica
+
+    def select(self, cluster: str, service: str, urls: List[str]) -> List[str]:
+        '''
+        @return the urls of a service owned by this replica, in their order.
+        '''
+        peers = self.get_peers()
+        if not peers:
+            return list(urls)
+        selected = [url for url in urls if get_owner(peers, cluster, service, url) == self.replica]
+        logger.info("Replica {} owns {} of {} urls of {} {}".format(
+            self.replica, len(selected), len(urls), cluster, service))
+        return selected
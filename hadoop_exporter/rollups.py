@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import math
+import heapq
+import traceback
+from array import array
+from logging import Logger
+from typing import Dict, List, Optional, Sequence, Tuple
+from prometheus_client.core import Metric
+from hadoop_exporter import utils
+from hadoop_exporter.store import ColumnarMetricFamily, LabelSet
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+ROLLUP_AGGREGATIONS = ("sum", "min", "max", "mean", "count")
+ROLLUP_AGGREGATIONS_DEFAULT = ["sum", "min", "max", "mean"]
+# labels aggregated away by default: the series of all hosts of a cluster are rolled up together
+ROLLUP_WITHOUT_DEFAULT = ["host", "jmx_port"]
+QUANTILE_LABEL = "quantile"
+
+
+class RollupRule(object):
+    '''
+    A rollup of metrics/<service>.yaml: aggregates of the series of the families it matches across hosts,
+    computed by the exporter after all urls of the service are converted, e.g.
+        rollups:
+          - metric: hadoop_hdfs_datanode_fsdatasetstate_.*
+            aggregations: [sum, min, max]
+            quantiles: [0.5, 0.99]
+            topk: 5
+    '''
+    __slots__ = ("metric", "regex", "without", "aggregations", "quantiles", "topk", "drop")
+
+    def __init__(self, definition: Dict):
+        '''
+        @param definition: metric: regex matching the whole name of the families to roll up.
+                           without: labels aggregated away, default host and jmx_port.
+                           aggregations: any of sum, min, max, mean and count, default sum, min, max and mean.
+                           quantiles: quantiles to compute, between 0 and 1.
+                           topk: number of series with the highest values to keep with all their labels.
+                           drop: drop the source series, only their rollups are exported.
+        @raise ValueError if the definition is invalid.
+        '''
+        if not definition.get("metric"):
+            raise ValueError("metric is required")
+        self.metric = definition["metric"]
+        try:
+            self.regex = re.compile(self.metric)
+        except re.error as e:
+            raise ValueError("invalid metric {}: {}".format(self.metric, e))
+        self.without = set(definition.get("without", ROLLUP_WITHOUT_DEFAULT) or [])
+        self.aggregations = list(definition.get("aggregations", ROLLUP_AGGREGATIONS_DEFAULT) or [])
+        for aggregation in self.aggregations:
+            if aggregation not in ROLLUP_AGGREGATIONS:
+                raise ValueError("aggregations must be in {}, not {}".format(", ".join(ROLLUP_AGGREGATIONS), aggregation))
+        self.quantiles = sorted(float(quantile) for quantile in definition.get("quantiles") or [])
+        if any(quantile < 0 or quantile > 1 for quantile in self.quantiles):
+            raise ValueError("quantiles must be between 0 and 1")
+        self.topk = int(definition.get("topk") or 0)
+        self.drop = bool(definition.get("drop", False))
+
+    def compute(self, metric: Metric) -> List[ColumnarMetricFamily]:
+        '''
+        @return the rollup families of a family matched by this rule.
+        '''
+        columns = get_columns(metric)
+        # labels kept by the rollups, in the order of the family
+        label_names = list(dict.fromkeys(name for names, _, _ in columns for name in names if name not in self.without))
+        groups: Dict[Tuple[str, ...], int] = {}
+        group_ids, values = array('q'), array('d')
+        for names, label_sets, column_values in columns:
+            positions = [names.index(name) if name in names else -1 for name in label_names]
+            for label_set in label_sets:
+                label_values = label_set.label_values
+                key = tuple(label_values[position] if position >= 0 else "" for position in positions)
+                group_id = groups.get(key)
+                if group_id is None:
+                    group_id = groups[key] = len(groups)
+                group_ids.append(group_id)
+            values.extend(column_values)
+        if not groups:
+            return []
+        aggregates = aggregate_numpy if np is not None else aggregate_python
+        results, topk = aggregates(group_ids, values, len(groups), self.quantiles, self.topk)
+
+        families = []
+        group_label_sets = [LabelSet(list(key)) for key in groups]
+        for aggregation in self.aggregations:
+            family = ColumnarMetricFamily("{}_rollup_{}".format(metric.name, aggregation),
+                                          "{} of {} without {}".format(aggregation, metric.name, ", ".join(
+                                              sorted(self.without))), label_names)
+            for label_set, value in zip(group_label_sets, results[aggregation]):
+                family.add(label_set, value)
+            families.append(family)
+        if self.quantiles:
+            family = ColumnarMetricFamily("{}_rollup_quantile".format(metric.name), "quantiles of {} without {}".format(
+                metric.name, ", ".join(sorted(self.without))), label_names + [QUANTILE_LABEL])
+            for key, group_quantiles in zip(groups, results["quantiles"]):
+                for quantile, value in zip(self.quantiles, group_quantiles):
+                    family.add(LabelSet(list(key) + [str(quantile)]), value)
+            families.append(family)
+        if self.topk:
+            families.append(build_topk_family(metric, columns, topk, values, self.topk))
+        return families
+
+
+def get_columns(metric: Metric) -> List[Tuple[Tuple[str, ...], Sequence[LabelSet], Sequence[float]]]:
+    '''
+    @return the samples of a family as columns of (label names, label sets, values).
+    '''
+    columns = list(metric._columns) if isinstance(metric, ColumnarMetricFamily) else []
+    samples = metric._samples if isinstance(metric, ColumnarMetricFamily) else metric.samples
+    by_names: Dict[Tuple[str, ...], Tuple[List[LabelSet], array]] = {}
+    for sample in samples:
+        names = tuple(sample.labels)
+        if names not in by_names:
+            by_names[names] = ([], array('d'))
+        by_names[names][0].append(LabelSet(list(sample.labels.values())))
+        by_names[names][1].append(sample.value)
+    columns.extend((names, label_sets, values) for names, (label_sets, values) in by_names.items())
+    return columns
+
+
+def aggregate_numpy(group_ids: array, values: array, size: int, quantiles: List[float],
+                    topk: int) -> Tuple[Dict[str, Sequence[float]], List[List[int]]]:
+    '''
+    aggregate the values of each group, vectorized over all samples: values are sorted by group then by value once,
+    so min, max, quantiles and top k are read at the bounds of each group.
+    @return a tuple of (aggregates by name, each with one value per group; indexes of the top k samples of each group).
+    '''
+    ids = np.frombuffer(group_ids, dtype=np.int64)
+    data = np.frombuffer(values, dtype=np.float64)
+    order = np.lexsort((data, ids))
+    ordered = data[order]
+    counts = np.bincount(ids, minlength=size)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    sums = np.add.reduceat(ordered, starts)
+    results = {"sum": sums.tolist(), "min": ordered[starts].tolist(), "max": ordered[ends - 1].tolist(),
+               "mean": (sums / counts).tolist(), "count": counts.astype(np.float64).tolist()}
+    if quantiles:
+        # linear interpolation between the closest ranks, as numpy.quantile
+        positions = np.outer(counts - 1, quantiles)
+        lower = np.floor(positions).astype(np.int64)
+        upper = np.minimum(lower + 1, (counts - 1)[:, None])
+        low_values = ordered[starts[:, None] + lower]
+        results["quantiles"] = (low_values + (ordered[starts[:, None] + upper] - low_values) *
+                                (positions - lower)).tolist()
+    top = [order[max(start, end - topk):end][::-1].tolist() for start, end in zip(starts, ends)] if topk else []
+    return results, top
+
+
+def aggregate_python(group_ids: array, values: array, size: int, quantiles: List[float],
+                     topk: int) -> Tuple[Dict[str, Sequence[float]], List[List[int]]]:
+    '''
+    same as aggregate_numpy, without numpy.
+    '''
+    indexes: List[List[int]] = [[] for _ in range(size)]
+    for index, group_id in enumerate(group_ids):
+        indexes[group_id].append(index)
+    results = {name: [] for name in ROLLUP_AGGREGATIONS + ("quantiles",)}
+    for group_indexes in indexes:
+        ordered = sorted(values[index] for index in group_indexes)
+        count = len(ordered)
+        total = math.fsum(ordered)
+        results["sum"].append(total)
+        results["min"].append(ordered[0])
+        results["max"].append(ordered[-1])
+        results["mean"].append(total / count)
+        results["count"].append(float(count))
+        group_quantiles = []
+        for quantile in quantiles:
+            position = (count - 1) * quantile
+            lower = int(math.floor(position))
+            upper = min(lower + 1, count - 1)
+            group_quantiles.append(ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower))
+        results["quantiles"].append(group_quantiles)
+    top = [heapq.nlargest(topk, group_indexes, key=values.__getitem__) for group_indexes in indexes] if topk else []
+    return results, top
+
+
+def build_topk_family(metric: Metric, columns: List, top: List[List[int]], values: array,
+                      topk: int) -> ColumnarMetricFamily:
+    '''
+    family of the top k series of each group, with all their labels.
+    @param top: Indexes of the top k samples of each group, in the samples of all columns.
+    '''
+    # label names of a column -> label sets and values of its top k samples
+    selected = sorted(index for group_top in top for index in group_top)
+    by_names: Dict[Tuple[str, ...], Tuple[List[LabelSet], array]] = {}
+    start, position = 0, 0
+    for names, label_sets, _ in columns:
+        end = start + len(label_sets)
+        while position < len(selected) and selected[position] < end:
+            index = selected[position]
+            if names not in by_names:
+                by_names[names] = ([], array('d'))
+            by_names[names][0].append(label_sets[index - start])
+            by_names[names][1].append(values[index])
+            position += 1
+        start = end
+    family = ColumnarMetricFamily("{}_rollup_topk".format(metric.name), "top {} series of {}".format(topk, metric.name),
+                                  next(iter(by_names), ()))
+    family._columns = [(names, label_sets, topk_values) for names, (label_sets, topk_values) in by_names.items()]
+    return family
+
+
+class RollupSet(object):
+    '''
+    Rollup rules of a service, each family is rolled up by the first rule matching its name.
+    '''
+
+    def __init__(self, definitions: Optional[List[Dict]] = None, logger: Logger = None):
+        self.rules: List[RollupRule] = []
+        for definition in definitions or []:
+            try:
+                self.rules.append(RollupRule(definition))
+            except (TypeError, ValueError) as e:
+                (logger or utils.logger).warning("Invalid rollup {}: {}".format(definition, e))
+        self._matches: Dict[str, Optional[RollupRule]] = {}
+
+    def __len__(self):
+        return len(self.rules)
+
+    def match(self, name: str) -> Optional[RollupRule]:
+        if name not in self._matches:
+            self._matches[name] = next((rule for rule in self.rules if rule.regex.fullmatch(name)), None)
+        return self._matches[name]
+
+    def apply(self, metrics: List[Metric]) -> List[Metric]:
+        '''
+        @return the metrics followed by their rollups, without the source families of rules dropping them.
+        '''
+        if not self.rules:
+            return metrics
+        kept, rollups = [], []
+        for metric in metrics:
+            rule = self.match(metric.name)
+            if rule is None:
+                kept.append(metric)
+                continue
+            if not rule.drop:
+                kept.append(metric)
+            try:
+                rollups.extend(rule.compute(metric))
+            except:
+                utils.logger.warning("Error while rolling up {}".format(metric.name))
+                traceback.print_exc()
+        return kept + rollups
@@ -0,0 +1,585 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import time
+import threading
+import traceback
+from logging import Logger
+from typing import Dict, List, Optional, Tuple, Union
+from hadoop_exporter import utils
+from hadoop_exporter.cardinality import OVERFLOW_ACTIONS, OVERFLOW_DROP
+from hadoop_exporter.mapping import compile_mapping
+from hadoop_exporter.rollups import RollupSet
+
+SUPPORTED_METRIC_TYPES = ["GAUSE"]
+REGEX_META_CHARS = set(".^$*+?{}[]\\|()")
+TEMPLATE_REF_REGEX = re.compile(r"\$(\d{1,2})(?!\d)")
+OBJECT_NAME_WILDCARDS_REGEX = re.compile(r"[*?]*\*[*?]*")
+BEAN_CACHE_SIZE = 65536
+RULES_CHECK_INTERVAL = 30
+# qry of all beans, the default of the jmx servlet
+ALL_BEANS_QUERY = "*:*"
+
+
+def to_template(value) -> str:
+    '''
+    convert a rule template using $n group references to a python regex template using \\n.
+    '''
+    return str(value).replace("$", "\\")
+
+
+class Template(object):
+    '''
+    A rule template (name, label or help) parsed once into literal and group reference pieces,
+    so it can be expanded from a match without re-parsing it like re.Match.expand does.
+    '''
+    __slots__ = ("template", "pieces")
+
+    def __init__(self, value):
+        self.template = to_template(value)
+        value = str(value)
+        self.pieces = None
+        # only simple $n templates are pre-parsed, anything else is expanded by the re module
+        if "\\" not in value and "$" not in TEMPLATE_REF_REGEX.sub("", value):
+            pieces, last = [], 0
+            for ref in TEMPLATE_REF_REGEX.finditer(value):
+                if ref.start() > last:
+                    pieces.append(value[last:ref.start()])
+                pieces.append(int(ref.group(1)))
+                last = ref.end()
+            if last < len(value):
+                pieces.append(value[last:])
+            self.pieces = pieces
+
+    def expand(self, matched: re.Match) -> str:
+        if self.pieces is None:
+            return matched.expand(self.template)
+        return "".join([piece if piece.__class__ is str else (matched.group(piece) or "")
+                        for piece in self.pieces])
+
+
+def has_top_level_alternation(pattern: str) -> bool:
+    depth, in_class, i = 0, False, 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            i += 2
+            continue
+        if in_class:
+            if c == "]":
+                in_class = False
+        elif c == "[":
+            in_class = True
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "|" and depth == 0:
+            return True
+        i += 1
+    return False
+
+
+def literal_prefix(pattern: str) -> str:
+    '''
+    get the literal text that every string matched (re.match) by the pattern must start with.
+    @param pattern: a group pattern defined in metrics/*.yaml, e.g. "Hadoop:service=NameNode,name=(FSNamesystem)$"
+    @return the literal prefix, e.g. "Hadoop:service=NameNode,name=". An empty string means no prefix can be guaranteed.
+    '''
+    if has_top_level_alternation(pattern):
+        return ""
+    prefix = []
+    for c in pattern[1:] if pattern.startswith("^") else pattern:
+        if c in "*?{":
+            # the previous character is optional
+            prefix = prefix[:-1]
+            break
+        if c in REGEX_META_CHARS:
+            break
+        prefix.append(c)
+    return "".join(prefix)
+
+
+def find_group_end(pattern: str, start: int) -> int:
+    '''
+    @return the index of the parenthesis closing the group opened at start, -1 if not found.
+    '''
+    depth, in_class, i = 0, False, start
+    while i < len(pattern):
+        c = pattern[i]
+        if c == "\\":
+            i += 2
+            continue
+        if in_class:
+            if c == "]":
+                in_class = False
+        elif c == "[":
+            in_class = True
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+            if depth == 0:
+                return i
+        i += 1
+    return -1
+
+
+def translate_to_object_name(pattern: str) -> Optional[Tuple[str, bool]]:
+    '''
+    translate a regex fragment to an ObjectName pattern matching a superset of it.
+    @return a tuple of (pattern, whether a wildcard may match ","), None if the fragment can't be expressed.
+    '''
+    atoms, spans, i = [], False, 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c in "*+?{":
+            # any quantified atom becomes a wildcard
+            if not atoms:
+                return None
+            if c == "{":
+                i = pattern.find("}", i)
+                if i < 0:
+                    return None
+            atoms[-1] = "*"
+            i += 1
+            if i < len(pattern) and pattern[i] in "?+":
+                i += 1
+            continue
+        if c == "\\":
+            if i + 1 >= len(pattern):
+                return None
+            d = pattern[i + 1]
+            if d in "dwsDWS":
+                atoms.append("?")
+                spans = spans or d in "DWS"
+            elif d.isalnum() or d in "*?\"\n":
+                return None
+            else:
+                atoms.append(d)
+            i += 2
+            continue
+        if c == ".":
+            atoms.append("?")
+            spans = True
+        elif c == "[":
+            end = i + 2 if pattern[i + 1:i + 3] in ("]", "^]") else i + 1
+            while end < len(pattern) and pattern[end] != "]":
+                end += 2 if pattern[end] == "\\" else 1
+            if end >= len(pattern):
+                return None
+            atoms.append("?")
+            spans = spans or pattern[i + 1] == "^" or "," in pattern[i:end]
+            i = end
+        elif c == "(":
+            end = find_group_end(pattern, i)
+            if end < 0:
+                return None
+            inner = pattern[i + 1:end]
+            if inner.startswith("?:"):
+                inner = inner[2:]
+            elif inner.startswith("?"):
+                return None
+            if has_top_level_alternation(inner):
+                atoms.append("*")
+                spans = True
+            else:
+                translated = translate_to_object_name(inner)
+                if translated is None:
+                    return None
+                atoms.append(translated[0])
+                spans = spans or translated[1]
+            i = end
+        elif c in "|^$)\"\n":
+            return None
+        else:
+            atoms.append(c)
+        i += 1
+    return "".join(atoms), spans
+
+
+def to_object_name_pattern(pattern: str) -> Optional[str]:
+    '''
+    translate a group pattern to a JMX ObjectName pattern usable in the qry parameter of the hadoop jmx servlet.
+    Every bean name matched by the group pattern is matched by the ObjectName pattern, not the other way around.
+    @param pattern: a group pattern defined in metrics/*.yaml, e.g. "Hadoop:service=.+,name=(JvmMetrics)"
+    @return ObjectName pattern, e.g. "Hadoop:service=*,name=JvmMetrics*,*". None if the pattern can't be expressed.
+    '''
+    if has_top_level_alternation(pattern):
+        return None
+    body = pattern[1:] if pattern.startswith("^") else pattern
+    anchored = body.endswith("$") and not body.endswith("\\$")
+    translated = translate_to_object_name(body[:-1] if anchored else body)
+    if translated is None:
+        return None
+    query, spans = translated
+    if not anchored:
+        query += "*"
+    query = OBJECT_NAME_WILDCARDS_REGEX.sub("*", query)
+    domain, sep, properties = query.partition(":")
+    if not domain or not sep or not properties:
+        return None
+    for prop in properties.split(","):
+        key, eq, value = prop.partition("=")
+        if not key or not eq or not value or "*" in key or "?" in key or "=" in value:
+            return None
+    if not anchored or spans:
+        # match beans having more properties than the pattern
+        query += ",*"
+    return query
+
+
+def object_name_pattern_regex(query: str):
+    '''
+    a conservative regex matching ObjectName patterns (as text) that are covered by the query.
+    '''
+    if query.endswith(":*"):
+        # all beans of a domain, e.g. Hadoop:*
+        return re.compile("".join("[^:]*" if c == "*" else "[^:*]" if c == "?" else re.escape(c)
+                                  for c in query[:-1]) + ".*$")
+    list_pattern = query.endswith(",*")
+    base = query[:-2] if list_pattern else query
+    regex = "".join("[^,]*" if c == "*" else "[^,*]" if c == "?" else re.escape(c) for c in base)
+    return re.compile(regex + ("(,.*)?" if list_pattern else "") + "$")
+
+
+def minimize_queries(queries: List[str]) -> List[str]:
+    '''
+    remove queries covered by a more general query in the list.
+    '''
+    unique = list(dict.fromkeys(queries))
+    regexes = {query: object_name_pattern_regex(query) for query in unique}
+
+    def covers(general, specific):
+        return general != specific and regexes[general].match(specific) is not None
+
+    return [query for query in unique
+            if not any(covers(other, query) and not covers(query, other) for other in unique)]
+
+
+def merge_queries(queries: List[str], by_domain: bool = False) -> List[str]:
+    '''
+    merge queries of the same JMX domain and first key property into one query, e.g.
+    Hadoop:service=NameNode,name=FSNamesystem and Hadoop:service=NameNode,name=JvmMetrics* into Hadoop:service=NameNode,*
+    so a service is fetched by a few requests, each one fetching more beans than needed.
+    @param by_domain: merge queries of the same domain, e.g. into Hadoop:*
+    '''
+    merged: Dict[str, List[str]] = {}
+    for query in queries:
+        domain, _, properties = query.partition(":")
+        prefix = domain + ":" if by_domain else "{}:{},".format(domain, properties.split(",")[0])
+        merged.setdefault(prefix, []).append(query)
+    return minimize_queries([group[0] if len(group) == 1 else prefix + "*" for prefix, group in merged.items()])
+
+
+class CompiledRule(object):
+    '''
+    A metric rule of a rule group with all regexes and substitution templates compiled once.
+    '''
+    __slots__ = ("definition", "type", "pattern", "combined", "name", "label_names",
+                 "sorted_label_names", "label_templates", "help", "mapping", "resolve", "max_series", "overflow")
+
+    def __init__(self, group_pattern: str, definition: Dict):
+        self.definition = definition
+        self.type = definition["type"]
+        self.pattern = re.compile(definition["pattern"])
+        self.combined = re.compile("{}<>{}".format(
+            group_pattern.rstrip("$"), definition["pattern"].lstrip("^")))
+        self.name = Template(definition["name"])
+        labels = definition.get("labels") or {}
+        self.label_names = list(labels.keys())
+        self.sorted_label_names = sorted(self.label_names)
+        self.label_templates = [Template(label) for label in labels.values()]
+        self.help = Template(definition["help"]) if "help" in definition else None
+        self.mapping = definition.get("mapping", None)
+        # resolver of attribute values, returns None for values which can't be exported
+        self.resolve = compile_mapping(self.mapping)
+        # series budget of the rule in each collector, 0 for no limit
+        self.max_series = int(definition.get("max_series") or 0)
+        self.overflow = definition.get("overflow", OVERFLOW_DROP)
+        if self.overflow not in OVERFLOW_ACTIONS:
+            raise ValueError("overflow must be one of {}, not {}".format(", ".join(OVERFLOW_ACTIONS), self.overflow))
+
+    def substitute(self, bean_name: str, metric_name: str) -> Tuple[str, List[str], Optional[str]]:
+        '''
+        resolve metric name, label values and help of a bean attribute matched by this rule.
+        @return a tuple of (name, label values, help). help is None if the rule has no help.
+        '''
+        concat_str = "{}<>{}".format(bean_name, metric_name)
+        matched = self.combined.search(concat_str)
+        if matched is not None and matched.start() == 0 and matched.end() == len(concat_str):
+            def expand(template): return template.expand(matched)
+        else:
+            # keep the exact re.sub semantic for partial matches
+            def expand(template): return self.combined.sub(template.template, concat_str)
+        return (expand(self.name),
+                [expand(label) for label in self.label_templates],
+                expand(self.help) if self.help is not None else None)
+
+
+class RuleGroup(object):
+    '''
+    A group pattern matched against bean names with its list of compiled metric rules.
+    A group is defined by its list of rules, or by a dict with its rules and its refresh policy:
+        Hadoop:service=NameNode,name=(NameNodeInfo)$:
+          refresh: 60  # seconds between two fetches of the beans of the group, cached meanwhile
+          rules:
+            - pattern: ...
+    '''
+
+    def __init__(self, index: int, pattern: str, definitions: Union[List[Dict], Dict], logger: Logger):
+        self.index = index
+        self.pattern = pattern
+        self.regex = re.compile(pattern)
+        self.prefix = literal_prefix(pattern)
+        # 0 to fetch beans of the group on every scrape
+        self.refresh = 0.0
+        if isinstance(definitions, dict):
+            try:
+                self.refresh = max(0.0, float(definitions.get("refresh") or 0))
+            except (TypeError, ValueError):
+                logger.warning("Invalid refresh {} of group {}, fetched on every scrape".format(
+                    definitions.get("refresh"), pattern))
+            definitions = definitions.get("rules")
+        self.rules: List[CompiledRule] = []
+        for definition in definitions or []:
+            if definition.get("type") not in SUPPORTED_METRIC_TYPES:
+                logger.warning("Metric type {} not supported currently".format(definition.get("type")))
+                continue
+            try:
+                self.rules.append(CompiledRule(pattern, definition))
+            except (re.error, ValueError) as e:
+                logger.warning("Invalid metric rule {} of group {}: {}".format(definition.get("pattern"), pattern, e))
+
+    def find_rule(self, metric_name: str) -> Optional[CompiledRule]:
+        for rule in self.rules:
+            if rule.pattern.match(metric_name):
+                return rule
+        return None
+
+
+class RuleSet(object):
+    '''
+    RuleSet compiles the rules of metrics/*.yaml once and dispatches each bean to its candidate rule groups
+    through a literal prefix index instead of trying every group regex.
+    '''
+
+    def __init__(self, rules: Dict[str, List[Dict]], logger: Logger = None):
+        '''
+        @param rules: mapping of group pattern to list of metric rules, as defined in the "rules" field of metrics/*.yaml
+        '''
+        self.groups = [RuleGroup(i, pattern, definitions, logger or utils.logger)
+                       for i, (pattern, definitions) in enumerate(rules.items())]
+        self._prefix_index: Dict[str, List[RuleGroup]] = {}
+        self._unindexed: List[RuleGroup] = []
+        for group in self.groups:
+            if group.prefix:
+                self._prefix_index.setdefault(group.prefix, []).append(group)
+            else:
+                self._unindexed.append(group)
+        self._prefix_lengths = sorted(set(len(prefix) for prefix in self._prefix_index))
+        self._bean_cache: Dict[str, List[RuleGroup]] = {}
+
+    def __iter__(self):
+        return iter(self.groups)
+
+    def __len__(self):
+        return len(self.groups)
+
+    def has_series_budgets(self) -> bool:
+        return any(rule.max_series > 0 for group in self.groups for rule in group.rules)
+
+    def get_queries(self, extra_patterns: List[str] = [], max_queries: Optional[int] = None) -> Optional[List[str]]:
+        '''
+        derive the smallest list of ObjectName patterns (jmx qry) fetching all beans matched by any group.
+        @param extra_patterns: other bean name patterns to fetch, e.g. beans used to resolve common labels.
+        @param max_queries: Max number of queries fetched on every scrape, they are merged by JMX domain to stay below it.
+        @return list of queries, None if a pattern can't be expressed or more than max_queries queries are needed,
+                so all beans must be fetched in one request.
+        '''
+        queries = self.get_refresh_queries(extra_patterns, max_queries)
+        return None if queries is None else [query for query, _ in queries]
+
+    def get_refresh_queries(self, extra_patterns: List[str] = [],
+                            max_queries: Optional[int] = None) -> Optional[List[Tuple[str, float]]]:
+        '''
+        same as get_queries, with the refresh of each query. queries of groups with a refresh are never merged
+        nor dropped when they are covered by a query fetched on every scrape, and don't count in max_queries:
+        the beans of their groups are dropped from the results of faster queries, see get_refresh.
+        @param extra_patterns: other bean name patterns to fetch on every scrape.
+        @return list of (query, refresh seconds), queries fetched on every scrape first, None if all beans must be
+                fetched on every scrape.
+        '''
+        refreshes: Dict[str, float] = {}
+        for pattern, refresh in [(group.pattern, group.refresh) for group in self.groups] + \
+                [(pattern, 0.0) for pattern in extra_patterns]:
+            query = to_object_name_pattern(pattern)
+            if query is None:
+                return None
+            refreshes[query] = min(refresh, refreshes.get(query, refresh))
+
+        slow_queries = []
+        for slow_refresh in sorted(set(refreshes.values()) - {0}):
+            slow_queries.extend((query, slow_refresh) for query in minimize_queries(
+                [query for query, refresh in refreshes.items() if refresh == slow_refresh]))
+        queries = minimize_queries([query for query, refresh in refreshes.items() if refresh == 0])
+        if max_queries is not None:
+            # a request per query multiplies the load of the jmx servers, queries are merged while they are too many
+            for by_domain in (False, True):
+                if len(queries) <= max_queries:
+                    break
+                queries = merge_queries(queries, by_domain)
+            if len(queries) > max_queries:
+                if not slow_queries:
+                    return None
+                # all beans on every scrape, groups with a refresh are still fetched by their own queries
+                queries = [ALL_BEANS_QUERY]
+        return [(query, 0.0) for query in queries] + slow_queries
+
+    def get_refresh(self, bean_name: str) -> float:
+        '''
+        @return the seconds between two fetches of a bean: the smallest refresh of the groups matching it,
+                0 if it's matched by no group, e.g. a bean of common labels.
+        '''
+        return min((group.refresh for group in self.match(bean_name)), default=0.0)
+
+    def match(self, bean_name: str) -> List[RuleGroup]:
+        '''
+        get all rule groups matching the bean name, in the order they are defined.
+        '''
+        groups = self._bean_cache.get(bean_name)
+        if groups is not None:
+            return groups
+
+        candidates = list(self._unindexed)
+        for length in self._prefix_lengths:
+            candidates.extend(self._prefix_index.get(bean_name[:length], ()))
+        groups = sorted((group for group in candidates if group.regex.match(bean_name)),
+                        key=lambda group: group.index)
+
+        if len(self._bean_cache) >= BEAN_CACHE_SIZE:
+            self._bean_cache.clear()
+        self._bean_cache[bean_name] = groups
+        return groups
+
+
+class ServiceRules(object):
+    '''
+    Compiled rules of a service: rules of metrics/<service>.yaml merged with metrics/common.yaml,
+    and the rollups of metrics/<service>.yaml.
+    It is shared by all collectors of the service and must not be modified.
+    '''
+    __slots__ = ("service", "rule_set", "lower_name", "lower_label", "mtimes", "rollups")
+
+    def __init__(self, service: str, rule_set: RuleSet, lower_name: bool, lower_label: bool,
+                 mtimes: Tuple, rollups: Optional[RollupSet] = None):
+        self.service = service
+        self.rule_set = rule_set
+        self.lower_name = lower_name
+        self.lower_label = lower_label
+        self.mtimes = mtimes
+        self.rollups = rollups or RollupSet()
+
+
+class RuleRegistry(object):
+    '''
+    Process-wide registry of compiled rules keyed by service name, so each rule file is parsed and compiled
+    once whatever the number of clusters and collectors.
+    Rules are reloaded when a rule file changes (mtime checked at most every check_interval seconds)
+    or after invalidate() is called, e.g. on SIGHUP.
+    '''
+
+    def __init__(self, metrics_dir: str, check_interval: float = RULES_CHECK_INTERVAL, logger: Logger = None):
+        '''
+        @param metrics_dir: Directory of the rule files <service>.yaml and common.yaml.
+        @param check_interval: Minimum interval (seconds) between two mtime checks of the rule files of a service.
+        '''
+        self._metrics_dir = metrics_dir
+        self._check_interval = check_interval
+        self._logger = logger or utils.logger
+        self._lock = threading.Lock()
+        self._rules: Dict[str, ServiceRules] = {}
+        self._checked: Dict[str, float] = {}
+
+    def get(self, service: str) -> ServiceRules:
+        '''
+        get the compiled rules of a service, compile them on first use or if their files changed.
+        '''
+        rules = self._rules.get(service)
+        now = time.monotonic()
+        if rules is not None and now - self._checked.get(service, 0) < self._check_interval:
+            return rules
+        with self._lock:
+            rules = self._rules.get(service)
+            if rules is None or rules.mtimes != self._get_mtimes(service):
+                try:
+                    loaded = self._load(service)
+                except:
+                    if rules is None:
+                        raise
+                    # keep serving the previous rules until the files are fixed
+                    self._logger.warning("Error while reloading rules of service {}".format(service))
+                    traceback.print_exc()
+                else:
+                    if rules is not None:
+                        self._logger.info("Reloaded rules of service {}".format(service))
+                    rules = self._rules[service] = loaded
+            self._checked[service] = now
+            return rules
+
+    def invalidate(self):
+        '''
+        force the rule files of all services to be checked on next get.
+        '''
+        with self._lock:
+            self._checked.clear()
+
+    def _get_paths(self, service: str) -> List[str]:
+        return [os.path.join(self._metrics_dir, f"{service}.yaml"), os.path.join(self._metrics_dir, "common.yaml")]
+
+    def _get_mtimes(self, service: str) -> Tuple:
+        mtimes = []
+        for path in self._get_paths(service):
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                mtimes.append(None)
+        return tuple(mtimes)
+
+    def _load(self, service: str) -> ServiceRules:
+        mtimes = self._get_mtimes(service)
+        service_path, common_path = self._get_paths(service)
+        cfg = utils.read_yaml_file(service_path) or {}
+        common_cfg = utils.read_yaml_file(common_path) or {}
+        rules = dict(cfg.get("rules") or {})
+        rules.update(common_cfg.get("rules") or {})
+        return ServiceRules(service, RuleSet(rules, self._logger),
+                            cfg.get("lowercaseOutputName", True), cfg.get("lowercaseOutputLabel", True),
+                            mtimes, RollupSet(cfg.get("rollups"), self._logger))
+
+
+_registries: Dict[str, RuleRegistry] = {}
+_registries_lock = threading.Lock()
+
+
+def get_rule_registry(metrics_dir: str) -> RuleRegistry:
+    '''
+    get the process-wide rule registry of a metrics directory.
+    '''
+    with _registries_lock:
+        registry = _registries.get(metrics_dir)
+        if registry is None:
+            registry = _registries[metrics_dir] = RuleRegistry(metrics_dir)
+        return registry
+
+
+def invalidate_rule_registries():
+    '''
+    force the rule files of all registries to be checked on next use, e.g. on SIGHUP.
+    '''
+    with _registries_lock:
+        registries = list(_registries.values())
+    for registry in registries:
+        registry.invalidate()
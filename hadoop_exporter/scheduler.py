@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import random
+import asyncio
+import threading
+import traceback
+from typing import Dict, Iterable, List, Optional, Tuple
+from prometheus_client.core import GaugeMetricFamily, Metric
+from hadoop_exporter import utils
+from hadoop_exporter.common import MetricCollector
+from hadoop_exporter.store import ColumnarMetricFamily
+
+logger = utils.get_logger(__name__)
+
+SCHEDULER_JITTER_DEFAULT = 0.1
+
+
+class ScrapeJob(object):
+    '''
+    ScrapeJob scrapes a collector in a background thread every period (+/- jitter) and keeps its last snapshot.
+    '''
+
+    def __init__(self, collector: MetricCollector, period: float, jitter: float, on_snapshot):
+        '''
+        @param collector: The collector to scrape.
+        @param period: Interval (seconds) between two scrapes.
+        @param jitter: Random fraction of period added to or removed from each interval, to spread load on jmx services.
+        @param on_snapshot: Callback called with the job after each scrape.
+        '''
+        self.collector = collector
+        self.period = period
+        self.jitter = jitter
+        self.snapshot: List[Metric] = []
+        self.last_scrape = None
+        self.last_duration = None
+        self._on_snapshot = on_snapshot
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=f"{collector._prefix}_scheduler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def scrape(self):
+        start = time.time()
+        try:
+            self.snapshot = list(self.collector.collect())
+        except:
+            logger.warning("Error while scraping {}".format(self.collector.__class__.__name__))
+            traceback.print_exc()
+        self.last_scrape = time.time()
+        self.last_duration = self.last_scrape - start
+        self._on_snapshot(self)
+
+    def _run(self):
+        # spread first scrapes of all jobs over the jitter window
+        next_run = time.time() + random.uniform(0, self.period * self.jitter)
+        while not self._stopped.wait(max(0, next_run - time.time())):
+            self.scrape()
+            next_run += self.period * (1 + random.uniform(-self.jitter, self.jitter))
+            # skip missed runs if the scrape took longer than the period
+            next_run = max(next_run, time.time())
+
+
+class Scheduler(object):
+    '''
+    Scheduler scrapes every service in background and serves /metrics from the merged snapshot of all jobs,
+    so a prometheus pull never waits for jmx services.
+    '''
+
+    def __init__(self, services: List, period: float, jitter: float = SCHEDULER_JITTER_DEFAULT):
+        '''
+        @param services: List of Service to scrape.
+        @param period: Default interval (seconds) between two scrapes of a service, if not set on the service.
+        @param jitter: Random fraction of period added to or removed from each interval.
+        '''
+        self._services = services
+        self._period = period
+        self._jitter = jitter
+        self._jobs: List[ScrapeJob] = []
+        self._lock = threading.Lock()
+        self._exposition: List[Metric] = []
+
+    def start(self):
+        for service in self._services:
+            job = ScrapeJob(service.build(), service.period or self._period, self._jitter, self._update)
+            logger.info("schedule {} listen from {} every {}s".format(
+                service.collector.__name__, service.urls, job.period))
+            self._jobs.append(job)
+        for job in self._jobs:
+            job.start()
+
+    def stop(self):
+        for job in self._jobs:
+            job.stop()
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        exposition = self._exposition
+        for metric in exposition:
+            yield metric
+        for metric in self._collect_target_status():
+            yield metric
+
+    def _update(self, job: ScrapeJob):
+        '''
+        rebuild the merged exposition from the snapshots of all jobs.
+        '''
+        with self._lock:
+            self._exposition = merge_metrics(j.snapshot for j in self._jobs)
+
+    def _collect_target_status(self):
+        return build_target_status(
+            [(job.collector._cluster, job.collector._service, job.collector.get_last_success(), job.last_duration)
+             for job in self._jobs])
+
+
+def merge_metrics(snapshots: Iterable[List[Metric]]) -> List[Metric]:
+    '''
+    merge snapshots of metrics, metrics with the same name from different snapshots are merged into one family.
+    columns of ColumnarMetricFamily are shared by the merged family, not copied.
+    '''
+    merged: Dict[str, Metric] = {}
+    for snapshot in snapshots:
+        for metric in snapshot:
+            existing = merged.get(metric.name)
+            if existing is None:
+                merged[metric.name] = metric
+                continue
+            if isinstance(existing, ColumnarMetricFamily) and isinstance(metric, ColumnarMetricFamily):
+                merged[metric.name] = existing.merge(metric)
+                continue
+            combined = Metric(existing.name, existing.documentation, existing.type)
+            combined.samples = existing.samples + metric.samples
+            merged[metric.name] = combined
+    return list(merged.values())
+
+
+async def collect_async(collectors: List[MetricCollector]) -> List[Metric]:
+    '''
+    scrape the collectors concurrently in the running event loop, their metrics are merged as the snapshots of jobs.
+    '''
+    results = await asyncio.gather(*[collector.collect_async() for collector in collectors], return_exceptions=True)
+    snapshots = []
+    for collector, result in zip(collectors, results):
+        if isinstance(result, Exception):
+            logger.warning("Error while scraping {}".format(collector.__class__.__name__))
+            traceback.print_exception(type(result), result, result.__traceback__)
+            continue
+        snapshots.append(result)
+    return merge_metrics(snapshots)
+
+
+def build_target_status(statuses: List[Tuple[str, str, Dict[str, Optional[float]], Optional[float]]]) -> List[Metric]:
+    '''
+    build the status metrics of background scrapes.
+    @param statuses: list of (cluster, service, last success timestamp by url, duration of the last scrape).
+    '''
+    labels = ["cluster", "service", "url"]
+    last_success = GaugeMetricFamily(
+        "hadoop_exporter_last_success_timestamp_seconds",
+        "unix timestamp of the last successful scrape of the target", labels=labels)
+    staleness = GaugeMetricFamily(
+        "hadoop_exporter_staleness_seconds",
+        "seconds since the last successful scrape of the target, -1 if never succeeded", labels=labels)
+    last_duration = GaugeMetricFamily(
+        "hadoop_exporter_scrape_duration_seconds",
+        "duration of the last background scrape of the service", labels=["cluster", "service"])
+    now = time.time()
+    for cluster, service, last_successes, duration in statuses:
+        for url, timestamp in last_successes.items():
+            label_values = [cluster, service, url]
+            if timestamp is None:
+                staleness.add_metric(label_values, -1)
+            else:
+                last_success.add_metric(label_values, timestamp)
+                staleness.add_metric(label_values, now - timestamp)
+        if duration is not None:
+            last_duration.add_metric([cluster, service], duration)
+    return [last_success, staleness, last_duration]
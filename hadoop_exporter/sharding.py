@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import copy
+import queue
+import threading
+import traceback
+import multiprocessing
+from typing import Dict, List, Optional, Tuple
+from prometheus_client.core import Metric
+from prometheus_client.samples import Sample
+from hadoop_exporter import utils
+from hadoop_exporter.instrumentation import ExporterMetrics
+from hadoop_exporter.store import ColumnarMetricFamily, LabelSet
+from hadoop_exporter.scheduler import Scheduler, ScrapeJob, SCHEDULER_JITTER_DEFAULT, build_target_status, merge_metrics
+from hadoop_exporter.rules import get_rule_registry
+from hadoop_exporter.rollups import RollupSet
+from hadoop_exporter.discovery import TargetDiscovery, DISCOVERY_INTERVAL_DEFAULT
+from hadoop_exporter import common
+
+logger = utils.get_logger(__name__)
+
+# seconds between two checks of dead workers and of the parent process by workers
+SHARD_MONITOR_INTERVAL = 5
+
+
+def split_urls(urls: List[str], parts: int) -> List[List[str]]:
+    '''
+    split urls into at most parts balanced chunks, keeping their order.
+    '''
+    parts = max(1, min(parts, len(urls)))
+    size, extra = divmod(len(urls), parts)
+    chunks, start = [], 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        chunks.append(urls[start:end])
+        start = end
+    return chunks
+
+
+def get_discovery(service) -> Optional[TargetDiscovery]:
+    '''
+    @return the discovery of the urls of a service, None if its urls are not discovered.
+    '''
+    if not service.options.get("discover_from"):
+        return None
+    return TargetDiscovery(service.collector.SERVICE, service.options["discover_from"],
+                           service.options.get("discovery_interval", DISCOVERY_INTERVAL_DEFAULT),
+                           service.options.get("timeout", utils.HTTP_TIMEOUT_DEFAULT))
+
+
+def resolve_discovery(service, discovered_urls: Optional[List[str]]):
+    '''
+    workers scrape a fixed part of the urls of a service, so urls of a service with discovery are discovered
+    by the front end, which assigns the shards again when they change.
+    @param discovered_urls: Urls discovered for the service, None if they are not discovered yet.
+    @return the service with its configured and discovered urls, without discovery.
+    '''
+    if not service.options.get("discover_from"):
+        return service
+    urls = service.urls.split(",") if isinstance(service.urls, str) else list(service.urls)
+    resolved = copy.copy(service)
+    resolved.urls = list(dict.fromkeys([url.rstrip("/") for url in urls if url] + (discovered_urls or [])))
+    resolved.options = {key: value for key, value in service.options.items()
+                        if key not in ("discover_from", "discovery_interval")}
+    return resolved
+
+
+def assign_shards(services: List, workers: int) -> List[List]:
+    '''
+    spread services across workers. urls of a service are split so a large fleet (e.g. datanodes) is converted
+    by all workers, then each part is assigned to the least loaded worker by number of urls.
+    rollups are computed by the front end on the merged snapshots, not by workers.
+    @return a list of services per worker, each service has a subset of the urls of a configured service.
+    '''
+    units = []
+    for service in services:
+        urls = service.urls.split(",") if isinstance(service.urls, str) else list(service.urls)
+        for chunk in split_urls(urls, workers):
+            unit = copy.copy(service)
+            unit.urls = chunk
+            unit.options = dict(service.options, rollups=False)
+            units.append(unit)
+    shards, loads = [[] for _ in range(workers)], [0] * workers
+    for unit in sorted(units, key=lambda unit: len(unit.urls), reverse=True):
+        index = loads.index(min(loads))
+        shards[index].append(unit)
+        loads[index] += len(unit.urls)
+    return [shard for shard in shards if shard]
+
+
+def encode_metrics(metrics: List[Metric], extra_labels: Optional[Dict[str, str]] = None) -> List[Tuple]:
+    '''
+    encode converted metrics into plain tuples, cheap to pickle between processes.
+    values of ColumnarMetricFamily are sent as arrays, with the label values of each sample.
+    @param extra_labels: labels added to all samples.
+    '''
+    if extra_labels:
+        return [(metric.name, metric.documentation, metric.type,
+                 [(sample.name, dict(sample.labels, **extra_labels), sample.value) for sample in metric.samples],
+                 None)
+                for metric in metrics]
+    encoded = []
+    for metric in metrics:
+        if isinstance(metric, ColumnarMetricFamily):
+            encoded.append((metric.name, metric.documentation, metric.type,
+                            [(sample.name, sample.labels, sample.value) for sample in metric._samples],
+                            [(label_names, [label_set.label_values for label_set in label_sets], values)
+                             for label_names, label_sets, values in metric._columns]))
+        else:
+            encoded.append((metric.name, metric.documentation, metric.type,
+                            [(sample.name, sample.labels, sample.value) for sample in metric.samples], None))
+    return encoded
+
+
+def decode_metrics(encoded: List[Tuple]) -> List[Metric]:
+    metrics = []
+    for name, documentation, typ, samples, columns in encoded:
+        if columns is None:
+            metric = Metric(name, documentation, typ)
+        else:
+            metric = ColumnarMetricFamily(name, documentation, columns[0][0] if columns else [], typ)
+            metric._columns = [(label_names, [LabelSet(label_values) for label_values in label_values_list], values)
+                               for label_names, label_values_list, values in columns]
+        metric.samples = [Sample(sample_name, labels, value, None) for sample_name, labels, value in samples]
+        metrics.append(metric)
+    return metrics
+
+
+def merge_statuses(statuses: List[Tuple]) -> List[Tuple]:
+    '''
+    merge scrape statuses of the parts of a service split across shards, its duration is the one of the slowest part.
+    '''
+    merged: Dict[Tuple[str, str], Tuple] = {}
+    for cluster, service, last_success, duration in statuses:
+        key = (cluster, service)
+        if key not in merged:
+            merged[key] = (cluster, service, dict(last_success), duration)
+            continue
+        _, _, merged_last_success, merged_duration = merged[key]
+        merged_last_success.update(last_success)
+        if duration is not None and (merged_duration is None or duration > merged_duration):
+            merged[key] = (cluster, service, merged_last_success, duration)
+    return list(merged.values())
+
+
+class ShardWorker(Scheduler):
+    '''
+    ShardWorker scrapes its shard of services in a worker process and sends each converted snapshot to the front end.
+    '''
+
+    def __init__(self, generation: int, index: int, services: List, period: float, jitter: float, results):
+        super().__init__(services, period, jitter)
+        self._generation = generation
+        self._index = index
+        self._results = results
+        self._exporter_metrics = ExporterMetrics()
+
+    def _update(self, job: ScrapeJob):
+        collector = job.collector
+        status = (collector._cluster, collector._service, collector.get_last_success(), job.last_duration)
+        # stages of a service split across shards would be duplicated series without a shard label
+        self._results.put((self._generation, self._index, self._jobs.index(job), encode_metrics(job.snapshot), status,
+                           encode_metrics(self._exporter_metrics.collect(), {"shard": str(self._index)})))
+
+
+def run_shard(generation: int, index: int, services: List, period: float, jitter: float, results):
+    '''
+    entrypoint of a worker process, stops when the front end process exits.
+    @param generation: Number of the assignment of the shards, snapshots of the workers of a previous one are dropped.
+    '''
+    parent = os.getppid()
+    worker = ShardWorker(generation, index, services, period, jitter, results)
+    worker.start()
+    stopped = threading.Event()
+    while not stopped.wait(SHARD_MONITOR_INTERVAL):
+        if os.getppid() != parent:
+            break
+    worker.stop()
+
+
+class ShardedScheduler(object):
+    '''
+    ShardedScheduler spreads services (and the urls of large services) across worker processes, so conversion
+    isn't bound to one core by the GIL. Workers scrape in background and send converted snapshots,
+    which are merged and served by the front end like Scheduler. The merged exposition is rebuilt on collect,
+    only if snapshots were received since the last one, so its cost doesn't grow with the number of messages.
+    Urls of services with discovery are discovered by the front end, when they change the shards are assigned again
+    and workers restarted, the last snapshots of the previous workers are served until all new jobs reported.
+    '''
+
+    def __init__(self, services: List, period: float, jitter: float = SCHEDULER_JITTER_DEFAULT,
+                 workers: Optional[int] = None):
+        '''
+        @param services: List of Service to scrape.
+        @param period: Default interval (seconds) between two scrapes of a service, if not set on the service.
+        @param jitter: Random fraction of period added to or removed from each interval.
+        @param workers: Number of worker processes, default to the number of cpus.
+        '''
+        self._configured_services = services
+        self._workers = workers or os.cpu_count() or 1
+        self._discoveries = [get_discovery(service) for service in services]
+        self._discovered_urls = self._get_discovered_urls()
+        self._shards = self._assign_shards(self._discovered_urls)
+        # number of the assignment of the shards, incremented when they are assigned again
+        self._generation = 0
+        self._services = sorted(set(service.collector.SERVICE for service in services
+                                    if getattr(service.collector, "SERVICE", None)))
+        self._period = period
+        self._jitter = jitter
+        self._context = multiprocessing.get_context("spawn")
+        self._results = self._context.Queue()
+        self._processes: List = [None] * len(self._shards)
+        # guards the shards and their processes
+        self._workers_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._snapshots: Dict[Tuple[int, int], List[Metric]] = {}
+        self._statuses: Dict[Tuple[int, int], Tuple] = {}
+        # (snapshots, statuses) of the previous shards, served until all jobs of the current ones reported
+        self._previous: Optional[Tuple[Dict, Dict]] = None
+        self._worker_metrics: Dict[int, List[Metric]] = {}
+        self._exposition: List[Metric] = []
+        # snapshots were received since the exposition was built
+        self._dirty = False
+        self._build_lock = threading.Lock()
+        # rollups of all services, built again when the rules of a service are reloaded
+        self._rollups: Optional[RollupSet] = None
+        self._rollup_sources: List[RollupSet] = []
+        self._stopped = threading.Event()
+        self._receiver = threading.Thread(target=self._receive, name="shard_receiver", daemon=True)
+        self._discoverer = threading.Thread(target=self._rediscover, name="shard_discovery", daemon=True) \
+            if any(self._discoveries) else None
+
+    def start(self):
+        with self._workers_lock:
+            self._start_workers()
+        self._receiver.start()
+        if self._discoverer is not None:
+            self._discoverer.start()
+
+    def stop(self):
+        self._stopped.set()
+        with self._workers_lock:
+            for process in self._processes:
+                if process is not None:
+                    process.terminate()
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        exposition = self._get_exposition()
+        with self._lock:
+            statuses = list((self._statuses if self._previous is None else self._previous[1]).values())
+            worker_metrics = list(self._worker_metrics.values())
+        for metric in exposition:
+            yield metric
+        for metric in build_target_status(merge_statuses(statuses)):
+            yield metric
+        for metric in merge_metrics(worker_metrics):
+            yield metric
+
+    def _get_discovered_urls(self) -> List[Optional[List[str]]]:
+        '''
+        @return the discovered urls of each service, the same lists until they change.
+        '''
+        return [discovery.get_urls() if discovery is not None else None for discovery in self._discoveries]
+
+    def _assign_shards(self, discovered_urls: List[Optional[List[str]]]) -> List[List]:
+        return assign_shards([resolve_discovery(service, urls)
+                              for service, urls in zip(self._configured_services, discovered_urls)], self._workers)
+
+    def _start_workers(self):
+        for index, shard in enumerate(self._shards):
+            logger.info("shard {} scrapes {}".format(index, ", ".join(
+                "{}{}".format(service.collector.__name__, service.urls) for service in shard)))
+            self._start_worker(index)
+
+    def _start_worker(self, index: int):
+        process = self._context.Process(
+            target=run_shard,
+            args=(self._generation, index, self._shards[index], self._period, self._jitter, self._results),
+            name=f"hadoop_exporter_shard_{index}", daemon=True)
+        process.start()
+        self._processes[index] = process
+
+    def _rediscover(self):
+        '''
+        assign the shards again when the discovered urls of a service changed, discoveries are cached by TargetDiscovery
+        for discovery_interval seconds.
+        '''
+        while not self._stopped.wait(SHARD_MONITOR_INTERVAL):
+            try:
+                discovered_urls = self._get_discovered_urls()
+                if all(urls is previous for urls, previous in zip(discovered_urls, self._discovered_urls)):
+                    continue
+                self._discovered_urls = discovered_urls
+                self._reassign_shards(self._assign_shards(discovered_urls))
+            except:
+                logger.warning("Error while assigning the shards of discovered urls")
+                traceback.print_exc()
+
+    def _reassign_shards(self, shards: List[List]):
+        '''
+        restart the workers with new shards. the snapshots of the previous workers are kept apart, they are served
+        until all jobs of the new workers reported, so series don't disappear nor are duplicated meanwhile.
+        '''
+        with self._workers_lock:
+            if self._stopped.is_set():
+                return
+            logger.info("discovered urls changed, assign {} shards again".format(len(shards)))
+            for process in self._processes:
+                if process is not None:
+                    process.terminate()
+            with self._lock:
+                self._generation += 1
+                if self._previous is None:
+                    self._previous = (self._snapshots, self._statuses)
+                self._snapshots, self._statuses, self._worker_metrics = {}, {}, {}
+                self._shards = shards
+                self._dirty = True
+            self._processes = [None] * len(shards)
+            self._start_workers()
+
+    def _receive(self):
+        while not self._stopped.is_set():
+            try:
+                generation, index, job, encoded, status, worker_metrics = self._results.get(
+                    timeout=SHARD_MONITOR_INTERVAL)
+            except queue.Empty:
+                self._restart_dead_workers()
+                continue
+            except:
+                logger.warning("Error while receiving snapshot from shards")
+                traceback.print_exc()
+                continue
+            snapshot = decode_metrics(encoded)
+            worker_metrics = decode_metrics(worker_metrics)
+            with self._lock:
+                if generation != self._generation:
+                    continue
+                self._snapshots[(index, job)] = snapshot
+                self._statuses[(index, job)] = status
+                self._worker_metrics[index] = worker_metrics
+                if self._previous is not None and len(self._snapshots) == sum(len(shard) for shard in self._shards):
+                    self._previous = None
+                self._dirty = True
+            self._restart_dead_workers()
+
+    def _get_exposition(self) -> List[Metric]:
+        '''
+        merge the last snapshots of all jobs and roll them up, if snapshots were received since the last merge.
+        '''
+        with self._build_lock:
+            with self._lock:
+                if not self._dirty:
+                    return self._exposition
+                self._dirty = False
+                snapshots = list((self._snapshots if self._previous is None else self._previous[0]).values())
+            exposition = self._get_rollups().apply(merge_metrics(snapshots))
+            with self._lock:
+                self._exposition = exposition
+            return exposition
+
+    def _get_rollups(self) -> RollupSet:
+        '''
+        rollups of all services, taken from their current rules so they are reloaded with them.
+        they are merged again only when the rules of a service were reloaded.
+        '''
+        registry = get_rule_registry(common.EXPORTER_METRICS_DIR)
+        sources = []
+        for service in self._services:
+            try:
+                sources.append(registry.get(service).rollups)
+            except:
+                logger.warning("Error while loading rollups of service {}".format(service))
+                traceback.print_exc()
+        if self._rollups is None or len(sources) != len(self._rollup_sources) or \
+                any(source is not cached for source, cached in zip(sources, self._rollup_sources)):
+            rollups = RollupSet()
+            for source in sources:
+                rollups.rules.extend(source.rules)
+            self._rollups, self._rollup_sources = rollups, sources
+        return self._rollups
+
+    def _restart_dead_workers(self):
+        with self._workers_lock:
+            for index, process in enumerate(self._processes):
+                if process is not None and not process.is_alive() and not self._stopped.is_set():
+                    logger.warning("shard {} exited with code {}, restart it".format(index, process.exitcode))
+                    self._start_worker(index)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from array import array
+from typing import Dict, List, Optional, Tuple
+from prometheus_client.core import Metric
+from prometheus_client.samples import Sample
+from prometheus_client.utils import floatToGoString
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+class LabelSet(object):
+    '''
+    Label values of a series, stored once and referenced by every sample of the series.
+    Its labels dict and its prefix in the exposition format are built once per label names and reused across scrapes.
+    '''
+    __slots__ = ("label_values", "_labels", "_labels_for", "_prefix", "_prefix_name", "_prefix_for")
+
+    def __init__(self, label_values: List[str]):
+        self.label_values = label_values
+        self._labels = None
+        self._labels_for = None
+        self._prefix = None
+        self._prefix_name = None
+        self._prefix_for = None
+
+    def get_labels(self, label_names: Tuple[str, ...]) -> Dict[str, str]:
+        '''
+        labels of a sample in a metric family with these label names, usually the ones of this series.
+        '''
+        if label_names != self._labels_for:
+            self._labels = dict(zip(label_names, self.label_values))
+            self._labels_for = label_names
+        return self._labels
+
+    def get_prefix(self, name: str, label_names: Tuple[str, ...]) -> str:
+        '''
+        start of a sample line in the exposition formats until its value, e.g. 'name{cluster="prod",host="nn1"} '.
+        '''
+        if name != self._prefix_name or label_names != self._prefix_for:
+            labels = self.get_labels(label_names)
+            self._prefix = '{0}{1} '.format(name, '{{{0}}}'.format(','.join(
+                '{0}="{1}"'.format(k, escape_label_value(v)) for k, v in sorted(labels.items()))) if labels else '')
+            self._prefix_name = name
+            self._prefix_for = label_names
+        return self._prefix
+
+
+class ColumnarMetricFamily(Metric):
+    '''
+    Metric family storing its samples in columns: a reference to the LabelSet of each sample and its value in a flat
+    array('d'), so adding a sample doesn't allocate a Sample, a labels dict nor a list of label values.
+    Samples are only materialized when read through samples, the text exposition is rendered from the columns.
+    Columns of families merged from several collectors are kept apart, each with the label names of its family.
+    '''
+
+    def __init__(self, name: str, documentation: str, labels: List[str], typ: str = 'gauge'):
+        self._columns: List[Tuple[Tuple[str, ...], List[LabelSet], array]] = []
+        Metric.__init__(self, name, documentation, typ)
+        self._labelnames = tuple(labels)
+        self._label_sets: List[LabelSet] = []
+        self._values = array('d')
+        self._columns.append((self._labelnames, self._label_sets, self._values))
+
+    def add(self, label_set: LabelSet, value: float):
+        self._label_sets.append(label_set)
+        self._values.append(value)
+
+    def add_metric(self, labels: List[str], value: float, timestamp: Optional[float] = None):
+        '''
+        same as GaugeMetricFamily.add_metric, the label set is not shared with other samples.
+        '''
+        if timestamp is not None:
+            self._samples.append(Sample(self.name, dict(zip(self._labelnames, labels)), value, timestamp))
+            return
+        self.add(LabelSet(labels), value)
+
+    def merge(self, other: "ColumnarMetricFamily") -> "ColumnarMetricFamily":
+        '''
+        @return a new family with the samples of this family then the ones of other, without copying the columns.
+        '''
+        merged = ColumnarMetricFamily(self.name, self.documentation, self._labelnames, self.type)
+        merged._columns = self._columns + other._columns
+        merged._samples = self._samples + other._samples
+        return merged
+
+    def __len__(self) -> int:
+        return sum(len(values) for _, _, values in self._columns) + len(self._samples)
+
+    @property
+    def samples(self) -> List[Sample]:
+        samples = [Sample(self.name, label_set.get_labels(label_names), value, None)
+                   for label_names, label_sets, values in self._columns
+                   for label_set, value in zip(label_sets, values)]
+        return samples + self._samples if self._samples else samples
+
+    @samples.setter
+    def samples(self, samples: List[Sample]):
+        # samples set by Metric.__init__ or by callers, kept beside the columns
+        self._samples = list(samples)
+
+    def render(self, output: List[str], sample_line) -> None:
+        '''
+        append the sample lines, straight from the columns. lines of the text and OpenMetrics formats are the same
+        for samples without timestamp.
+        @param sample_line: function rendering a Sample which is not stored in columns.
+        '''
+        name = self.name
+        for label_names, label_sets, values in self._columns:
+            output.extend([label_set.get_prefix(name, label_names) + floatToGoString(value) + '\n'
+                           for label_set, value in zip(label_sets, values)])
+        output.extend([sample_line(sample) for sample in self._samples])
+
+    def __repr__(self):
+        return "ColumnarMetricFamily({0}, {1}, {2}, {3} samples)".format(
+            self.name, self.documentation, self.type, len(self))
@@ -5,72 +5,294 @@ import os
 import socket
 import re
 from typing import Dict, List, Optional
+import json
+import time
+import threading
+from typing import Callable, Iterable, Iterator
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
 import yaml
+from hadoop_exporter import logs
 import argparse
 
 EXPORTER_LOGS_DIR = os.environ.get('EXPORTER_LOGS_DIR', '/tmp/exporter')
 
 
-def get_logger(name, log_file="hadoop_exporter.log", level: str = "INFO") -> logging.Logger:
+def get_logger(name, log_file=logs.LOG_FILE_DEFAULT, level: str = "INFO") -> logging.Logger:
     '''
     define a common logger template to record log.
+    records are written to the console and to log_file by a background thread, repeated records of a line are
+    rate limited. handlers are attached once, so collectors of a service calling it share its logger.
     @param name log module or object name.
     @return logger.
     '''
+    return logs.get_logger(name, EXPORTER_LOGS_DIR, log_file, level)
 
-    logger = logging.getLogger(name)
-    logger.setLevel(level.upper())
 
-    if not os.path.exists(EXPORTER_LOGS_DIR):
-        os.makedirs(EXPORTER_LOGS_DIR)
+logger = get_logger(__name__)
 
-    fh = logging.FileHandler(os.path.join(EXPORTER_LOGS_DIR, log_file))
-    fh.setLevel(logging.INFO)
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
-    sh = logging.StreamHandler()
-    sh.setLevel(logging.INFO)
+HTTP_TIMEOUT_DEFAULT = 5
+HTTP_CHUNK_SIZE = 64 * 1024
+BEANS_START_REGEX = re.compile(rb'"beans"\s*:\s*\[')
+JSON_STRING = rb'"[^"\\]*(?:\\.[^"\\]*)*"'
+JSON_STRING_REGEX = re.compile(JSON_STRING)
+# runs of anything but braces, strings are skipped as a whole so braces in strings are ignored.
+# repeats are bounded to keep the memory of the regex engine small
+BEAN_SKIP_REGEX = re.compile(rb'[^"{}]*(?:' + JSON_STRING + rb'[^"{}]*){0,256}')
+BEAN_SEPARATOR_REGEX = re.compile(rb'[\s,]*')
+BEAN_NAME_REGEX = re.compile(rb'\{\s*"name"\s*:\s*(' + JSON_STRING + rb')')
+# bytes after which a bean without a leading name is decoded to find its name
+BEAN_NAME_LOOKAHEAD = 4096
+HTTP_POOL_SIZE_DEFAULT = 2
+HTTP_RETRY_STATUS = (500, 502, 503, 504)
 
-    fmt = logging.Formatter(
-        fmt='%(asctime)s %(filename)s[line:%(lineno)d]-[%(levelname)s]: %(message)s')
-    fh.setFormatter(fmt)
-    sh.setFormatter(fmt)
+_default_session = None
+_default_session_lock = threading.Lock()
 
-    logger.addHandler(fh)
-    logger.addHandler(sh)
-    return logger
 
+def get_session(pool_connections: int = 10, pool_size: int = HTTP_POOL_SIZE_DEFAULT, keep_alive: bool = True,
+                retries: int = 0, backoff_factor: float = 0) -> requests.Session:
+    '''
+    create a long-lived http session with connection pooling, reused across scrapes.
+    @param pool_connections: number of per-host connection pools to keep, should cover all hosts scraped by the session.
+    @param pool_size: max number of connections kept alive per host.
+    @param keep_alive: reuse connections between requests if true, else close them after each request.
+    @param retries: number of retries on connection errors and 5xx responses.
+    @param backoff_factor: sleep {backoff_factor} * (2 ^ (retry - 1)) seconds between retries.
+    @return session.
+    '''
+    retry = Retry(total=retries, backoff_factor=backoff_factor,
+                  status_forcelist=HTTP_RETRY_STATUS, raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if not keep_alive:
+        session.headers["Connection"] = "close"
+    return session
 
-logger = get_logger(__name__)
+
+def get_default_session() -> requests.Session:
+    '''
+    get the process-wide session used when no session is given to get_metrics.
+    '''
+    global _default_session
+    with _default_session_lock:
+        if _default_session is None:
+            _default_session = get_session()
+        return _default_session
+
+
+class FetchStats(object):
+    '''
+    Measures of the fetch of an url, accumulated over all its requests by fetch_beans.
+    '''
+    __slots__ = ("request_seconds", "download_seconds", "decode_seconds", "bytes", "beans")
+
+    def __init__(self):
+        self.request_seconds = 0.0
+        self.download_seconds = 0.0
+        self.decode_seconds = 0.0
+        self.bytes = 0
+        self.beans = 0
+
+    def read(self, chunks: Iterable[bytes]) -> Iterator[bytes]:
+        '''
+        count bytes of chunks and time spent waiting for them.
+        '''
+        chunks = iter(chunks)
+        while True:
+            started = time.perf_counter()
+            chunk = next(chunks, None)
+            self.download_seconds += time.perf_counter() - started
+            if chunk is None:
+                return
+            self.bytes += len(chunk)
+            yield chunk
+
+
+class BeanParser(object):
+    '''
+    Incremental parser of the beans array of a jmx json document, fed with the chunks of the document as they are
+    received, e.g. by a non-blocking client. See iter_beans.
+    '''
+
+    def __init__(self, accept: Optional[Callable[[str], bool]] = None, stats: Optional[FetchStats] = None):
+        '''
+        @param accept: Called with the bean name before decoding a bean, the bean is skipped without being decoded if false.
+        @param stats: Counts all beans of the document, accepted or not.
+        '''
+        self.accept = accept
+        self.stats = stats
+        # whether the end of the beans array was parsed, the rest of the document is ignored
+        self.done = False
+        # wanted: whether the bean in progress is decoded, None until its name is known
+        self._state = (b"", 0, 0, 0, False, None)
+
+    def feed(self, chunk: bytes) -> List[Dict]:
+        '''
+        @return the beans completed by a chunk of the document.
+        '''
+        if self.done:
+            return []
+        accept, stats = self.accept, self.stats
+        buf, pos, depth, start, started, wanted = self._state
+        buf += chunk
+        beans = []
+        if not started:
+            matched = BEANS_START_REGEX.search(buf)
+            if matched is None:
+                # keep enough bytes to match the beans key split between two chunks
+                self._state = (buf[-64:], pos, depth, start, started, wanted)
+                return beans
+            started, pos = True, matched.end()
+        while pos < len(buf):
+            if depth == 0:
+                pos = BEAN_SEPARATOR_REGEX.match(buf, pos).end()
+                if pos >= len(buf):
+                    break
+                if buf[pos:pos + 1] == b"]":
+                    self.done = True
+                    self._state = (b"", 0, 0, 0, True, None)
+                    return beans
+                if buf[pos:pos + 1] != b"{":
+                    raise ValueError("unexpected character in beans array at {0}".format(pos))
+                start, wanted = pos, True if accept is None else None
+                if stats is not None:
+                    stats.beans += 1
+            else:
+                if wanted is None and pos - start <= BEAN_NAME_LOOKAHEAD:
+                    name = BEAN_NAME_REGEX.match(buf, start)
+                    if name is not None:
+                        wanted = bool(accept(json_loads(name.group(1))))
+                pos = BEAN_SKIP_REGEX.match(buf, pos).end()
+                if pos >= len(buf):
+                    break
+                if buf[pos:pos + 1] == b'"':
+                    if JSON_STRING_REGEX.match(buf, pos) is None:
+                        # a string is split between two chunks
+                        break
+                    continue
+            depth += 1 if buf[pos:pos + 1] == b"{" else -1
+            pos += 1
+            if depth == 0 and wanted is not False:
+                bean = json_loads(buf[start:pos])
+                # the name is checked after decoding if it's not the first key of the bean
+                if wanted or accept(bean.get("name", "")):
+                    beans.append(bean)
+        # drop parsed and skipped beans, keep the one in progress
+        keep = start if depth > 0 and wanted is not False else pos
+        self._state = (buf[keep:], pos - keep, depth, start - keep, started, wanted)
+        return beans
+
+    def close(self):
+        '''
+        @raise ValueError if the document ended before the end of the beans array.
+        '''
+        if not self.done:
+            raise ValueError("incomplete beans array" if self._state[4] else "no beans array")
 
 
-def get_metrics(url) -> List[Dict]:
+def iter_beans(chunks: Iterable[bytes], accept: Optional[Callable[[str], bool]] = None,
+               stats: Optional[FetchStats] = None) -> Iterator[Dict]:
+    '''
+    parse the beans array of a jmx json document incrementally, one chunk at a time. The whole document is never held
+    in memory, but parsing is about 3 times slower than json.loads, it's meant for very large responses.
+    @param chunks: The document as an iterable of bytes, e.g. response.iter_content()
+    @param accept: Called with the bean name before decoding a bean, the bean is skipped without being decoded if false.
+    @param stats: Counts all beans of the document, accepted or not.
+    @return an iterator of decoded beans.
+    '''
+    parser = BeanParser(accept, stats)
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+        if parser.done:
+            return
+    parser.close()
+
+
+def fetch_beans(url, session: Optional[requests.Session] = None, timeout: float = HTTP_TIMEOUT_DEFAULT,
+                params: Optional[Dict] = None, accept: Optional[Callable[[str], bool]] = None,
+                stream: bool = False, stats: Optional[FetchStats] = None) -> List[Dict]:
+    '''
+    same as get_metrics but raise an exception on any error instead of returning an empty list.
+    :param params: The query parameters, e.g. {"qry": "Hadoop:service=NameNode,name=FSNamesystem"}
+    :param accept: Called with each bean name, beans not accepted are dropped.
+    :param stream: Parse beans incrementally from the response body instead of loading the whole document,
+                   beans not accepted are never decoded. Saves memory on very large responses, at a cpu cost.
+    :param stats: Accumulates durations of request, download and decode, bytes and beans received.
+    '''
+    stats = stats or FetchStats()
+    started = time.perf_counter()
+    # the body is read after the headers in both modes, to time the download apart
+    response = (session or get_default_session()).get(url, timeout=timeout, params=params, stream=True)
+    with response:
+        stats.request_seconds += time.perf_counter() - started
+        response.raise_for_status()
+        if stream:
+            started, downloaded = time.perf_counter(), stats.download_seconds
+            beans = list(iter_beans(stats.read(response.iter_content(HTTP_CHUNK_SIZE)), accept, stats))
+            stats.decode_seconds += time.perf_counter() - started - (stats.download_seconds - downloaded)
+            return beans
+        started = time.perf_counter()
+        content = response.content
+        stats.download_seconds += time.perf_counter() - started
+        stats.bytes += len(content)
+    return load_beans(content, response.url, accept, stats)
+
+
+def load_beans(content: bytes, url: str, accept: Optional[Callable[[str], bool]] = None,
+               stats: Optional[FetchStats] = None) -> List[Dict]:
+    '''
+    decode the beans of a whole jmx json document.
+    :param url: The url of the document, reported if it has no beans.
+    :param accept: Called with each bean name, beans not accepted are dropped.
+    :param stats: Accumulates the decode duration and the beans received.
+    '''
+    stats = stats or FetchStats()
+    started = time.perf_counter()
+    rlt = json_loads(content)
+    stats.decode_seconds += time.perf_counter() - started
+    if not isinstance(rlt, dict) or "beans" not in rlt:
+        raise ValueError("no beans in response of {0}".format(url))
+    stats.beans += len(rlt["beans"])
+    if accept is None:
+        return rlt["beans"]
+    return [bean for bean in rlt["beans"] if accept(bean.get("name", ""))]
+
+
+def get_metrics(url, session: Optional[requests.Session] = None, timeout: float = HTTP_TIMEOUT_DEFAULT,
+                accept: Optional[Callable[[str], bool]] = None, stream: bool = False) -> List[Dict]:
     '''
     :param url: The jmx url, e.g. http://host1:9870/jmx, http://host1:8088/jmx, http://host2:19888/jmx...
+    :param session: The pooled session to send request, the process-wide session is used if not provided.
+    :param timeout: The request timeout in seconds.
+    :param accept: Called with each bean name, beans not accepted are dropped.
+    :param stream: Parse beans incrementally from the response body.
     :return a dict of all metrics scraped in the jmx url.
     '''
-    result = []
     try:
-        s = requests.session()
-        response = s.get(url, timeout=5)
+        result = fetch_beans(url, session, timeout, accept=accept, stream=stream)
+    except requests.HTTPError as e:
+        logger.warning("get {0} failed, response code is: {1}.".format(
+            url, e.response.status_code))
+        return []
+    except ValueError as e:
+        logger.warning("no metrics get in the {0}: {1}".format(url, e))
+        return []
     except Exception as e:
         logger.warning("error in func: get_metrics, error msg: %s" % e)
-        result = []
-    else:
-        if response.status_code != requests.codes.ok:
-            logger.warning("get {0} failed, response code is: {1}.".format(
-                url, response.status_code))
-            result = []
-        rlt = response.json()
-        logger.debug(rlt)
-        if rlt and "beans" in rlt:
-            result = rlt['beans']
-        else:
-            logger.warning("no metrics get in the {0}.".format(url))
-            result = []
-    finally:
-        s.close()
+        return []
+    if not result:
+        logger.warning("no metrics get in the {0}.".format(url))
     return result
 
 
@@ -237,6 +459,81 @@ def parse_args():
         help='Period (seconds) to consume jmx service. (default: 30)',
         default=None
     )
+    parser.add_argument(
+        '--mode',
+        dest='mode',
+        required=False,
+        help='Exporter mode: pull (scrape jmx on each prometheus pull), scheduler (scrape jmx in background every period), sharded (like scheduler, in worker processes), async (like pull, jmx urls fetched concurrently in an event loop) or push (like scheduler, samples pushed to --remote-write-url). (default: pull)',
+        default=None
+    )
+    parser.add_argument(
+        '--jitter',
+        dest='jitter',
+        required=False,
+        type=float,
+        help='Random fraction of period added to or removed from each background scrape interval in scheduler mode. (default: 0.1)',
+        default=None
+    )
+    parser.add_argument(
+        '--workers',
+        dest='workers',
+        required=False,
+        type=int,
+        help='Number of worker processes in sharded mode. (default: number of cpus)',
+        default=None
+    )
+    parser.add_argument(
+        '--cache-ttl',
+        dest='cache_ttl',
+        required=False,
+        type=float,
+        help='Seconds a rendering of /metrics is served to other scrapers, 0 to only share renderings in progress. (default: 0)',
+        default=None
+    )
+    parser.add_argument(
+        '--remote-write-url',
+        dest='remote_write_url',
+        required=False,
+        help='Prometheus remote-write url the samples are pushed to in push mode, e.g. http://prometheus:9090/api/v1/write',
+        default=None
+    )
+    parser.add_argument(
+        '--replica',
+        dest='replica',
+        required=False,
+        help='Name of this exporter in the peers sharing the targets. (default: hostname)',
+        default=None
+    )
+    parser.add_argument(
+        '--peers',
+        dest='peers',
+        required=False,
+        help='Comma separated names of the exporter replicas sharing the targets, each one scrapes only its part. (example "exporter-0,exporter-1")',
+        default=None
+    )
+    parser.add_argument(
+        '--membership-file',
+        dest='membership_file',
+        required=False,
+        help='File listing the names of the exporter replicas, one per line, re-read when it changes. Replaces --peers.',
+        default=None
+    )
+    parser.add_argument(
+        '--max-in-flight',
+        dest='max_in_flight',
+        required=False,
+        type=int,
+        help='Maximum number of JMX urls of a service fetched concurrently. (default: 16)',
+        default=None
+    )
+    parser.add_argument(
+        '--scrape-deadline',
+        dest='scrape_deadline',
+        required=False,
+        type=float,
+        help='Total time (seconds) to wait for all JMX urls of a service on each scrape, late requests can overrun it by the download of a body still arriving or their retries. (default: 25)',
+        default=None
+    )
     parser.add_argument(
         '--log-level',
         required=False,